@@ -1,8 +1,9 @@
-from flask import Flask, g
-from abell.database import mongo
-from abell import config
+from flask import Flask
+from abell.database import mongo, mongo_uri
+from abell import config, metrics, profiling, slow_queries
 from abell.api import api
-import time
+from abell.api import responses
+from abell.models import asset, asset_type
 
 
 def create_app(config=config.base_config):
@@ -12,11 +13,6 @@ def create_app(config=config.base_config):
     register_extensions(app)
     register_blueprints(app)
 
-    @app.before_request
-    def before_request():
-        g.request_start_time = time.time()
-        g.request_time = lambda: '%.5fs' % (time.time() - g.request_start_time)
-
     @app.route('/', methods=['GET'])
     def index():
         return 'Hello'
@@ -25,7 +21,14 @@ def create_app(config=config.base_config):
 
 
 def register_extensions(app):
+    app.config.setdefault('MONGO_URI', mongo_uri(app.config))
     mongo.init_app(app)
+    asset_type.ASSET_TYPE_CACHE.init_app(app)
+    asset.QUERY_CACHE.init_app(app)
+    responses.ENCODER.init_app(app)
+    metrics.METRICS.init_app(app)
+    slow_queries.SLOW_QUERIES.init_app(app)
+    profiling.PROFILER.init_app(app)
 
 
 def register_blueprints(app):
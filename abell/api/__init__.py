@@ -3,3 +3,4 @@ from flask import Blueprint
 api = Blueprint('api', __name__)
 
 from abell.api import v1_controller  # noqa
+from abell.api import compression  # noqa
@@ -0,0 +1,89 @@
+import gzip
+import zlib
+from flask import current_app, request
+from abell.api import api
+
+
+# Already compressed bodies are sent as they are
+SKIPPED_MIMETYPES = set(['application/gzip', 'application/zip',
+                         'application/x-gzip'])
+
+
+def negotiate_encoding():
+    """Returns gzip or deflate as allowed by Accept-Encoding, or None."""
+    return request.accept_encodings.best_match(['gzip', 'deflate'])
+
+
+def compressor(encoding, level):
+    if encoding == 'gzip':
+        # wbits 16 + MAX_WBITS writes the gzip header and trailer
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(level)
+
+
+def compress_stream(chunks, original, encoding, level, flush_size=16384):
+    """Compresses chunks as they come, flushing so clients see them early.
+
+    zlib keeps output back until a block fills, so the stream is sync
+    flushed once the bytes taken in since the last flush reach a threshold.
+    The threshold starts at one byte and doubles up to flush_size, the
+    first documents go out right away and a long stream flushes rarely
+    enough to keep its compression ratio.
+    """
+    compress = compressor(encoding, level)
+    threshold = 1
+    pending = 0
+    try:
+        for chunk in chunks:
+            data = compress.compress(chunk)
+            pending += len(chunk)
+            if pending >= threshold:
+                data += compress.flush(zlib.Z_SYNC_FLUSH)
+                pending = 0
+                threshold = min(threshold * 2, flush_size)
+            if data:
+                yield data
+        yield compress.flush()
+    finally:
+        if hasattr(original, 'close'):
+            original.close()
+
+
+@api.after_request
+def compress_response(response):
+    """Compresses API responses with gzip or deflate.
+
+    Buffered bodies smaller than COMPRESSION_MIN_SIZE bytes are left alone.
+    Streamed bodies have no known size and are always compressed, chunk by
+    chunk as they are produced.
+    """
+    config = current_app.config
+    if not config.get('COMPRESSION_ENABLED', True):
+        return response
+    if (response.status_code < 200 or response.status_code in (204, 304) or
+            response.mimetype in SKIPPED_MIMETYPES or
+            'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if not encoding:
+        return response
+    level = config.get('COMPRESSION_LEVEL', 6)
+
+    if response.is_streamed:
+        original = response.response
+        response.response = compress_stream(
+            response.iter_encoded(), original, encoding, level,
+            config.get('COMPRESSION_FLUSH_SIZE', 16384))
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < config.get('COMPRESSION_MIN_SIZE', 1024):
+            return response
+        if encoding == 'gzip':
+            data = gzip.compress(data, level)
+        else:
+            data = zlib.compress(data, level)
+        response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -1,20 +1,237 @@
+import bson
+import datetime
 import json
-from flask import Response
+import time
+import uuid
+import zlib
+from bson import ObjectId
+from bson.decimal128 import Decimal128
+from bson.raw_bson import RawBSONDocument
+from flask import Response, stream_with_context
+from abell import metrics
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def bson_default(obj):
+    """Encodes the BSON types the json encoders do not know about."""
+    if isinstance(obj, (ObjectId, Decimal128, uuid.UUID)):
+        return str(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8', 'replace')
+    raise TypeError('%r is not JSON serializable' % type(obj))
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj, default=bson_default).encode('utf-8')
+
+
+def orjson_dumps(obj):
+    return orjson.dumps(obj, default=bson_default,
+                        option=orjson.OPT_NON_STR_KEYS)
+
+
+def ujson_dumps(obj):
+    return ujson.dumps(obj, default=bson_default).encode('utf-8')
+
+
+class ResponseEncoder(object):
+    """JSON encoder used for every response body.
+
+    JSON_ENCODER picks orjson, ujson or json, 'auto' takes the fastest one
+    installed. Output is always bytes. Anything the fast encoder refuses,
+    like integers over 64 bits, is retried with the stdlib encoder.
+    """
+
+    ENCODERS = [('orjson', orjson, orjson_dumps),
+                ('ujson', ujson, ujson_dumps)]
+
+    def __init__(self, name='auto'):
+        self.set_encoder(name)
+
+    def init_app(self, app):
+        self.set_encoder(app.config.get('JSON_ENCODER', 'auto'))
+
+    def set_encoder(self, name):
+        self.name, self.dumps = 'json', stdlib_dumps
+        for encoder_name, module, dumps in self.ENCODERS:
+            if module is not None and name in ('auto', encoder_name):
+                self.name, self.dumps = encoder_name, dumps
+                return
+
+    def encode(self, obj):
+        try:
+            return self.dumps(obj)
+        except (TypeError, ValueError, OverflowError):
+            if self.dumps is stdlib_dumps:
+                raise
+            return stdlib_dumps(obj)
+
+
+ENCODER = ResponseEncoder()
+
+
+class PreEncoded(object):
+    """JSON that has already been encoded, written out as is."""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.data = data
+
+
+def encode(obj):
+    if isinstance(obj, PreEncoded):
+        return obj.data
+    return ENCODER.encode(obj)
 
 
 def abell_success(*args, **kwargs):
-    success = {"code": 200}
-    payload = kwargs.get('payload', None)
-    kwargs.pop('payload', None)
+    payload = kwargs.pop('payload', None)
     details = kwargs
-    success.update({'payload': payload,
-                    'details': details})
-    response = Response(json.dumps(success),
+    started = time.perf_counter()
+    # payload is spliced in so PreEncoded bytes are never decoded again
+    body = b''.join([b'{"code": 200, "payload": ', encode(payload),
+                     b', "details": ', encode(details), b'}'])
+    metrics.add_time('serialize', time.perf_counter() - started)
+    response = Response(body,
                         status=200,
                         mimetype="application/json")
     return response
 
 
+def abell_stream(documents, **kwargs):
+    """Streams the abell_success envelope.
+
+    Documents are encoded one at a time while iterating, so the full result
+    is never held in memory. details are written after the payload, which
+    lets an error raised mid stream still be reported to the client.
+    """
+    def generate():
+        yield b'{"code": 200, "payload": ['
+        separator = b''
+        try:
+            for document in documents:
+                yield separator + encode(document)
+                separator = b', '
+        except Exception as e:
+            metrics.db_error('abell_stream', e)
+            kwargs['error'] = 'Stream interrupted, payload is incomplete'
+        yield b'], "details": ' + encode(kwargs) + b'}'
+
+    return Response(stream_with_context(generate()),
+                    status=200,
+                    mimetype="application/json")
+
+
+def abell_ndjson(documents):
+    """Streams documents as newline delimited JSON, one per line."""
+    def generate():
+        try:
+            for document in documents:
+                yield encode(document) + b'\n'
+        except Exception as e:
+            metrics.db_error('abell_ndjson', e)
+            yield encode(
+                {'error': 'Stream interrupted, payload is incomplete'}) + b'\n'
+
+    return Response(stream_with_context(generate()),
+                    status=200,
+                    mimetype="application/x-ndjson")
+
+
+def abell_bson(documents):
+    """Streams documents as concatenated BSON, like mongodump writes them.
+
+    RawBSONDocuments are sent as the bytes the server returned, without
+    being decoded and encoded again.
+    """
+    def generate():
+        try:
+            for document in documents:
+                if isinstance(document, RawBSONDocument):
+                    yield document.raw
+                else:
+                    yield bson.encode(document)
+        except Exception as e:
+            metrics.db_error('abell_bson', e)
+            yield bson.encode(
+                {'error': 'Stream interrupted, payload is incomplete'})
+
+    return Response(stream_with_context(generate()),
+                    status=200,
+                    mimetype="application/bson")
+
+
+def abell_msgpack(documents):
+    """Streams documents as a sequence of MessagePack maps.
+
+    Needs the optional msgpack package.
+    """
+    packer = msgpack.Packer(default=bson_default)
+
+    def generate():
+        try:
+            for document in documents:
+                yield packer.pack(document)
+        except Exception as e:
+            metrics.db_error('abell_msgpack', e)
+            yield packer.pack(
+                {'error': 'Stream interrupted, payload is incomplete'})
+
+    return Response(stream_with_context(generate()),
+                    status=200,
+                    mimetype="application/msgpack")
+
+
+def abell_export(header, documents, filename, level=6):
+    """Streams a gzip compressed NDJSON file download.
+
+    The header record is the first line, followed by one document per
+    line. Lines are compressed as they are produced.
+    """
+    def generate():
+        compress = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        yield compress.compress(encode(header) + b'\n')
+        try:
+            for document in documents:
+                data = compress.compress(encode(document) + b'\n')
+                if data:
+                    yield data
+        except Exception as e:
+            metrics.db_error('abell_export', e)
+            yield compress.compress(encode(
+                {'error': 'Stream interrupted, export is incomplete'}) + b'\n')
+        yield compress.flush()
+
+    response = Response(stream_with_context(generate()),
+                        status=200,
+                        mimetype="application/gzip")
+    response.headers['Content-Disposition'] = (
+        'attachment; filename="%s"' % filename)
+    return response
+
+
+def abell_not_modified(etag):
+    """Empty 304 answer to a matching If-None-Match."""
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    return response
+
+
 def abell_error(code, *args, **kwargs):
     if code == 400:
         return four_oh_oh(*args, **kwargs)
@@ -22,6 +239,8 @@ def abell_error(code, *args, **kwargs):
         return four_oh_one(*args, **kwargs)
     if code == 404:
         return four_oh_four(*args, **kwargs)
+    if code == 406:
+        return four_oh_six(*args, **kwargs)
     if code == 500:
         return five_oh_oh(*args, **kwargs)
 
@@ -58,6 +277,16 @@ def four_oh_four(*args, **kwargs):
     return flask_error_response(error)
 
 
+# 406's No acceptable response format
+def four_oh_six(*args, **kwargs):
+    error = {"code": 406,
+             "type": "not acceptable",
+             "message": args,
+             "details": kwargs}
+
+    return flask_error_response(error)
+
+
 # 500 Internal Server error
 def five_oh_oh(*args, **kwargs):
     error = {"code": 500,
@@ -70,7 +299,7 @@ def five_oh_oh(*args, **kwargs):
 def flask_error_response(error_dict):
     error_code = error_dict.get('code', 500)
     message = error_dict.get('message')
-    response = Response(json.dumps(error_dict),
+    response = Response(encode(error_dict),
                         status=error_code,
                         mimetype="application/json")
     response.headers['Error-Message'] = message
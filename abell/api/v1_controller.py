@@ -1,11 +1,18 @@
 from functools import wraps
-from flask import request
+from flask import current_app, request
 from ..api import api
 from abell.models import asset_type as AT
 from abell.models import asset
-from .responses import abell_error, abell_success
+from abell.models import migration
+from abell import slow_queries
+from abell.api import responses
+from .responses import (abell_bson, abell_error, abell_export, abell_msgpack,
+                        abell_ndjson, abell_not_modified, abell_stream,
+                        abell_success)
 
-# import json
+import datetime
+import hashlib
+import json
 
 FLAGS = {'create_keys': {'action': ['create'],
                          'auth': ['admin']}}
@@ -60,13 +67,25 @@ def get_query_params(request_args):
                      'error': None,
                      'params': None,
                      'specified_keys': None,
-                     'distinct_key': None}
+                     'distinct_key': None,
+                     'stream': False,
+                     'limit': None,
+                     'after': None}
     params = dict()
     specified_keys = {'_id': 0}
     try:
         for k, v in request_args.items():
             if k == 'distinct_key':
                 response_dict['distinct_key'] = v
+            elif k == 'stream':
+                response_dict['stream'] = v.lower() == 'true'
+            elif k == 'limit':
+                limit = int(v)
+                if limit < 1:
+                    raise ValueError('limit must be positive')
+                response_dict['limit'] = limit
+            elif k == 'after':
+                response_dict['after'] = v
             elif k == 'specified_keys':
                 keys = v.replace('[', '').replace(']', '').split(',')
                 for key in keys:
@@ -102,7 +121,10 @@ def create_asset_type():
         data type.
         EX:{'type': 'server',
             'managed_keys': [key1,key2],
-            'unmanaged_keys':[key3,key4]}
+            'unmanaged_keys':[key3,key4],
+            'indexed_keys': [key1, [key2, key3]],
+            'sparse': true}
+        sparse types only store the keys that were set on each asset.
     Returns:
         Response dict: {'code': int, 'payload': null}
     """
@@ -121,6 +143,14 @@ def create_asset_type():
                            'managed_keys and unmanaged_keys must by lists')
     new_asset_info = {'managed_keys': managed_keys,
                       'unmanaged_keys': unmanaged_keys}
+    if 'indexed_keys' in data:
+        if type(data.get('indexed_keys')) is not list:
+            return abell_error(400, 'indexed_keys must be a list')
+        new_asset_info['indexed_keys'] = data.get('indexed_keys')
+    if 'sparse' in data:
+        if type(data.get('sparse')) is not bool:
+            return abell_error(400, 'sparse must be true or false')
+        new_asset_info['sparse'] = data.get('sparse')
 
     new_asset = AT.AbellAssetType(new_asset_type,
                                   asset_info=new_asset_info)
@@ -149,15 +179,59 @@ def return_asset_info():
     if not validate_response.get('success'):
         return validate_response.get('error')
     asset_type = request.args.get('type')
+    # only schema changes bump the version, asset writes do not matter here
+    generation = asset.type_generation(asset_type)
+    etag = None
+    if generation is not None:
+        etag = read_etag('asset_type', asset_type,
+                         (generation[0], generation[-1]))
+    if not_modified(etag):
+        return abell_not_modified(etag)
 
     abell_asset_type = AT.get_asset_type(asset_type)
     if abell_asset_type:
-        return abell_success(payload=abell_asset_type.key_dict())
+        response_details = {}
+        if abell_asset_type.indexed_keys:
+            response_details['index_status'] = abell_asset_type.index_status()
+        return tag_response(abell_success(payload=abell_asset_type.key_dict(),
+                                          **response_details), etag)
 
     return abell_error(404,
                        '%s asset type not found' % asset_type)
 
 
+@api.route('/v1/asset_type/<asset_type>/export', methods=['GET'])
+# todo auth
+def export_asset_type(asset_type):
+    """Export every asset of a type
+
+    Streams a gzip compressed NDJSON file. The first line holds the asset
+    type schema, every following line is an asset, sorted by abell_id.
+    Assets are read from a snapshot when the database supports it.
+    Args:
+        asset type from the url
+        EX: GET .../v1/asset_type/server/export
+    Returns:
+        application/gzip attachment
+    """
+    abell_asset_type = AT.get_asset_type(asset_type)
+    if not abell_asset_type:
+        return abell_error(404,
+                           '%s asset type not found' % asset_type)
+    db_result = asset.export_assets(
+        abell_asset_type, current_app.config.get('EXPORT_BATCH_SIZE', 1000))
+    if not db_result.get('success'):
+        return abell_error(db_result.get('error'),
+                           db_result.get('message'))
+    export = db_result.get('result')
+    header = {'schema': abell_asset_type.key_dict(),
+              'snapshot': export.get('snapshot'),
+              'exported_at': datetime.datetime.utcnow().isoformat()}
+    return abell_export(header, export.get('documents'),
+                        '%s.ndjson.gz' % asset_type,
+                        current_app.config.get('COMPRESSION_LEVEL', 6))
+
+
 @api.route('/v1/asset_type', methods=['PUT'])
 # todo auth
 def update_asset_type():
@@ -171,12 +245,20 @@ def update_asset_type():
         EX:{'type': 'server',
             'remove_keys': ['key5']
             'managed_keys': ['key1','key2'],
-            'unmanaged_keys':['key3','key4']}
+            'unmanaged_keys':['key3','key4'],
+            'indexed_keys': ['key1', ['key2', 'key3']]}
+        indexed_keys replaces the declared indexes when given, indexes on
+        removed keys are always dropped.
     Returns:
         Response dict: {'code': int, 'payload': null,
                         'details': {'new keys': [],
                                     'removed_keys': [],
+                                    'new_indexes': [],
+                                    'dropped_indexes': [],
+                                    'migration_id': str,
                                     'info': str}}
+        Adding or removing keys on the assets runs as a migration job,
+        its progress is reported by GET .../v1/migrations
     """
     data = dict(request.get_json())
     response_details = {}
@@ -199,13 +281,22 @@ def update_asset_type():
         return abell_error(400,
                            'managed_keys, unmanaged_keys and remove_keys '
                            'must by lists')
-    r = abell_asset_type.update_keys(remove_keys, managed_keys, unmanaged_keys)
+    index_update = {}
+    if 'indexed_keys' in data:
+        if type(data.get('indexed_keys')) is not list:
+            return abell_error(400, 'indexed_keys must be a list')
+        index_update['indexed_keys'] = data.get('indexed_keys')
+    r = abell_asset_type.update_keys(remove_keys, managed_keys, unmanaged_keys,
+                                     **index_update)
     if r.get('success'):
         response_details.update({'info': 'Asset %s updated' % asset_type,
                                  'removed_keys': r.get('removed_keys'),
-                                 'new_keys': r.get('new_keys')})
+                                 'new_keys': r.get('new_keys'),
+                                 'new_indexes': r.get('new_indexes'),
+                                 'dropped_indexes': r.get('dropped_indexes'),
+                                 'migration_id': r.get('migration_id')})
         return abell_success(**response_details)
-    return abell_error(500,
+    return abell_error(r.get('error', 500),
                        r.get('message', 'Asset update error'))
 
 
@@ -241,9 +332,127 @@ def delete_asset_type():
                        r.get('message', 'Asset type delete error'))
 
 
+def keyset_page(params, specified_keys, after=None):
+    """Builds the filter and projection for a page of find results.
+
+    Pages are sorted on the unique abell_id index and start right after the
+    given abell_id, so every page costs the same no matter how deep it is.
+    Args:
+        params (dict): Filter from get_query_params
+        specified_keys (dict): Projection from get_query_params
+        after (str): abell_id of the last asset of the previous page
+    Returns:
+        tuple: (filter dict, projection dict)
+    """
+    page_filter = dict(params)
+    if after is not None:
+        if 'abell_id' in page_filter:
+            page_filter = {'$and': [page_filter,
+                                    {'abell_id': {'$gt': after}}]}
+        else:
+            page_filter['abell_id'] = {'$gt': after}
+    page_keys = dict(specified_keys)
+    # an inclusion projection still has to return the cursor key
+    if any(v == 1 for v in page_keys.values()):
+        page_keys['abell_id'] = 1
+    return page_filter, page_keys
+
+
+def encoded_read(operation, limit=0):
+    """Returns the encode hook of a find, count or distinct.
+
+    It encodes the payload of a read once, the query cache keeps the bytes
+    and abell_success splices them into every hit as PreEncoded. A find
+    page is cut to limit first and keeps its next_cursor. Reads that were
+    not cached go through the same hook, it skips encoded responses.
+    Args:
+        operation (str): find, count or distinct
+        limit (int): Page size of a find, 0 when not paged
+    Returns:
+        callable: Takes and returns an AbellDb response dict
+    """
+    def encode_read(db_response):
+        payload = db_response.get('result')
+        if isinstance(payload, responses.PreEncoded):
+            return db_response
+        encoded = dict(db_response)
+        if operation == 'count':
+            payload = {'count': payload}
+        elif operation == 'find' and limit:
+            next_cursor = None
+            if len(payload) > limit:
+                payload = payload[:limit]
+                next_cursor = payload[-1].get('abell_id')
+            encoded['next_cursor'] = next_cursor
+        encoded['result'] = responses.PreEncoded(responses.encode(payload))
+        return encoded
+    return encode_read
+
+
+STREAM_FORMATS = {'application/x-ndjson': 'ndjson',
+                  'application/bson': 'bson',
+                  'application/msgpack': 'msgpack'}
+
+
+def negotiate_format():
+    """Returns json, ndjson, bson or msgpack as asked for by Accept.
+
+    Returns None when the only acceptable format is msgpack and the
+    optional msgpack package is not installed.
+    """
+    offers = ['application/json', 'application/x-ndjson', 'application/bson']
+    if responses.msgpack is not None:
+        offers.append('application/msgpack')
+    best = request.accept_mimetypes.best_match(offers)
+    if best is None and request.accept_mimetypes['application/msgpack']:
+        return None
+    return STREAM_FORMATS.get(best, 'json')
+
+
+def read_etag(operation, asset_type, generation, *query):
+    """Weak ETag of a read from the type generation and the query.
+
+    Returns None when the generation is unknown, such a read is never
+    answered with a 304.
+    """
+    if generation is None:
+        return None
+    key = json.dumps([operation, asset_type, generation, query],
+                     sort_keys=True, default=str)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def not_modified(etag):
+    return etag is not None and request.if_none_match.contains_weak(etag)
+
+
+def tag_response(response, etag):
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    return response
+
+
 @api.route('/v1/asset', methods=['GET'])
 # todo auth
 def find_assets():
+    """Find assets
+
+    Returns every asset matching the filter params. With
+    'Accept: application/x-ndjson' the assets are streamed one per line,
+    application/bson streams the documents as stored without decoding them
+    and application/msgpack streams MessagePack maps. With ?stream=true the
+    usual envelope is streamed instead of being built in memory. Passing
+    limit pages through the results in abell_id order, the next_cursor
+    detail is the after value of the next page. after on its own returns
+    every asset past it in abell_id order. stream, limit, after,
+    specified_keys and distinct_key are options, not filters on keys of
+    those names.
+    Args:
+        takes filter params from arguments
+        EX: GET .../v1/asset?type=server&cloud=dfw&limit=100&after=a99
+    Returns:
+        Response dict: {'code': int, 'payload': list, 'details': dict}
+    """
     response_details = {}
     query_params = get_query_params(request.args)
 
@@ -254,10 +463,64 @@ def find_assets():
         specified_keys = query_params.get('specified_keys')
         response_details.update({'query_params': params})
     asset_type = params.get('type')
+    find_filter = params
+    sort = None
+    limit = query_params.get('limit')
+    after = query_params.get('after')
+    if limit or after is not None:
+        find_filter, specified_keys = keyset_page(params, specified_keys,
+                                                  after)
+        sort = [('abell_id', 1)]
+    response_format = negotiate_format()
+    if response_format is None:
+        return abell_error(406, 'application/msgpack is not available',
+                           **response_details)
+    if response_format == 'json' and query_params.get('stream'):
+        response_format = 'stream'
+    read_preference = asset.routed_reads()
+    generation = None
+    if asset_type and read_preference is None:
+        generation = asset.type_generation(asset_type)
+    etag = read_etag('find', asset_type, generation, find_filter,
+                     specified_keys, sort, limit, response_format)
+    if not_modified(etag):
+        return abell_not_modified(etag)
+    if asset_type and response_format != 'json':
+        db_result = asset.asset_stream(asset_type,
+                                       find_filter,
+                                       specified_keys=specified_keys,
+                                       sort=sort,
+                                       limit=limit,
+                                       raw=response_format == 'bson',
+                                       read_preference=read_preference)
+        if not db_result.get('success'):
+            # DB Error
+            return abell_error(db_result.get('error'),
+                               db_result.get('message'),
+                               **response_details)
+        documents = db_result.get('result')
+        if response_format == 'ndjson':
+            response = abell_ndjson(documents)
+        elif response_format == 'bson':
+            response = abell_bson(documents)
+        elif response_format == 'msgpack':
+            response = abell_msgpack(documents)
+        else:
+            response = abell_stream(documents, **response_details)
+        return tag_response(response, etag)
+
     if asset_type:
+        # one extra asset tells whether there is a next page
+        encode_read = encoded_read('find', limit)
         db_result = asset.asset_find(asset_type,
-                                     params,
-                                     specified_keys=specified_keys)
+                                     find_filter,
+                                     specified_keys=specified_keys,
+                                     sort=sort,
+                                     limit=limit + 1 if limit else 0,
+                                     cache=read_preference is None,
+                                     generation=generation,
+                                     read_preference=read_preference,
+                                     encode=encode_read)
         if not db_result.get('success'):
             # DB Error
             return abell_error(db_result.get('error'),
@@ -265,9 +528,12 @@ def find_assets():
                                **response_details)
         else:
             # Successful find!
-            payload = db_result.get('result')
-            return abell_success(payload=payload,
-                                 **response_details)
+            db_result = encode_read(db_result)
+            if limit:
+                response_details['next_cursor'] = db_result.get(
+                    'next_cursor')
+            return tag_response(abell_success(payload=db_result.get('result'),
+                                              **response_details), etag)
 
     return abell_error(500,
                        'Unknown find error',
@@ -286,8 +552,20 @@ def count_assets():
         response_details.update({'query_params': params})
     asset_type = params.get('type')
     if asset_type:
+        read_preference = asset.routed_reads()
+        generation = None
+        if read_preference is None:
+            generation = asset.type_generation(asset_type)
+        etag = read_etag('count', asset_type, generation, params)
+        if not_modified(etag):
+            return abell_not_modified(etag)
+        encode_read = encoded_read('count')
         db_result = asset.asset_count(asset_type,
-                                      params)
+                                      params,
+                                      cache=read_preference is None,
+                                      generation=generation,
+                                      read_preference=read_preference,
+                                      encode=encode_read)
         if not db_result.get('success'):
             # DB Error
             return abell_error(db_result.get('error'),
@@ -295,9 +573,9 @@ def count_assets():
                                **response_details)
         else:
             # Successful count!
-            payload = {'count': db_result.get('result')}
-            return abell_success(payload=payload,
-                                 **response_details)
+            payload = encode_read(db_result).get('result')
+            return tag_response(abell_success(payload=payload,
+                                              **response_details), etag)
 
     return abell_error(500,
                        'Unknown count error',
@@ -318,9 +596,19 @@ def distinct_fields():
                                  'distinct_key': distinct_key})
     asset_type = params.get('type')
     if asset_type:
-        db_result = asset.distinct_asset_fields(asset_type,
-                                                params,
-                                                distinct_key)
+        read_preference = asset.routed_reads()
+        generation = None
+        if read_preference is None:
+            generation = asset.type_generation(asset_type)
+        etag = read_etag('distinct', asset_type, generation, params,
+                         distinct_key)
+        if not_modified(etag):
+            return abell_not_modified(etag)
+        encode_read = encoded_read('distinct')
+        db_result = asset.distinct_asset_fields(
+            asset_type, params, distinct_key, cache=read_preference is None,
+            generation=generation, read_preference=read_preference,
+            encode=encode_read)
         if not db_result.get('success'):
             # DB Error
             return abell_error(db_result.get('error'),
@@ -328,9 +616,9 @@ def distinct_fields():
                                **response_details)
         else:
             # Successful distinct call!
-            payload = db_result.get('result')
-            return abell_success(payload=payload,
-                                 **response_details)
+            payload = encode_read(db_result).get('result')
+            return tag_response(abell_success(payload=payload,
+                                              **response_details), etag)
 
     return abell_error(500,
                        'Unknown distinct error',
@@ -450,6 +738,8 @@ def create_one_asset():
                                r.get('message', 'Error in asset create'))
         new_keys = r.get('new_keys')
         response_details.update({'new_keys_added': list(new_keys)})
+        if r.get('migration_id'):
+            response_details['migration_id'] = r.get('migration_id')
 
     # Create new asset
     new_asset = asset.AbellAsset(given_asset_type, data.get('abell_id'),
@@ -462,3 +752,174 @@ def create_one_asset():
     return abell_error(r.get('error', 500),
                        r.get('message', 'Unknown create error'),
                        **response_details)
+
+
+@api.route('/v1/assets/bulk', methods=['POST'])
+@validate_json
+# todo auth
+def create_assets_bulk():
+    """Create many assets
+
+    Creates a list of assets of a single type. The type is looked up once
+    and the assets are written in unordered chunks of
+    BULK_INSERT_CHUNK_SIZE, so one bad asset does not fail the rest.
+    Args:
+        Takes a json formatted list of assets from the post.
+        EX:[{'type': 'server', 'abell_id': 'a1', 'owner': 'me',
+             'cloud': 'dfw'}, ...]
+    Returns:
+        Response dict: {'code': int, 'payload': null,
+                        'details': {'created': [abell_id],
+                                    'duplicates': [abell_id],
+                                    'rejected': [{'index': int,
+                                                  'abell_id': str,
+                                                  'message': str}]}}
+    """
+    data = request.get_json()
+    if type(data) is not list or not data:
+        return abell_error(400, 'Bulk create expects a list of assets')
+
+    first_asset = data[0] if type(data[0]) is dict else {}
+    given_asset_type = first_asset.get('type')
+    abell_asset_type = AT.get_asset_type(given_asset_type)
+    if not abell_asset_type:
+        return abell_error(400,
+                           '%s asset type does not exist. Check submitted '
+                           'type or have an admin create it'
+                           % given_asset_type)
+
+    r = asset.insert_assets(abell_asset_type, data,
+                            current_app.config.get('BULK_INSERT_CHUNK_SIZE',
+                                                   1000))
+    if not r.get('success'):
+        return abell_error(500, 'Unknown bulk create error')
+    return abell_success(info='%s of %s assets created'
+                              % (len(r.get('created')), len(data)),
+                         created=r.get('created'),
+                         duplicates=r.get('duplicates'),
+                         rejected=r.get('rejected'))
+
+
+@api.route('/v1/assets/bulk', methods=['PUT'])
+@validate_json
+# todo auth
+def update_assets_bulk():
+    """Update many assets
+
+    Applies a list of filter and update pairs of a single asset type in one
+    unordered bulk write. Each update is limited to the keys the caller may
+    change, like PUT /v1/asset. Each filter updates one asset unless
+    update_multiple_assets=true is passed.
+    Args:
+        Takes a json formatted list of operations from the put.
+        EX:[{'filter': {'type': 'server', 'abell_id': 'a1'},
+             'update': {'patches': '2017-06'}}, ...]
+    Returns:
+        Response dict: {'code': int, 'payload': null,
+                        'details': {'matched': int, 'modified': int,
+                                    'results': [{'index': int,
+                                                 'status': str,
+                                                 'message': str,
+                                                 'updated_keys': dict,
+                                                 'matched': int,
+                                                 'modified': int}]}}
+    """
+    data = request.get_json()
+    if type(data) is not list or not data:
+        return abell_error(400, 'Bulk update expects a list of operations')
+    update_multiple = False
+    if request.args.get('update_multiple_assets', 'false').lower() == 'true':
+        update_multiple = True
+    response = asset.bulk_update_asset_values(data,
+                                              auth_level='admin',
+                                              multi=update_multiple)
+    if response.get('success'):
+        return abell_success(matched=response.get('matched'),
+                             modified=response.get('modified'),
+                             results=response.get('results'))
+    return abell_error(response.get('error', 500),
+                       response.get('message', 'Unknown bulk update error.'))
+
+
+@api.route('/v1/migrations', methods=['GET'])
+@api.route('/v1/migrations/<job_id>', methods=['GET'])
+# todo auth
+def migration_status(job_id=None):
+    """Get migration status
+
+    Returns schema migration jobs, newest first. Stalled jobs are not
+    restarted here, see POST .../v1/migrations/resume.
+    Args:
+        optional type from arguments or a job id in the path
+        EX: GET .../v1/migrations?type=server
+            GET .../v1/migrations/59a1c8f0e1382310a2b5c3d4
+    Returns:
+        Response dict: {'code': int, 'payload': list | dict, 'details': dict}
+    """
+    asset_type = request.args.get('type')
+    r = migration.ABELLDB.get_migrations(asset_type=asset_type,
+                                         job_id=job_id)
+    if not r.get('success'):
+        return abell_error(500, r.get('message', 'Migration lookup error'))
+    jobs = [migration.job_status(job) for job in r.get('result')]
+    if job_id is not None:
+        if not jobs:
+            return abell_error(404, 'Migration %s not found' % job_id)
+        return abell_success(payload=jobs[0])
+    return abell_success(payload=jobs)
+
+
+@api.route('/v1/migrations/resume', methods=['POST'])
+# todo auth
+def resume_migrations():
+    """Resume stalled migrations
+
+    Restarts in the background the unfinished jobs whose runner went away,
+    e.g. a crashed process.
+    Args:
+        optional type from arguments
+        EX: POST .../v1/migrations/resume?type=server
+    Returns:
+        Response dict: {'code': int, 'payload': null,
+                        'details': {'resumed': list}}
+    """
+    asset_type = request.args.get('type')
+    resumed = migration.resume_stalled_migrations(asset_type)
+    return abell_success(resumed=resumed)
+
+
+@api.route('/v1/stats', methods=['GET'])
+# todo auth
+def cache_stats():
+    """Get cache stats
+
+    Returns the hit and miss counters of the process local caches.
+    Returns:
+        Response dict: {'code': int, 'payload': dict, 'details': dict}
+    """
+    payload = {'asset_type_cache': AT.ASSET_TYPE_CACHE.stats(),
+               'query_cache': asset.QUERY_CACHE.stats()}
+    return abell_success(payload=payload)
+
+
+@api.route('/v1/admin/slow_queries', methods=['GET'])
+# todo auth
+def slow_query_report():
+    """Get the slowest query shapes
+
+    Returns the query shapes that took longest in total, per asset type,
+    with their latest explain plan summary.
+    Args:
+        takes optional type and limit from arguments
+        EX: GET .../v1/admin/slow_queries?type=server&limit=5
+    Returns:
+        Response dict: {'code': int, 'payload': dict, 'details': dict}
+    """
+    try:
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        return abell_error(400, 'limit must be a number')
+    payload = slow_queries.SLOW_QUERIES.worst(request.args.get('type'),
+                                              limit)
+    return abell_success(payload=payload,
+                         threshold_ms=slow_queries.SLOW_QUERIES.threshold_ms)
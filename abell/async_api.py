@@ -0,0 +1,376 @@
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags
+from abell import create_app
+from abell.metrics import METRICS, db_error
+from abell.api.responses import abell_error, abell_success, encode
+from abell.api.v1_controller import (encoded_read, get_query_params,
+                                     keyset_page, read_etag, validate_data)
+from abell.database.async_db import AsyncAbellDb
+from abell.models import asset
+from abell.models import asset_type as AT
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+
+ASYNC_DB = AsyncAbellDb()
+
+# werkzeug sets these itself, aiohttp must work them out for its own body
+SKIPPED_HEADERS = ('Content-Type', 'Content-Length')
+
+
+def to_aiohttp(response):
+    """Turns a Response from the abell_* helpers into an aiohttp one."""
+    web_response = web.Response(body=response.get_data(),
+                                status=response.status_code,
+                                content_type=response.mimetype)
+    for name, value in response.headers.items():
+        if name not in SKIPPED_HEADERS:
+            web_response.headers[name] = value
+    return web_response
+
+
+def not_modified(request, etag):
+    if etag is None:
+        return False
+    return parse_etags(request.headers.get('If-None-Match')).contains_weak(
+        etag)
+
+
+def tagged(request, response, etag):
+    """aiohttp response with the ETag set, compressed like the sync API."""
+    web_response = to_aiohttp(response)
+    if etag is not None:
+        web_response.headers['ETag'] = 'W/"%s"' % etag
+    config = request.app['flask_app'].config
+    if (config.get('COMPRESSION_ENABLED') and
+            web_response.content_length >=
+            config.get('COMPRESSION_MIN_SIZE', 1024)):
+        web_response.enable_compression()
+    return web_response
+
+
+def not_modified_response(etag):
+    return web.Response(status=304, headers={'ETag': 'W/"%s"' % etag})
+
+
+def wants_ndjson(request):
+    accept = parse_accept_header(request.headers.get('Accept'), MIMEAccept)
+    best = accept.best_match(['application/json', 'application/x-ndjson'])
+    return best == 'application/x-ndjson'
+
+
+async def generation_of(asset_type):
+    db_response = await ASYNC_DB.get_generation(asset_type)
+    return db_response.get('result')
+
+
+async def get_asset_type(asset_type, generation=None):
+    # The generation read by every request carries the schema version, so
+    # the shared cache is checked against it instead of sync_versions
+    cached = AT.ASSET_TYPE_CACHE.get(asset_type)
+    if cached and (generation is None or cached.version == generation[-1]):
+        return cached.copy()
+    db_response = await ASYNC_DB.get_asset_type_info(asset_type)
+    asset_info = db_response.get('result')
+    if not asset_info:
+        return None
+    abell_asset_type = AT.AbellAssetType(asset_type, asset_info=asset_info)
+    AT.ASSET_TYPE_CACHE.set(asset_type, abell_asset_type)
+    return abell_asset_type.copy()
+
+
+async def cached_query(operation, asset_type, query, run_query, generation,
+                       encode):
+    # async twin of asset.cached_query, same keys, QUERY_CACHE and entries
+    if generation is None:
+        return await run_query()
+    key = asset.query_cache_key(operation, asset_type, generation, query)
+    cached = asset.QUERY_CACHE.get(key)
+    if cached is not None:
+        return dict(cached)
+    return asset.cache_response(key, await run_query(), encode)
+
+
+async def asset_find(asset_type, params, specified_keys, sort, limit,
+                     generation, encode):
+    ato = await get_asset_type(asset_type, generation)
+    sparse = ato if ato and ato.sparse else None
+
+    async def run_query():
+        if not sparse:
+            return await ASYNC_DB.asset_find(asset_type, params,
+                                             specified_keys, sort, limit)
+        db_response = await ASYNC_DB.asset_find(
+            asset_type, asset.sparse_filter(params), specified_keys, sort,
+            limit)
+        if db_response.get('success'):
+            db_response['result'] = [
+                sparse.fill_defaults(document, specified_keys)
+                for document in db_response.get('result')]
+        return db_response
+    return await cached_query('find', asset_type,
+                              (params, specified_keys, sort, limit),
+                              run_query, generation, encode)
+
+
+async def stream_assets(request, asset_type, params, specified_keys, sort,
+                        limit, generation, etag, response_details):
+    """Writes the find results as NDJSON or the streamed envelope."""
+    ato = await get_asset_type(asset_type, generation)
+    sparse = ato if ato and ato.sparse else None
+    db_result = ASYNC_DB.asset_cursor(
+        asset_type, asset.sparse_filter(params) if sparse else params,
+        specified_keys, sort, limit)
+    if not db_result.get('success'):
+        return to_aiohttp(abell_error(db_result.get('error'),
+                                      db_result.get('message'),
+                                      **response_details))
+    ndjson = wants_ndjson(request)
+    response = web.StreamResponse(status=200)
+    response.content_type = ('application/x-ndjson' if ndjson
+                             else 'application/json')
+    if etag is not None:
+        response.headers['ETag'] = 'W/"%s"' % etag
+    if request.app['flask_app'].config.get('COMPRESSION_ENABLED'):
+        response.enable_compression()
+    await response.prepare(request)
+    if not ndjson:
+        await response.write(b'{"code": 200, "payload": [')
+    separator = b''
+    try:
+        async for document in db_result.get('result'):
+            if sparse:
+                document = sparse.fill_defaults(document, specified_keys)
+            if ndjson:
+                await response.write(encode(document) + b'\n')
+            else:
+                await response.write(separator + encode(document))
+                separator = b', '
+    except Exception as e:
+        # the status is already sent, the envelope reports the error
+        db_error('stream_assets', e)
+        response_details['error'] = ('Stream interrupted, payload is '
+                                     'incomplete')
+    if not ndjson:
+        await response.write(b'], "details": ' + encode(response_details) +
+                             b'}')
+    await response.write_eof()
+    return response
+
+
+async def find_assets(request):
+    """GET /api/v1/asset, same arguments and answers as the sync route.
+
+    JSON and NDJSON only, the bson and msgpack formats are served by the
+    sync API.
+    """
+    response_details = {}
+    query_params = get_query_params(request.query)
+    if not query_params.get('success'):
+        return to_aiohttp(query_params['error'])
+    params = query_params.get('params')
+    specified_keys = query_params.get('specified_keys')
+    response_details.update({'query_params': params})
+    asset_type = params.get('type')
+    if not asset_type:
+        return to_aiohttp(abell_error(500, 'Unknown find error',
+                                      submission=response_details))
+    find_filter = params
+    sort = None
+    limit = query_params.get('limit')
+    after = query_params.get('after')
+    if limit or after is not None:
+        find_filter, specified_keys = keyset_page(params, specified_keys,
+                                                  after)
+        sort = [('abell_id', 1)]
+    response_format = 'ndjson' if wants_ndjson(request) else 'json'
+    if response_format == 'json' and query_params.get('stream'):
+        response_format = 'stream'
+    generation = await generation_of(asset_type)
+    etag = read_etag('find', asset_type, generation, find_filter,
+                     specified_keys, sort, limit, response_format)
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+    if response_format != 'json':
+        return await stream_assets(request, asset_type, find_filter,
+                                   specified_keys, sort, limit, generation,
+                                   etag, response_details)
+
+    encode_read = encoded_read('find', limit)
+    db_result = await asset_find(asset_type, find_filter, specified_keys,
+                                 sort, limit + 1 if limit else 0, generation,
+                                 encode_read)
+    if not db_result.get('success'):
+        return to_aiohttp(abell_error(db_result.get('error'),
+                                      db_result.get('message'),
+                                      **response_details))
+    db_result = encode_read(db_result)
+    if limit:
+        response_details['next_cursor'] = db_result.get('next_cursor')
+    return tagged(request, abell_success(payload=db_result.get('result'),
+                                         **response_details),
+                  etag)
+
+
+async def count_assets(request):
+    response_details = {}
+    query_params = get_query_params(request.query)
+    if not query_params.get('success'):
+        return to_aiohttp(query_params['error'])
+    params = query_params.get('params')
+    response_details.update({'query_params': params})
+    asset_type = params.get('type')
+    if not asset_type:
+        return to_aiohttp(abell_error(500, 'Unknown count error',
+                                      submission=response_details))
+    generation = await generation_of(asset_type)
+    etag = read_etag('count', asset_type, generation, params)
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+    ato = await get_asset_type(asset_type, generation)
+
+    async def run_query():
+        if ato and ato.sparse:
+            return await ASYNC_DB.asset_count(asset_type,
+                                              asset.sparse_filter(params))
+        return await ASYNC_DB.asset_count(asset_type, params)
+    encode_read = encoded_read('count')
+    db_result = await cached_query('count', asset_type, (params,), run_query,
+                                   generation, encode_read)
+    if not db_result.get('success'):
+        return to_aiohttp(abell_error(db_result.get('error'),
+                                      db_result.get('message'),
+                                      **response_details))
+    return tagged(request,
+                  abell_success(payload=encode_read(db_result).get('result'),
+                                **response_details),
+                  etag)
+
+
+async def distinct_fields(request):
+    response_details = {}
+    query_params = get_query_params(request.query)
+    if not query_params.get('success'):
+        return to_aiohttp(query_params['error'])
+    params = query_params.get('params')
+    distinct_key = str(query_params.get('distinct_key'))
+    response_details.update({'query_params': params,
+                             'distinct_key': query_params.get(
+                                 'distinct_key')})
+    asset_type = params.get('type')
+    if not asset_type:
+        return to_aiohttp(abell_error(500, 'Unknown distinct error',
+                                      submission=response_details))
+    generation = await generation_of(asset_type)
+    etag = read_etag('distinct', asset_type, generation, params,
+                     query_params.get('distinct_key'))
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+    ato = await get_asset_type(asset_type, generation)
+
+    async def run_query():
+        if not (ato and ato.sparse):
+            return await ASYNC_DB.asset_distinct(asset_type, params,
+                                                 distinct_key)
+        query_filter = asset.sparse_filter(params)
+        db_response = await ASYNC_DB.asset_distinct(asset_type, query_filter,
+                                                    distinct_key)
+        values = db_response.get('result')
+        if (not db_response.get('success') or 'None' in values or
+                distinct_key.split('.')[0] not in ato.all_keys()):
+            return db_response
+        # assets without the key read back as 'None'
+        missing = await ASYNC_DB.asset_find(
+            asset_type,
+            {'$and': [query_filter, {distinct_key: {'$exists': False}}]},
+            {'_id': 1}, limit=1)
+        if not missing.get('success'):
+            return missing
+        if missing.get('result'):
+            db_response['result'] = values + ['None']
+        return db_response
+    encode_read = encoded_read('distinct')
+    db_result = await cached_query('distinct', asset_type,
+                                   (params, distinct_key), run_query,
+                                   generation, encode_read)
+    if not db_result.get('success'):
+        return to_aiohttp(abell_error(db_result.get('error'),
+                                      db_result.get('message'),
+                                      **response_details))
+    return tagged(request,
+                  abell_success(payload=encode_read(db_result).get('result'),
+                                **response_details),
+                  etag)
+
+
+async def return_asset_info(request):
+    validate_response = validate_data('asset_info', request.query, ['type'])
+    if not validate_response.get('success'):
+        return to_aiohttp(validate_response.get('error'))
+    asset_type = request.query.get('type')
+    generation = await generation_of(asset_type)
+    etag = None
+    if generation is not None:
+        etag = read_etag('asset_type', asset_type,
+                         (generation[0], generation[-1]))
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+    ato = await get_asset_type(asset_type, generation)
+    if not ato:
+        return to_aiohttp(abell_error(404,
+                                      '%s asset type not found' % asset_type))
+    # index builds are tracked by the sync API, only the keys are served
+    return tagged(request, abell_success(payload=ato.key_dict()), etag)
+
+
+async def metrics_view(request):
+    # only the AbellDb error counts, requests are not timed here
+    return web.Response(text=METRICS.render(),
+                        content_type='text/plain')
+
+
+async def start_db(app):
+    ASYNC_DB.init_app(app['flask_app'].config,
+                      **app['client_options'])
+
+
+async def close_db(app):
+    await ASYNC_DB.close()
+
+
+def create_async_app(config, **client_options):
+    """aiohttp application serving the /api/v1 read routes.
+
+    The Flask app is created only for its config and the caches it sets
+    up, every query goes through ASYNC_DB. client_options are passed to
+    the async MongoClient, created once the event loop runs.
+    """
+    if web is None:
+        raise RuntimeError('The async API needs aiohttp, pip install aiohttp')
+    app = web.Application()
+    app['flask_app'] = create_app(config)
+    app['client_options'] = client_options
+    app.on_startup.append(start_db)
+    app.on_cleanup.append(close_db)
+    app.router.add_get('/api/v1/asset', find_assets)
+    app.router.add_get('/api/v1/asset/count', count_assets)
+    app.router.add_get('/api/v1/asset/distinct', distinct_fields)
+    app.router.add_get('/api/v1/asset_type', return_asset_info)
+    app.router.add_get('/metrics', metrics_view)
+    return app
+
+
+def serve_async(config, host='0.0.0.0', port=6001, max_pool_size=None):
+    """Runs the async read API, a single process and event loop.
+
+    The pool is not sized per thread as with serve, queries wait for a
+    free connection instead, so it can be kept small while thousands of
+    requests are in flight.
+    """
+    client_options = {}
+    if max_pool_size:
+        client_options['maxPoolSize'] = max_pool_size
+    web.run_app(create_async_app(config, **client_options), host=host,
+                port=port)
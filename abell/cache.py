@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread safe LRU cache with an optional time to live.
+
+    Entries older than ttl seconds are treated as misses and dropped. Once
+    maxsize entries are stored the least recently used entry is evicted.
+    Hit, miss and eviction counters are kept for stats().
+    """
+
+    def __init__(self, maxsize=256, ttl=None, config_prefix=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.config_prefix = config_prefix
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def init_app(self, app):
+        # Reads <PREFIX>_SIZE and <PREFIX>_TTL from the app config
+        if self.config_prefix:
+            self.maxsize = app.config.get('%s_SIZE' % self.config_prefix,
+                                          self.maxsize)
+            self.ttl = app.config.get('%s_TTL' % self.config_prefix,
+                                      self.ttl)
+        self.clear()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, stored_at = entry
+            if self.ttl and time.time() - stored_at > self.ttl:
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key):
+        # Returns the cached value without touching stats or LRU order
+        with self._lock:
+            entry = self._data.get(key)
+            return entry[0] if entry else None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._data),
+                    'maxsize': self.maxsize,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': (float(self.hits) / lookups
+                                 if lookups else 0.0)}
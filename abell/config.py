@@ -10,6 +10,101 @@ class base_config(object):
     MONGO_DBNAME = os.environ.get('MONGO_DBNAME', 'abell')
     MONGO_USERNAME = os.environ.get('MONGO_USERNAME', 'abell')
     MONGO_PASSWORD = os.environ.get('MONGO_PASSWORD', '123456')
+    # MONGO_HOST may list several hosts, comma separated, for a replica set
+    MONGO_REPLICA_SET = os.environ.get('MONGO_REPLICA_SET')
+    # Connections per process, None for the driver default. manage.py serve
+    # sets the max from the thread count when unset
+    MONGO_MIN_POOL_SIZE = None
+    MONGO_MAX_POOL_SIZE = None
+    # Milliseconds a request waits for a free connection, and for a server
+    # to become available, None for the driver defaults
+    MONGO_WAIT_QUEUE_TIMEOUT_MS = None
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = None
+
+    # Where find, count and distinct requests read from: primary,
+    # primaryPreferred, secondary, secondaryPreferred or nearest. Writes and
+    # reads done as part of a write always use the primary. Secondaries
+    # more than READ_MAX_STALENESS seconds behind (90 at least) are not
+    # used, None for no bound. Reads off the primary skip the query cache
+    # and ETags
+    READ_PREFERENCE = 'primary'
+    READ_MAX_STALENESS = None
+
+    # manage.py serve, None workers means 2 per cpu + 1
+    SERVE_BIND = '0.0.0.0:6000'
+    SERVE_WORKERS = None
+    SERVE_THREADS = 8
+    SERVE_TIMEOUT = 60
+
+    # Asset type cache, size in entries and times in seconds
+    ASSET_TYPE_CACHE_SIZE = 256
+    ASSET_TYPE_CACHE_TTL = 300
+    ASSET_TYPE_CACHE_CHECK_INTERVAL = 1
+
+    # find, count and distinct result cache. Results with more than
+    # QUERY_CACHE_MAX_RESULTS entries are not cached, a size of 0 disables it
+    QUERY_CACHE_SIZE = 1024
+    QUERY_CACHE_TTL = 300
+    QUERY_CACHE_MAX_RESULTS = 1000
+
+    # Build and drop secondary indexes outside of the request
+    INDEX_BUILD_BACKGROUND = True
+
+    # Assets per insert_many call of POST /v1/assets/bulk
+    BULK_INSERT_CHUNK_SIZE = 1000
+
+    # Multi asset updates and deletes are written this many assets at a
+    # time, in _id order
+    MULTI_WRITE_BATCH_SIZE = 1000
+
+    # Schema migrations after key changes. Chunks are in assets, the rate
+    # limit in assets per second (0 for none) and the lease in seconds
+    MIGRATION_BACKGROUND = True
+    MIGRATION_CHUNK_SIZE = 500
+    MIGRATION_RATE_LIMIT = 2000
+    MIGRATION_LEASE = 60
+
+    # New asset types only store the keys set on each asset
+    SPARSE_STORAGE_DEFAULT = False
+
+    # Response encoder: auto, orjson, ujson or json. auto picks the
+    # fastest one installed
+    JSON_ENCODER = 'auto'
+
+    # gzip or deflate API responses, as negotiated from Accept-Encoding.
+    # Buffered responses under COMPRESSION_MIN_SIZE bytes are sent as is,
+    # streamed responses are always compressed. Level is 1 (fast) to 9.
+    # Streams are flushed after at most COMPRESSION_FLUSH_SIZE bytes
+    COMPRESSION_ENABLED = True
+    COMPRESSION_MIN_SIZE = 1024
+    COMPRESSION_LEVEL = 6
+    COMPRESSION_FLUSH_SIZE = 16384
+
+    # Assets per cursor batch of GET /v1/asset_type/<type>/export
+    EXPORT_BATCH_SIZE = 1000
+
+    # Per route latency histograms, the Server-Timing header and /metrics
+    METRICS_ENABLED = True
+
+    # find, count and distinct calls over SLOW_QUERY_MS are logged and
+    # kept by query shape, 0 disables it. Each shape is explained at most
+    # once every SLOW_QUERY_EXPLAIN_INTERVAL seconds, outside of the
+    # request. Up to SLOW_QUERY_LOG_SIZE shapes are kept
+    SLOW_QUERY_MS = 100
+    SLOW_QUERY_EXPLAIN_INTERVAL = 60
+    SLOW_QUERY_EXPLAIN_BACKGROUND = True
+    SLOW_QUERY_LOG_SIZE = 500
+
+    # cProfile requests that send PROFILING_TOKEN in the X-Abell-Profile
+    # header, and one of every PROFILING_SAMPLE_RATE requests (0 for none).
+    # Stats go to PROFILING_DIR, PROFILING_TRACEMALLOC also saves the
+    # PROFILING_TOP_ALLOCATIONS biggest allocation differences
+    PROFILING_ENABLED = False
+    PROFILING_TOKEN = os.environ.get('ABELL_PROFILING_TOKEN')
+    PROFILING_SAMPLE_RATE = 0
+    PROFILING_DIR = 'profiles'
+    PROFILING_TRACEMALLOC = False
+    PROFILING_TOP_ALLOCATIONS = 25
 
 
 class dev_config(base_config):
@@ -27,3 +122,10 @@ class test_config(base_config):
     MONGO_DBNAME = os.environ.get('MONGO_DBNAME', 'abell')
     MONGO_USERNAME = os.environ.get('MONGO_USERNAME', 'abell')
     MONGO_PASSWORD = os.environ.get('MONGO_PASSWORD', '123456')
+
+    # Always check asset type versions so tests never see a stale type
+    ASSET_TYPE_CACHE_CHECK_INTERVAL = 0
+    INDEX_BUILD_BACKGROUND = False
+    MIGRATION_BACKGROUND = False
+    SLOW_QUERY_EXPLAIN_BACKGROUND = False
+    MIGRATION_RATE_LIMIT = 0
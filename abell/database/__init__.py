@@ -1,9 +1,84 @@
+import itertools
+import time
+from urllib.parse import quote_plus, urlencode
+from bson import ObjectId
+from bson.codec_options import CodecOptions
+from bson.errors import InvalidId
+from bson.raw_bson import RawBSONDocument
+from bson.son import SON
 from flask_pymongo import PyMongo
+from pymongo import ASCENDING, DESCENDING, ReadPreference, ReturnDocument, \
+    UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, ConfigurationError, \
+    InvalidOperation, OperationFailure
+try:
+    from pymongo.errors import ClientBulkWriteException
+except ImportError:
+    ClientBulkWriteException = None
+from pymongo.read_preferences import Nearest, PrimaryPreferred, Secondary, \
+    SecondaryPreferred
+from abell import metrics, slow_queries
 
 mongo = PyMongo()
 
+# Filters per aggregate in asset_ids_per_filter, each is one $unionWith
+# stage and pipelines are limited to 1000 stages
+UNION_BATCH_SIZE = 250
 
+# URI option and config key of the pool and replica set settings
+URI_OPTIONS = [('replicaSet', 'MONGO_REPLICA_SET'),
+               ('minPoolSize', 'MONGO_MIN_POOL_SIZE'),
+               ('maxPoolSize', 'MONGO_MAX_POOL_SIZE'),
+               ('waitQueueTimeoutMS', 'MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+               ('serverSelectionTimeoutMS',
+                'MONGO_SERVER_SELECTION_TIMEOUT_MS')]
+
+READ_PREFERENCES = {'primaryPreferred': PrimaryPreferred,
+                    'secondary': Secondary,
+                    'secondaryPreferred': SecondaryPreferred,
+                    'nearest': Nearest}
+
+
+def mongo_uri(config, max_pool_size=None):
+    """Builds the MongoDB URI from the MONGO_* settings.
+
+    max_pool_size overrides MONGO_MAX_POOL_SIZE, connections per process.
+    """
+    port = config.get('MONGO_PORT')
+    hosts = ','.join(host if ':' in host else '%s:%s' % (host, port)
+                     for host in str(config.get('MONGO_HOST')).split(','))
+    uri = 'mongodb://%s:%s@%s/%s' % (
+        quote_plus(str(config.get('MONGO_USERNAME'))),
+        quote_plus(str(config.get('MONGO_PASSWORD'))),
+        hosts, config.get('MONGO_DBNAME'))
+    options = {}
+    for option, key in URI_OPTIONS:
+        if config.get(key):
+            options[option] = config.get(key)
+    if max_pool_size:
+        options['maxPoolSize'] = max_pool_size
+    if options:
+        uri += '?' + urlencode(sorted(options.items()))
+    return uri
+
+
+def read_preference(config):
+    """ReadPreference of the find, count and distinct endpoints."""
+    mode = config.get('READ_PREFERENCE') or 'primary'
+    if mode == 'primary':
+        return ReadPreference.PRIMARY
+    if mode not in READ_PREFERENCES:
+        raise ValueError('Unknown READ_PREFERENCE %s' % mode)
+    return READ_PREFERENCES[mode](
+        max_staleness=config.get('READ_MAX_STALENESS') or -1)
+
+
+@metrics.instrument
 class AbellDb(object):
+    # MongoClient.bulk_write, per operation counts, needs PyMongo 4.9 and
+    # MongoDB 8.0, turned off the first time the server refuses it
+    client_bulk_write = ClientBulkWriteException is not None
+
     def get_asset_type_info(self, asset_type):
         response_dict = {'success': False}
         try:
@@ -15,23 +90,88 @@ class AbellDb(object):
             response_dict.update(
                 {'error': 500,
                  'message': 'Unknown db error, contact admin'})
-            # (TODO) log error
-            print(e)
+            metrics.db_error('get_asset_type_info', e)
             return response_dict
         return response_dict
 
+    def get_asset_types(self, limit=0):
+        response_dict = {'success': False}
+        try:
+            result = mongo.db.assetinfo.find({}, {'_id': False}).limit(limit)
+            response_dict.update({'success': True,
+                                  'result': list(result)})
+        except Exception as e:
+            response_dict.update(
+                {'error': 500,
+                 'message': 'Unknown db error, contact admin'})
+            metrics.db_error('get_asset_types', e)
+        return response_dict
+
+    def get_asset_type_versions(self, asset_types):
+        # returns {type: version} for the given types, missing types are
+        # left out of the result
+        response_dict = {'success': False}
+        try:
+            result = mongo.db.assetinfo.find({'type': {'$in': asset_types}},
+                                             {'_id': False,
+                                              'type': True,
+                                              'version': True})
+            versions = dict((r.get('type'), r.get('version', 0))
+                            for r in result)
+            response_dict.update({'success': True,
+                                  'result': versions})
+        except Exception as e:
+            response_dict.update(
+                {'error': 500,
+                 'message': 'Unknown db error, contact admin'})
+            metrics.db_error('get_asset_type_versions', e)
+        return response_dict
+
+    def get_generation(self, asset_type):
+        # result is a (type document id, write generation, schema version)
+        # tuple, or None when the type does not exist. The document id keeps
+        # a recreated type from reusing generations of the old one.
+        response_dict = {'success': False}
+        try:
+            asset_info = mongo.db.assetinfo.find_one({'type': asset_type},
+                                                     {'generation': True,
+                                                      'version': True})
+            generation = None
+            if asset_info:
+                generation = (str(asset_info.get('_id')),
+                              asset_info.get('generation', 0),
+                              asset_info.get('version', 0))
+            response_dict.update({'success': True,
+                                  'result': generation})
+        except Exception as e:
+            response_dict.update(
+                {'error': 500,
+                 'message': 'Unknown db error, contact admin'})
+            metrics.db_error('get_generation', e)
+        return response_dict
+
+    def bump_generation(self, asset_type):
+        # called after every write to the assets of a type. Bumping after
+        # the write means a result read before the write can never be
+        # cached under the new generation.
+        try:
+            mongo.db.assetinfo.update_one({'type': asset_type},
+                                          {'$inc': {'generation': 1}})
+        except Exception as e:
+            metrics.db_error('bump_generation', e)
+
     def update_managed_vars(self, asset_type, update_dict):
         response_dict = {'success': False}
         try:
             mongo.db.assetinfo.update_one({'type': asset_type},
-                                          {'$set': update_dict})
+                                          {'$set': update_dict,
+                                           '$inc': {'version': 1}})
             response_dict.update({'success': True})
         except Exception as e:
             response_dict.update(
                 {'error': 500,
                  'message': 'Error in managed keys update, contact admin'})
-            # (TODO) log error
-            print(e)
+            metrics.db_error('update_managed_vars', e)
             return response_dict
         return response_dict
 
@@ -40,14 +180,14 @@ class AbellDb(object):
         asset_type = update_dict.get('type')
         try:
             mongo.db.assetinfo.update_one({'type': asset_type},
-                                          {'$set': update_dict})
+                                          {'$set': update_dict,
+                                           '$inc': {'version': 1}})
             response_dict.update({'success': True})
         except Exception as e:
             response_dict.update(
                 {'error': 500,
                  'message': 'Error in managed keys update, contact admin'})
-            # (TODO) log error
-            print(e)
+            metrics.db_error('update_asset_type', e)
             return response_dict
         return response_dict
 
@@ -61,9 +201,76 @@ class AbellDb(object):
             response_dict.update({'success': True})
             return response_dict
         except Exception as e:
-            print(e)
+            metrics.db_error('add_new_asset_type', e)
             return response_dict
 
+    def create_asset_index(self, asset_type, keys, name):
+        response_dict = {'success': False}
+        try:
+            mongo.db[asset_type].create_index([(k, 1) for k in keys],
+                                              name=name,
+                                              background=True)
+            response_dict.update({'success': True})
+        except Exception as e:
+            response_dict.update(
+                {'error': 500,
+                 'message': 'Index build error: %s' % e})
+            metrics.db_error('create_asset_index', e)
+        return response_dict
+
+    def drop_asset_index(self, asset_type, name):
+        response_dict = {'success': False}
+        try:
+            mongo.db[asset_type].drop_index(name)
+            response_dict.update({'success': True})
+        except Exception as e:
+            if 'index not found' in str(e):
+                response_dict.update({'success': True})
+                return response_dict
+            response_dict.update(
+                {'error': 500,
+                 'message': 'Index drop error: %s' % e})
+            metrics.db_error('drop_asset_index', e)
+        return response_dict
+
+    def set_index_status(self, asset_type, name, state, message=None):
+        # a state of None removes the index from the status map
+        response_dict = {'success': False}
+        field = 'index_status.%s' % name
+        if state is None:
+            update = {'$unset': {field: ''}}
+        else:
+            update = {'$set': {field: state if not message
+                               else '%s: %s' % (state, message)}}
+        # index states are part of the type info, clients polling it with
+        # If-None-Match see a new version
+        update['$inc'] = {'version': 1}
+        try:
+            mongo.db.assetinfo.update_one({'type': asset_type}, update)
+            response_dict.update({'success': True})
+        except Exception as e:
+            response_dict.update(
+                {'error': 500,
+                 'message': 'Unknown db error, contact admin'})
+            metrics.db_error('set_index_status', e)
+        return response_dict
+
+    def get_index_status(self, asset_type):
+        response_dict = {'success': False}
+        try:
+            asset_info = mongo.db.assetinfo.find_one({'type': asset_type},
+                                                     {'_id': False,
+                                                      'index_status': True})
+            response_dict.update(
+                {'success': True,
+                 'result': (asset_info or {}).get('index_status', {})})
+        except Exception as e:
+            response_dict.update(
+                {'error': 500,
+                 'message': 'Unknown db error, contact admin'})
+            metrics.db_error('get_index_status', e)
+        return response_dict
+
     def add_new_key_all_assets(self, asset_type, new_vars):
         # adds new field to all assets of a given type
         response_dict = {'success': False}
@@ -83,8 +290,9 @@ class AbellDb(object):
             response_dict.update(
                 {'error': 500,
                  'message': 'Unknown db error, contact admin'})
-            # (TODO) log error
-            print(e)
+            metrics.db_error('add_new_key_all_assets', e)
+        finally:
+            self.bump_generation(asset_type)
         return response_dict
 
     def delete_key_all_assets(self, asset_type, remove_keys):
@@ -105,8 +313,127 @@ class AbellDb(object):
             response_dict.update(
                 {'error': 500,
                  'message': 'Unknown db error, contact admin'})
-            # (TODO) log error
-            print(e)
+            metrics.db_error('delete_key_all_assets', e)
+        finally:
+            self.bump_generation(asset_type)
+        return response_dict
+
+    def add_migration(self, job):
+        response_dict = {'success': False}
+        try:
+            resp = mongo.db.migrations.insert_one(job)
+            response_dict.update({'success': True,
+                                  'result': str(resp.inserted_id)})
+        except Exception as e:
+            response_dict.update(
+                {'error': 500,
+                 'message': 'Unknown db error, contact admin'})
+            metrics.db_error('add_migration', e)
+        return response_dict
+
+    def claim_migration(self, asset_type, owner, lease):
+        # claims the oldest unfinished job of a type unless another runner
+        # holds its lease. result is the job or None.
+        response_dict = {'success': False, 'result': None}
+        try:
+            job = mongo.db.migrations.find_one(
+                {'type': asset_type, 'state': {'$in': ['pending', 'running']}},
+                sort=[('created_at', ASCENDING), ('_id', ASCENDING)])
+            if job:
+                now = time.time()
+                job = mongo.db.migrations.find_one_and_update(
+                    {'_id': job.get('_id'), 'lease_until': {'$lt': now}},
+                    {'$set': {'state': 'running',
+                              'owner': owner,
+                              'lease_until': now + lease,
+                              'updated_at': now}},
+                    return_document=ReturnDocument.AFTER)
+            response_dict.update({'success': True, 'result': job})
+        except Exception as e:
+            response_dict.update(
+                {'error': 500,
+                 'message': 'Unknown db error, contact admin'})
+            metrics.db_error('claim_migration', e)
+        return response_dict
+
+    def update_migration(self, job_id, owner, update_dict):
+        # result is False when the job is no longer owned by owner
+        response_dict = {'success': False, 'result': False}
+        update_dict['updated_at'] = time.time()
+        try:
+            resp = mongo.db.migrations.update_one({'_id': job_id,
+                                                   'owner': owner},
+                                                  {'$set': update_dict})
+            response_dict.update({'success': True,
+                                  'result': resp.matched_count == 1})
+        except Exception as e:
+            response_dict.update(
+                {'error': 500,
+                 'message': 'Unknown db error, contact admin'})
+            metrics.db_error('update_migration', e)
+        return response_dict
+
+    def get_migrations(self, asset_type=None, job_id=None, unfinished=False,
+                       limit=50):
+        # newest first
+        response_dict = {'success': False, 'result': None}
+        query = {}
+        try:
+            if job_id is not None:
+                query['_id'] = ObjectId(job_id)
+        except (InvalidId, TypeError):
+            response_dict.update({'success': True, 'result': []})
+            return response_dict
+        if asset_type:
+            query['type'] = asset_type
+        if unfinished:
+            query['state'] = {'$in': ['pending', 'running']}
+        try:
+            result = mongo.db.migrations.find(query).sort(
+                        [('created_at', DESCENDING)]).limit(limit)
+            response_dict.update({'success': True, 'result': list(result)})
+        except Exception as e:
+            response_dict.update(
+                {'error': 500,
+                 'message': 'Unknown db error, contact admin'})
+            metrics.db_error('get_migrations', e)
+        return response_dict
+
+    def asset_id_chunk(self, asset_type, last_id, limit):
+        # next chunk of _ids in _id order, walks the default _id index
+        response_dict = {'success': False, 'result': None}
+        query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+        try:
+            result = mongo.db[asset_type].find(query, {'_id': True}).sort(
+                        '_id', ASCENDING).limit(limit)
+            response_dict.update({'success': True,
+                                  'result': [r.get('_id') for r in result]})
+        except Exception as e:
+            response_dict.update({'error': 500,
+                                  'message': 'DB Find Error'})
+            metrics.db_error('asset_id_chunk', e)
+        return response_dict
+
+    def migrate_assets(self, asset_type, ids, new_keys, removed_keys):
+        # new keys are only set on assets that do not have them yet, an
+        # asset written since the key was added keeps its value
+        response_dict = {'success': False}
+        try:
+            for key in new_keys:
+                mongo.db[asset_type].update_many(
+                    {'_id': {'$in': ids}, key: {'$exists': False}},
+                    {'$set': {key: 'None'}})
+            if removed_keys:
+                mongo.db[asset_type].update_many(
+                    {'_id': {'$in': ids}},
+                    {'$unset': dict((k, '') for k in removed_keys)})
+            response_dict.update({'success': True})
+        except Exception as e:
+            response_dict.update({'error': 500,
+                                  'message': 'DB migration error: %s' % e})
+            metrics.db_error('migrate_assets', e)
+        finally:
+            self.bump_generation(asset_type)
         return response_dict
 
     def add_new_asset(self, payload):
@@ -137,96 +464,552 @@ class AbellDb(object):
                     {'error': 500,
                      'message': 'Unknown db, contact admin'})
             return response_dict
+        finally:
+            self.bump_generation(asset_type)
 
-    def asset_find(self, asset_type, asset_filter, specified_keys=None):
+    def add_new_assets(self, asset_type, payloads):
+        # unordered insert_many, one bad document does not stop the rest.
+        # duplicates and errors are keyed on the position in payloads.
+        response_dict = {'success': False,
+                         'duplicates': [],
+                         'errors': {}}
+        try:
+            mongo.db[asset_type].insert_many(payloads, ordered=False)
+            response_dict['success'] = True
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') == 11000:
+                    response_dict['duplicates'].append(error.get('index'))
+                else:
+                    response_dict['errors'][error.get('index')] = \
+                        error.get('errmsg')
+            response_dict['success'] = True
+        except Exception as e:
+            metrics.db_error('add_new_assets', e)
+            response_dict.update(
+                {'error': 500,
+                 'message': 'Unknown db, contact admin'})
+        finally:
+            self.bump_generation(asset_type)
+        return response_dict
+
+    def read_collection(self, asset_type, read_preference=None):
+        # reads go to the primary unless given another ReadPreference
+        collection = mongo.db[asset_type]
+        if read_preference is not None:
+            collection = collection.with_options(
+                read_preference=read_preference)
+        return collection
+
+    def asset_cursor(self, asset_type, asset_filter, specified_keys=None,
+                     sort=None, limit=0, raw=False, read_preference=None):
+        # returns the cursor itself so callers can stream the results. A raw
+        # cursor yields RawBSONDocuments, left undecoded until accessed
         response_dict = {'success': False,
                          'error': None,
                          'message': None,
                          'result': None}
         try:
+            collection = self.read_collection(asset_type, read_preference)
+            if raw:
+                collection = collection.with_options(
+                    codec_options=CodecOptions(document_class=RawBSONDocument))
             if specified_keys:
-                result = mongo.db[asset_type].find(
+                result = collection.find(
                             asset_filter,
                             specified_keys).batch_size(50)
-                response_dict.update(
-                    {'success': True,
-                     'result': list(result)})
             else:
-                result = mongo.db[asset_type].find(asset_filter).batch_size(50)
-                response_dict.update(
-                    {'success': True,
-                     'result': list(result)})
+                result = collection.find(asset_filter).batch_size(50)
+            if sort:
+                result = result.sort(sort)
+            if limit:
+                result = result.limit(limit)
+            response_dict.update(
+                {'success': True,
+                 'result': result})
         except Exception as e:
-            print(e)
+            metrics.db_error('asset_cursor', e)
             response_dict.update(
                 {'error': 500,
                  'message': 'DB Find Error'})
         return response_dict
 
-    def asset_count(self, asset_type, asset_filter):
+    def asset_find(self, asset_type, asset_filter, specified_keys=None,
+                   sort=None, limit=0, read_preference=None):
+        started = time.perf_counter()
+        response_dict = self.asset_cursor(asset_type, asset_filter,
+                                          specified_keys, sort, limit,
+                                          read_preference=read_preference)
+        if not response_dict.get('success'):
+            return response_dict
+        try:
+            response_dict['result'] = list(response_dict['result'])
+            slow_queries.SLOW_QUERIES.check(
+                'find', asset_type,
+                {'filter': asset_filter,
+                 'sort': [key for key, _ in sort or []]},
+                started, len(response_dict['result']),
+                lambda: self.explain_query('find', asset_type, asset_filter,
+                                           sort=sort, limit=limit,
+                                           read_preference=read_preference))
+        except Exception as e:
+            metrics.db_error('asset_find', e)
+            response_dict.update(
+                {'success': False,
+                 'error': 500,
+                 'message': 'DB Find Error',
+                 'result': None})
+        return response_dict
+
+    def asset_snapshot(self, asset_type, batch_size=1000):
+        # every asset of a type in abell_id order, read in a snapshot
+        # session so writes made while exporting do not show up. Falls back
+        # to a plain cursor where snapshot reads are not supported, like on
+        # a standalone mongod. result is {'documents': iterator,
+        # 'snapshot': bool}, one batch is held in memory at a time
+        response_dict = {'success': False,
+                         'error': None,
+                         'message': None,
+                         'result': None}
+        try:
+            for snapshot in (True, False):
+                session = None
+                if snapshot:
+                    session = mongo.cx.start_session(snapshot=True)
+                cursor = mongo.db[asset_type].find(
+                    {}, {'_id': False}, session=session,
+                    sort=[('abell_id', ASCENDING)], batch_size=batch_size)
+                try:
+                    # snapshot support only shows once the first batch is
+                    # read
+                    first = list(itertools.islice(cursor, 1))
+                except (ConfigurationError, OperationFailure) as e:
+                    if not snapshot:
+                        raise
+                    metrics.db_error('asset_snapshot', e)
+                    cursor.close()
+                    session.end_session()
+                    continue
+                break
+
+            def documents():
+                try:
+                    for document in itertools.chain(first, cursor):
+                        yield document
+                finally:
+                    cursor.close()
+                    if session is not None:
+                        session.end_session()
+            response_dict.update({'success': True,
+                                  'result': {'documents': documents(),
+                                             'snapshot': snapshot}})
+        except Exception as e:
+            metrics.db_error('asset_snapshot', e)
+            response_dict.update({'error': 500,
+                                  'message': 'DB Find Error'})
+        return response_dict
+
+    def asset_count(self, asset_type, asset_filter, read_preference=None):
         response_dict = {'success': False}
         try:
-            result = mongo.db[asset_type].find(
-                        asset_filter).count()
+            started = time.perf_counter()
+            result = self.read_collection(
+                asset_type, read_preference).count_documents(asset_filter)
             response_dict.update(
                 {'success': True,
                  'result': result})
+            slow_queries.SLOW_QUERIES.check(
+                'count', asset_type, {'filter': asset_filter}, started, 1,
+                lambda: self.explain_query('count', asset_type, asset_filter,
+                                           read_preference=read_preference))
         except Exception as e:
-            print(e)
+            metrics.db_error('asset_count', e)
             response_dict.update(
                 {'error': 500,
                  'message': 'DB Count Error'})
         return response_dict
 
-    def asset_distinct(self, asset_type, asset_filter, distinct_attribute):
+    def asset_distinct(self, asset_type, asset_filter, distinct_attribute,
+                       read_preference=None):
         response_dict = {'success': False,
                          'error': None,
                          'message': None,
                          'result': None}
         try:
-            result = mongo.db[asset_type].find(
+            started = time.perf_counter()
+            result = self.read_collection(asset_type, read_preference).find(
                         asset_filter).distinct(distinct_attribute)
             response_dict.update(
                 {'success': True,
                  'result': result})
+            slow_queries.SLOW_QUERIES.check(
+                'distinct', asset_type,
+                {'filter': asset_filter, 'key': distinct_attribute}, started,
+                len(result),
+                lambda: self.explain_query(
+                    'distinct', asset_type, asset_filter,
+                    distinct_attribute=distinct_attribute,
+                    read_preference=read_preference))
         except Exception as e:
-            print(e)
+            metrics.db_error('asset_distinct', e)
             response_dict.update(
                 {'error': 500,
                  'message': 'DB distinct Error'})
         return response_dict
 
-    def update_asset(self, asset_type, asset_filter, update_dict):
+    def explain_query(self, operation, asset_type, asset_filter, sort=None,
+                      limit=0, distinct_attribute=None, read_preference=None):
+        # executionStats explain of a find, count or distinct, runs the
+        # query again
+        response_dict = {'success': False}
+        if operation == 'find':
+            command = SON([('find', asset_type), ('filter', asset_filter)])
+            if sort:
+                command['sort'] = SON(sort)
+            if limit:
+                command['limit'] = limit
+        elif operation == 'count':
+            command = SON([('count', asset_type), ('query', asset_filter)])
+        else:
+            command = SON([('distinct', asset_type),
+                           ('key', distinct_attribute),
+                           ('query', asset_filter)])
+        try:
+            result = mongo.db.command(
+                'explain', command, verbosity='executionStats',
+                read_preference=read_preference or ReadPreference.PRIMARY)
+            response_dict.update(
+                {'success': True,
+                 'result': result})
+        except Exception as e:
+            metrics.db_error('explain_query', e)
+            response_dict.update(
+                {'error': 500,
+                 'message': 'DB Explain Error'})
+        return response_dict
+
+    def asset_ids(self, asset_type, asset_filter, limit=2):
+        # abell_ids of the first limit matching assets
+        response_dict = {'success': False,
+                         'error': None,
+                         'message': None,
+                         'result': None}
+        try:
+            result = mongo.db[asset_type].find(
+                        asset_filter,
+                        {'_id': False, 'abell_id': True}).limit(limit)
+            response_dict.update({'success': True,
+                                  'result': [r.get('abell_id')
+                                             for r in result]})
+        except Exception as e:
+            metrics.db_error('asset_ids', e)
+            response_dict.update(
+                {'error': 500,
+                 'message': 'DB Find Error'})
+        return response_dict
+
+    def asset_ids_per_filter(self, asset_type, asset_filters, limit=2):
+        # abell_ids of the first limit assets matching each filter, result
+        # holds a list per filter. The filters are read together, each in
+        # its own $unionWith so it can use its indexes
+        response_dict = {'success': False,
+                         'error': None,
+                         'message': None,
+                         'result': None}
+        abell_ids = [[] for _ in asset_filters]
+        try:
+            for start in range(0, len(asset_filters), UNION_BATCH_SIZE):
+                pipeline = []
+                for position in range(start, min(
+                        start + UNION_BATCH_SIZE, len(asset_filters))):
+                    stages = [{'$match': asset_filters[position]},
+                              {'$limit': limit},
+                              {'$project': {'_id': False,
+                                            'abell_id': True,
+                                            'position': {
+                                                '$literal': position}}}]
+                    if not pipeline:
+                        pipeline = stages
+                    else:
+                        pipeline.append({'$unionWith': {
+                            'coll': asset_type, 'pipeline': stages}})
+                for r in mongo.db[asset_type].aggregate(pipeline):
+                    abell_ids[r['position']].append(r.get('abell_id'))
+            response_dict.update({'success': True, 'result': abell_ids})
+        except Exception as e:
+            metrics.db_error('asset_ids_per_filter', e)
+            response_dict.update(
+                {'error': 500,
+                 'message': 'DB Find Error'})
+        return response_dict
+
+    def _id_batches(self, collection, asset_filter, batch_size):
+        # _id and abell_id of matching assets, batch_size at a time in _id
+        # order. Each batch is read after the previous one was written, so
+        # no reply or write filter ever holds every matching id
+        last_id = None
+        while True:
+            batch_filter = asset_filter
+            if last_id is not None:
+                batch_filter = {'$and': [asset_filter,
+                                         {'_id': {'$gt': last_id}}]}
+            batch = list(collection.find(batch_filter,
+                                         {'_id': True, 'abell_id': True})
+                         .sort('_id', 1).limit(batch_size))
+            if not batch:
+                return
+            last_id = batch[-1]['_id']
+            yield batch
+
+    def update_one_asset(self, asset_type, asset_filter, update_dict):
+        # result is the abell_id of the updated asset, None if no match
         response_dict = {'success': False,
                          'error': None,
                          'message': None,
                          'result': None}
         try:
-            result = mongo.db[asset_type].update_many(asset_filter,
-                                                      {'$set': update_dict})
+            result = mongo.db[asset_type].find_one_and_update(
+                        asset_filter,
+                        {'$set': update_dict},
+                        projection={'_id': False, 'abell_id': True},
+                        return_document=ReturnDocument.AFTER)
+            response_dict.update({'success': True,
+                                  'result': (result or {}).get('abell_id')})
+        except Exception as e:
+            metrics.db_error('update_one_asset', e)
+            response_dict['message'] = 'DB update error'
+        finally:
+            self.bump_generation(asset_type)
+        return response_dict
+
+    def upsert_asset(self, asset_type, asset_filter, update_dict,
+                     insert_dict):
+        # native upsert, insert_dict is only written when a new asset is
+        # created
+        response_dict = {'success': False,
+                         'error': None,
+                         'message': None,
+                         'upserted': False}
+        update = {'$setOnInsert': insert_dict}
+        if update_dict:
+            update['$set'] = update_dict
+        try:
+            result = mongo.db[asset_type].update_one(asset_filter, update,
+                                                     upsert=True)
             if result.acknowledged:
-                response_dict['success'] = True
-                response_dict['result'] = '%s matched, %s modified' % (
-                                            result.matched_count,
-                                            result.modified_count)
+                response_dict.update(
+                    {'success': True,
+                     'upserted': result.upserted_id is not None})
+        except Exception as e:
+            metrics.db_error('upsert_asset', e)
+            response_dict['message'] = 'DB upsert error'
+        finally:
+            self.bump_generation(asset_type)
+        return response_dict
+
+    def delete_one_asset(self, asset_type, asset_filter):
+        # result is the abell_id of the deleted asset, None if no match
+        response_dict = {'success': False,
+                         'error': None,
+                         'message': None,
+                         'result': None}
+        try:
+            result = mongo.db[asset_type].find_one_and_delete(
+                        asset_filter,
+                        projection={'_id': False, 'abell_id': True})
+            response_dict.update({'success': True,
+                                  'result': (result or {}).get('abell_id')})
+        except Exception as e:
+            metrics.db_error('delete_one_asset', e)
+            response_dict['message'] = 'DB delete error'
+        finally:
+            self.bump_generation(asset_type)
+        return response_dict
+
+    def update_asset(self, asset_type, asset_filter, update_dict,
+                     batch_size=1000):
+        # Updates every matching asset in _id ordered batches. Each write
+        # repeats the filter, an asset that stopped matching since its batch
+        # was read is left alone. result is the abell_ids updated
+        response_dict = {'success': False,
+                         'error': None,
+                         'message': None,
+                         'matched': 0,
+                         'modified': 0,
+                         'result': []}
+        collection = mongo.db[asset_type]
+        try:
+            for batch in self._id_batches(collection, asset_filter,
+                                          batch_size):
+                ids = [document['_id'] for document in batch]
+                result = collection.update_many(
+                    {'$and': [asset_filter, {'_id': {'$in': ids}}]},
+                    {'$set': update_dict})
+                response_dict['matched'] += result.matched_count
+                response_dict['modified'] += result.modified_count
+                if result.matched_count < len(batch):
+                    # some changed in between, keep those with the update
+                    batch = collection.find(
+                        {'$and': [{'_id': {'$in': ids}}, update_dict]},
+                        {'_id': False, 'abell_id': True})
+                response_dict['result'].extend(document.get('abell_id')
+                                               for document in batch)
+            response_dict['success'] = True
+            response_dict['message'] = '%s matched, %s modified' % (
+                response_dict['matched'], response_dict['modified'])
         except Exception as e:
-            print(e)
+            metrics.db_error('update_asset', e)
             response_dict['error'] = 'DB update error'
-            return response_dict
+        finally:
+            self.bump_generation(asset_type)
+        return response_dict
 
+    def bulk_update_assets(self, asset_type, updates, multi=False):
+        # updates is a list of (filter, set dict) pairs, all sent in one
+        # unordered bulk_write. errors are keyed on the position in updates,
+        # counts holds (matched, modified) per position, None where the
+        # server cannot tell
+        response_dict = {'success': False,
+                         'matched': 0,
+                         'modified': 0,
+                         'errors': {},
+                         'counts': [None] * len(updates)}
+        operation = UpdateMany if multi else UpdateOne
+        try:
+            if not (self.client_bulk_write and self._client_bulk_update(
+                    asset_type, updates, operation, response_dict)):
+                self._bulk_update(asset_type, updates, operation,
+                                  response_dict)
+            response_dict['success'] = True
+        except Exception as e:
+            metrics.db_error('bulk_update_assets', e)
+            response_dict.update({'error': 500,
+                                  'message': 'DB bulk update error'})
+        finally:
+            self.bump_generation(asset_type)
         return response_dict
 
-    def delete_assets(self, asset_type, asset_filter):
-        response_dict = {'success': False}
+    def _client_bulk_update(self, asset_type, updates, operation,
+                            response_dict):
+        # MongoClient.bulk_write with verbose results, counts per update.
+        # False when the server is older than MongoDB 8.0
+        namespace = '%s.%s' % (mongo.db.name, asset_type)
+        requests = [operation(asset_filter, {'$set': update_dict},
+                              namespace=namespace)
+                    for asset_filter, update_dict in updates]
         try:
-            result = mongo.db[asset_type].delete_many(asset_filter)
-            if result.acknowledged:
-                response_dict['success'] = True
+            result = mongo.cx.bulk_write(requests, ordered=False,
+                                         verbose_results=True)
+        except InvalidOperation:
+            AbellDb.client_bulk_write = False
+            return False
+        except ClientBulkWriteException as e:
+            if e.error:
+                raise
+            for error in e.write_errors or []:
+                response_dict['errors'][error.get('idx')] = \
+                    error.get('errmsg')
+            result = e.partial_result
+        if result is None:
+            return True
+        for position, update_result in result.update_results.items():
+            response_dict['counts'][position] = (
+                update_result.matched_count, update_result.modified_count)
+        response_dict.update({'matched': result.matched_count,
+                              'modified': result.modified_count})
+        return True
+
+    def _bulk_update(self, asset_type, updates, operation, response_dict):
+        # Collection.bulk_write only has totals. Updates of a single asset
+        # each matched one when the total says all did, and each modified
+        # one or none when all or none were modified
+        requests = [operation(asset_filter, {'$set': update_dict})
+                    for asset_filter, update_dict in updates]
+        try:
+            result = mongo.db[asset_type].bulk_write(requests, ordered=False)
+            matched = result.matched_count
+            modified = result.modified_count
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                response_dict['errors'][error.get('index')] = \
+                    error.get('errmsg')
+            matched = e.details.get('nMatched', 0)
+            modified = e.details.get('nModified', 0)
+        response_dict.update({'matched': matched, 'modified': modified})
+        written = len(updates) - len(response_dict['errors'])
+        if operation is not UpdateOne or matched != written:
+            return
+        modified_each = {written: 1, 0: 0}.get(modified)
+        for position in range(len(updates)):
+            if position not in response_dict['errors']:
+                response_dict['counts'][position] = (1, modified_each)
+
+    def upsert_assets(self, asset_type, upserts):
+        # upserts is a list of (abell_id, set dict, insert dict) triples.
+        # The set dict is written to the asset, the insert dict only when
+        # the asset is created. One unordered bulk_write, errors are keyed
+        # on the position in upserts.
+        response_dict = {'success': False,
+                         'upserted': 0,
+                         'matched': 0,
+                         'modified': 0,
+                         'errors': {}}
+        requests = []
+        for abell_id, set_dict, insert_dict in upserts:
+            update = {'$setOnInsert': insert_dict}
+            if set_dict:
+                update['$set'] = set_dict
+            requests.append(UpdateOne({'abell_id': abell_id}, update,
+                                      upsert=True))
+        try:
+            result = mongo.db[asset_type].bulk_write(requests, ordered=False)
+            response_dict.update({'success': True,
+                                  'upserted': result.upserted_count,
+                                  'matched': result.matched_count,
+                                  'modified': result.modified_count})
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                response_dict['errors'][error.get('index')] = \
+                    error.get('errmsg')
+            response_dict.update({'success': True,
+                                  'upserted': e.details.get('nUpserted', 0),
+                                  'matched': e.details.get('nMatched', 0),
+                                  'modified': e.details.get('nModified', 0)})
         except Exception as e:
-            print(e)
-            response_dict['error'] = 'DB delete error'
-            return response_dict
+            metrics.db_error('upsert_assets', e)
+            response_dict.update({'error': 500,
+                                  'message': 'DB bulk upsert error'})
+        finally:
+            self.bump_generation(asset_type)
+        return response_dict
 
+    def delete_assets(self, asset_type, asset_filter, batch_size=1000):
+        # Deletes every matching asset in _id ordered batches, see
+        # update_asset. result is the abell_ids deleted
+        response_dict = {'success': False,
+                         'result': []}
+        collection = mongo.db[asset_type]
+        try:
+            for batch in self._id_batches(collection, asset_filter,
+                                          batch_size):
+                ids = [document['_id'] for document in batch]
+                result = collection.delete_many(
+                    {'$and': [asset_filter, {'_id': {'$in': ids}}]})
+                if result.deleted_count < len(batch):
+                    # assets still there stopped matching in between
+                    kept = set(document['_id'] for document in
+                               collection.find({'_id': {'$in': ids}},
+                                               {'_id': True}))
+                    batch = [document for document in batch
+                             if document['_id'] not in kept]
+                response_dict['result'].extend(document.get('abell_id')
+                                               for document in batch)
+            response_dict['success'] = True
+        except Exception as e:
+            metrics.db_error('delete_assets', e)
+            response_dict['error'] = 'DB delete error'
+        finally:
+            self.bump_generation(asset_type)
         return response_dict
 
     def delete_asset_type(self, asset_type):
@@ -238,13 +1021,13 @@ class AbellDb(object):
             if result.acknowledged:
                 response_dict['success'] = True
         except Exception as e:
-            print(e)
+            metrics.db_error('delete_asset_type', e)
             response_dict['error'] = 'DB delete error'
             return response_dict
 
         return response_dict
 
     def nuke_all_collections(self):
-        collections = mongo.db.collection_names()
+        collections = mongo.db.list_collection_names()
         for c in collections:
             mongo.db.drop_collection(c)
@@ -0,0 +1,173 @@
+import inspect
+from abell import metrics
+from abell.database import mongo_uri
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:
+    try:
+        from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+    except ImportError:
+        AsyncMongoClient = None
+
+
+class AsyncAbellDb(object):
+    """asyncio version of the AbellDb read methods.
+
+    Uses the PyMongo async client, or motor on older PyMongo versions. The
+    methods return the same response dicts as their AbellDb counterparts.
+    Writes stay on AbellDb.
+    """
+
+    def __init__(self):
+        self.client = None
+        self.db = None
+
+    def init_app(self, config, **client_kwargs):
+        # config is the Flask config, the client is created on the running
+        # event loop
+        if AsyncMongoClient is None:
+            raise RuntimeError('The async API needs PyMongo 4.13 or motor')
+        uri = config.get('MONGO_URI') or mongo_uri(config)
+        self.client = AsyncMongoClient(uri, **client_kwargs)
+        self.db = self.client.get_default_database()
+
+    async def close(self):
+        if self.client is None:
+            return
+        # PyMongo's close is a coroutine, motor's is not
+        closed = self.client.close()
+        if inspect.isawaitable(closed):
+            await closed
+        self.client = None
+        self.db = None
+
+    async def get_asset_type_info(self, asset_type):
+        response_dict = {'success': False}
+        try:
+            asset_info = await self.db.assetinfo.find_one(
+                {'type': asset_type}, {'_id': False})
+            response_dict.update({'success': True,
+                                  'result': asset_info})
+        except Exception as e:
+            response_dict.update(
+                {'error': 500,
+                 'message': 'Unknown db error, contact admin'})
+            metrics.db_error('get_asset_type_info', e)
+        return response_dict
+
+    async def get_asset_types(self, limit=0):
+        response_dict = {'success': False}
+        try:
+            cursor = self.db.assetinfo.find({}, {'_id': False}).limit(limit)
+            response_dict.update({'success': True,
+                                  'result': await cursor.to_list(None)})
+        except Exception as e:
+            response_dict.update(
+                {'error': 500,
+                 'message': 'Unknown db error, contact admin'})
+            metrics.db_error('get_asset_types', e)
+        return response_dict
+
+    async def get_asset_type_versions(self, asset_types):
+        response_dict = {'success': False}
+        try:
+            cursor = self.db.assetinfo.find(
+                {'type': {'$in': list(asset_types)}},
+                {'_id': False, 'type': True, 'version': True})
+            response_dict.update(
+                {'success': True,
+                 'result': dict((r.get('type'), r.get('version', 0))
+                                for r in await cursor.to_list(None))})
+        except Exception as e:
+            response_dict.update(
+                {'error': 500,
+                 'message': 'Unknown db error, contact admin'})
+            metrics.db_error('get_asset_type_versions', e)
+        return response_dict
+
+    async def get_generation(self, asset_type):
+        # same (type document id, write generation, schema version) tuple
+        # as AbellDb.get_generation
+        response_dict = {'success': False}
+        try:
+            asset_info = await self.db.assetinfo.find_one(
+                {'type': asset_type}, {'generation': True, 'version': True})
+            generation = None
+            if asset_info:
+                generation = (str(asset_info.get('_id')),
+                              asset_info.get('generation', 0),
+                              asset_info.get('version', 0))
+            response_dict.update({'success': True,
+                                  'result': generation})
+        except Exception as e:
+            response_dict.update(
+                {'error': 500,
+                 'message': 'Unknown db error, contact admin'})
+            metrics.db_error('get_generation', e)
+        return response_dict
+
+    def asset_cursor(self, asset_type, asset_filter, specified_keys=None,
+                     sort=None, limit=0):
+        # not a coroutine, the cursor is iterated with async for
+        response_dict = {'success': False,
+                         'error': None,
+                         'message': None,
+                         'result': None}
+        try:
+            cursor = self.db[asset_type].find(asset_filter,
+                                              specified_keys or None)
+            cursor = cursor.batch_size(50)
+            if sort:
+                cursor = cursor.sort(sort)
+            if limit:
+                cursor = cursor.limit(limit)
+            response_dict.update({'success': True,
+                                  'result': cursor})
+        except Exception as e:
+            metrics.db_error('asset_cursor', e)
+            response_dict.update({'error': 500,
+                                  'message': 'DB Find Error'})
+        return response_dict
+
+    async def asset_find(self, asset_type, asset_filter, specified_keys=None,
+                         sort=None, limit=0):
+        response_dict = self.asset_cursor(asset_type, asset_filter,
+                                          specified_keys, sort, limit)
+        if not response_dict.get('success'):
+            return response_dict
+        try:
+            response_dict['result'] = await response_dict['result'].to_list(
+                None)
+        except Exception as e:
+            metrics.db_error('asset_find', e)
+            response_dict.update({'success': False,
+                                  'error': 500,
+                                  'message': 'DB Find Error',
+                                  'result': None})
+        return response_dict
+
+    async def asset_count(self, asset_type, asset_filter):
+        response_dict = {'success': False}
+        try:
+            result = await self.db[asset_type].count_documents(asset_filter)
+            response_dict.update({'success': True,
+                                  'result': result})
+        except Exception as e:
+            metrics.db_error('asset_count', e)
+            response_dict.update({'error': 500,
+                                  'message': 'DB Count Error'})
+        return response_dict
+
+    async def asset_distinct(self, asset_type, asset_filter,
+                             distinct_attribute):
+        response_dict = {'success': False}
+        try:
+            result = await self.db[asset_type].distinct(distinct_attribute,
+                                                        asset_filter)
+            response_dict.update({'success': True,
+                                  'result': result})
+        except Exception as e:
+            metrics.db_error('asset_distinct', e)
+            response_dict.update({'error': 500,
+                                  'message': 'DB Distinct Error'})
+        return response_dict
@@ -0,0 +1,299 @@
+import csv
+import gzip
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from abell.models import asset
+from abell.models import asset_type as AT
+
+
+# rejected records kept for the report, the rest are only counted
+MAX_ERRORS = 1000
+
+FORMATS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson',
+           '.json': 'ndjson'}
+
+
+def file_format(path):
+    """Guesses csv or ndjson from the file extension, .gz is looked past."""
+    name = path[:-3] if path.endswith('.gz') else path
+    return FORMATS.get(os.path.splitext(name)[1].lower())
+
+
+def open_text(path):
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, 'rb'), encoding='utf-8',
+                                newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def read_records(path, fmt, skip_to=0):
+    """Yields (line, record) pairs without reading the whole file.
+
+    line is the 1 based record number, records up to skip_to are skipped.
+    Empty CSV cells are left out so the type default applies. A record
+    that cannot be parsed is yielded as None.
+    """
+    with open_text(path) as f:
+        if fmt == 'csv':
+            rows = csv.DictReader(f)
+        else:
+            rows = (line for line in f if line.strip())
+        for line, row in enumerate(rows, 1):
+            if line <= skip_to:
+                continue
+            if fmt == 'csv':
+                yield line, dict((k, v) for k, v in row.items()
+                                 if k is not None and v != '')
+                continue
+            try:
+                yield line, json.loads(row)
+            except ValueError:
+                yield line, None
+
+
+def prepare_record(ato, record, mode):
+    """Turns a record into what load_chunk writes.
+
+    Returns:
+        (document, None) for an insert, ((abell_id, set dict, insert dict),
+        None) for an upsert or (None, error message).
+    """
+    if record is None:
+        return None, 'Record is not valid JSON'
+    message = asset.invalid_asset(ato, record)
+    if message:
+        return None, message
+    new_asset = asset.AbellAsset(ato.asset_type, record.get('abell_id'),
+                                 record, ato)
+    if mode == 'insert':
+        return new_asset.fields, None
+    # only the keys in the record overwrite an existing asset, system keys
+    # and the defaults are only written to new ones
+    set_dict = dict((k, v) for k, v in new_asset.fields.items()
+                    if k in record and k not in ato.system_keys)
+    insert_dict = dict((k, v) for k, v in new_asset.fields.items()
+                       if k not in set_dict)
+    return (new_asset.abell_id, set_dict, insert_dict), None
+
+
+class LoadStats(object):
+    """Thread safe counters of a load, reported while it runs."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.read = 0
+        self.inserted = 0
+        self.updated = 0
+        self.duplicates = 0
+        self.rejected = 0
+
+    def add(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def summary(self):
+        with self._lock:
+            elapsed = time.time() - self.started
+            return {'read': self.read,
+                    'inserted': self.inserted,
+                    'updated': self.updated,
+                    'duplicates': self.duplicates,
+                    'rejected': self.rejected,
+                    'seconds': round(elapsed, 2),
+                    'records_per_second': round(
+                        self.read / elapsed if elapsed else 0.0, 1)}
+
+
+class Checkpoint(object):
+    """Last record line up to which every write has finished.
+
+    Chunks finish out of order, the checkpoint only moves past a chunk
+    once every chunk before it is done, so resuming from it never skips
+    an unwritten record.
+    """
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = os.path.abspath(source)
+        self.line = 0
+        self._pending = {}
+        self._next_chunk = 0
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            saved = json.load(f)
+        if saved.get('source') == self.source:
+            self.line = saved.get('line', 0)
+        return self.line
+
+    def chunk_done(self, chunk_number, last_line):
+        self._pending[chunk_number] = last_line
+        moved = False
+        while self._next_chunk in self._pending:
+            self.line = self._pending.pop(self._next_chunk)
+            self._next_chunk += 1
+            moved = True
+        if moved and self.path:
+            self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'source': self.source, 'line': self.line,
+                       'saved_at': time.time()}, f)
+        os.replace(tmp_path, self.path)
+
+
+def load_chunk(app, asset_type, mode, chunk):
+    """Writes one chunk of prepared records.
+
+    Returns:
+        dict of LoadStats counts, errors as [(line, abell_id, message)]
+        and failed, True when the write itself failed and no record of
+        the chunk may have been written
+    """
+    lines = [line for line, _ in chunk]
+    items = [item for _, item in chunk]
+    with app.app_context():
+        if mode == 'insert':
+            db_response = asset.ABELLDB.add_new_assets(asset_type, items)
+        else:
+            db_response = asset.ABELLDB.upsert_assets(asset_type, items)
+    if not db_response.get('success'):
+        return {'rejected': len(chunk),
+                'failed': True,
+                'errors': [(line, None, db_response.get('message'))
+                           for line in lines]}
+    errors = db_response.get('errors', {})
+    result = {'rejected': len(errors),
+              'failed': False,
+              'errors': [(lines[position], None, message)
+                         for position, message in sorted(errors.items())]}
+    if mode == 'insert':
+        duplicates = len(db_response.get('duplicates', []))
+        result.update({'inserted': len(chunk) - duplicates - len(errors),
+                       'duplicates': duplicates})
+    else:
+        result.update({'inserted': db_response.get('upserted', 0),
+                       'updated': db_response.get('matched', 0)})
+    return result
+
+
+def load_file(app, path, asset_type, mode='insert', fmt=None, workers=4,
+              chunk_size=1000, checkpoint_path=None, resume=False,
+              report_interval=5, report=print):
+    """Streams a CSV or NDJSON file into an asset type.
+
+    Records are validated against the AbellAssetType and written in chunks
+    by a pool of worker threads. insert mode does unordered insert_many
+    calls, existing abell_ids are counted as duplicates. upsert mode does
+    unordered bulk_write upserts keyed on abell_id. At most two chunks per
+    worker are queued, so memory does not grow with the file.
+    Args:
+        app (Flask): App the workers run in
+        path (str): File to load, may be gzipped
+        asset_type (str): Type every record must belong to
+        mode (str): insert or upsert
+        fmt (str): csv or ndjson, guessed from the extension by default
+        workers (int): Writer threads
+        chunk_size (int): Records per write
+        checkpoint_path (str): File the resume point is saved in
+        resume (bool): Skip the records done according to the checkpoint,
+                       which must exist
+        report_interval (int): Seconds between progress reports
+        report (callable): Receives the progress lines
+    Returns:
+        dict: The LoadStats summary, 'errors' lists (line, abell_id,
+              message) of the first MAX_ERRORS rejected records,
+              'failed_chunks' the number of chunks whose write failed and
+              'checkpoint' the line up to which the file is loaded. The
+              checkpoint stops before the first failed chunk, so resuming
+              writes it again.
+    """
+    fmt = fmt or file_format(path)
+    if fmt not in ('csv', 'ndjson'):
+        raise ValueError('Unknown file format for %s, use csv or ndjson'
+                         % path)
+    if mode not in ('insert', 'upsert'):
+        raise ValueError('mode must be insert or upsert')
+    if resume and not (checkpoint_path and os.path.exists(checkpoint_path)):
+        # starting over would silently load the whole file again
+        raise ValueError('No checkpoint to resume from at %s'
+                         % checkpoint_path)
+    with app.app_context():
+        ato = AT.get_asset_type(asset_type)
+    if not ato:
+        raise ValueError('Asset type %s not found' % asset_type)
+
+    checkpoint = Checkpoint(checkpoint_path, path)
+    skip_to = checkpoint.load() if resume else 0
+    stats = LoadStats()
+    errors = []
+    failed_chunks = []
+    in_flight = {}
+    last_report = time.time()
+
+    def collect(futures):
+        for future in futures:
+            chunk_number, last_line = in_flight.pop(future)
+            result = future.result()
+            errors.extend(result.pop('errors')[:MAX_ERRORS - len(errors)])
+            if result.pop('failed'):
+                # never marked done, the checkpoint cannot move past it
+                failed_chunks.append(chunk_number)
+            else:
+                checkpoint.chunk_done(chunk_number, last_line)
+            stats.add(**result)
+
+    def submit(chunk, chunk_number):
+        future = pool.submit(load_chunk, app, asset_type, mode, chunk)
+        in_flight[future] = (chunk_number, chunk[-1][0])
+
+    with app.app_context(), ThreadPoolExecutor(max_workers=workers) as pool:
+        chunk = []
+        chunk_number = 0
+        for line, record in read_records(path, fmt, skip_to):
+            stats.add(read=1)
+            item, message = prepare_record(ato, record, mode)
+            if message:
+                stats.add(rejected=1)
+                if len(errors) < MAX_ERRORS:
+                    errors.append((line, record.get('abell_id')
+                                   if type(record) is dict else None,
+                                   message))
+                continue
+            chunk.append((line, item))
+            if len(chunk) < chunk_size:
+                continue
+            while len(in_flight) >= workers * 2:
+                done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                collect(done)
+            submit(chunk, chunk_number)
+            chunk = []
+            chunk_number += 1
+            if time.time() - last_report >= report_interval:
+                last_report = time.time()
+                report(progress_line(stats.summary()))
+        if chunk:
+            submit(chunk, chunk_number)
+        collect(list(in_flight))
+
+    summary = stats.summary()
+    summary.update({'errors': sorted(errors, key=lambda e: e[0]),
+                    'failed_chunks': len(failed_chunks),
+                    'checkpoint': checkpoint.line})
+    return summary
+
+
+def progress_line(summary):
+    return ('%(read)d read, %(inserted)d inserted, %(updated)d updated, '
+            '%(duplicates)d duplicates, %(rejected)d rejected, '
+            '%(records_per_second).1f records/s' % summary)
@@ -0,0 +1,170 @@
+import logging
+import threading
+import time
+from functools import wraps
+from flask import Response, g, has_request_context, request
+
+
+log = logging.getLogger('abell.database')
+
+# Upper bounds in seconds, Prometheus style
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, float('inf'))
+
+PHASES = ('db', 'serialize', 'total')
+
+
+class Histogram(object):
+    """Cumulative bucket counts, sum and count of observed seconds."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class Metrics(object):
+    """Process wide request latencies and AbellDb error counts.
+
+    Every worker process keeps its own numbers, /metrics reports the ones
+    of the process answering it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.enabled = True
+        self.clear()
+
+    def init_app(self, app):
+        self.enabled = app.config.get('METRICS_ENABLED', True)
+        self.clear()
+        if not self.enabled:
+            return
+        app.before_request(start_request)
+        app.after_request(finish_request)
+        app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+    def clear(self):
+        with self._lock:
+            self.histograms = {}
+            self.db_errors = {}
+
+    def observe(self, route, timings):
+        with self._lock:
+            for phase in PHASES:
+                key = (route, phase)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.observe(timings[phase])
+
+    def db_error(self, method):
+        with self._lock:
+            self.db_errors[method] = self.db_errors.get(method, 0) + 1
+
+    def render(self):
+        """Prometheus text exposition format."""
+        lines = ['# HELP abell_request_seconds Request time by route and '
+                 'phase',
+                 '# TYPE abell_request_seconds histogram']
+        with self._lock:
+            for (route, phase), histogram in sorted(self.histograms.items()):
+                labels = 'route="%s",phase="%s"' % (route, phase)
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('abell_request_seconds_bucket{%s,le="%s"} %d'
+                                 % (labels, le, count))
+                lines.append('abell_request_seconds_sum{%s} %.6f'
+                             % (labels, histogram.sum))
+                lines.append('abell_request_seconds_count{%s} %d'
+                             % (labels, histogram.count))
+            lines.extend(['# HELP abell_db_errors_total Failed AbellDb '
+                          'calls by method',
+                          '# TYPE abell_db_errors_total counter'])
+            for method, count in sorted(self.db_errors.items()):
+                lines.append('abell_db_errors_total{method="%s"} %d'
+                             % (method, count))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+def add_time(phase, seconds):
+    # time spent outside a request is not reported
+    if has_request_context() and 'timings' in g:
+        g.timings[phase] += seconds
+
+
+def db_error(method, error):
+    """Counts and logs an exception an AbellDb method handled."""
+    METRICS.db_error(method)
+    log.error('%s failed: %s', method, error)
+
+
+def timed(method):
+    # calls made by another timed method are part of its time
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        if not has_request_context() or 'timings' not in g or g.db_depth:
+            return method(*args, **kwargs)
+        g.db_depth += 1
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            g.timings['db'] += time.perf_counter() - started
+            g.db_depth -= 1
+    return wrapper
+
+
+def instrument(cls):
+    """Class decorator counting every public method call as db time.
+
+    Cursors returned to be streamed are fetched after the call, that time
+    shows up in the total only.
+    """
+    for name, method in list(vars(cls).items()):
+        if callable(method) and not name.startswith('_'):
+            setattr(cls, name, timed(method))
+    return cls
+
+
+def start_request():
+    g.timings = dict((phase, 0.0) for phase in PHASES)
+    g.db_depth = 0
+    g.timing_started = time.perf_counter()
+
+
+def route_name():
+    if request.url_rule is None:
+        return 'unmatched'
+    return '%s %s' % (request.method, request.url_rule.rule)
+
+
+def finish_request(response):
+    """Adds the Server-Timing header and records the histograms.
+
+    Streamed bodies are sent after this runs, their total covers the time
+    to the first byte.
+    """
+    if 'timings' not in g or request.endpoint == 'metrics':
+        return response
+    timings = g.timings
+    timings['total'] = time.perf_counter() - g.timing_started
+    response.headers['Server-Timing'] = ', '.join(
+        '%s;dur=%.2f' % (phase, timings[phase] * 1000) for phase in PHASES)
+    METRICS.observe(route_name(), timings)
+    return response
+
+
+def metrics_view():
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
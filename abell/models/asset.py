@@ -1,5 +1,10 @@
 # from repoze.lru import lru_cache
+import json
+from abell.cache import LRUCache
 from abell.models import model_tools
+from flask import current_app
+from pymongo import ReadPreference
+from abell import database
 from abell.database import AbellDb
 from abell.models import asset_type as AT
 
@@ -7,6 +12,297 @@ from abell.models import asset_type as AT
 ABELLDB = AbellDb()
 
 
+class QueryCache(LRUCache):
+    """Cache of find, count and distinct results.
+
+    Entries are keyed on the write generation of the asset type, which
+    every write in AbellDb bumps, and on its schema version, which changes
+    how sparse assets read back, so a stale result is never served.
+    Results longer than max_results are not cached to bound memory.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, max_results=1000):
+        super(QueryCache, self).__init__(maxsize, ttl,
+                                         config_prefix='QUERY_CACHE')
+        self.max_results = max_results
+
+    def init_app(self, app):
+        super(QueryCache, self).init_app(app)
+        self.max_results = app.config.get('QUERY_CACHE_MAX_RESULTS',
+                                          self.max_results)
+
+
+QUERY_CACHE = QueryCache()
+
+
+def type_generation(asset_type):
+    """Returns the (id, generation, version) of a type, None if unknown."""
+    return ABELLDB.get_generation(asset_type).get('result')
+
+
+def routed_reads():
+    """ReadPreference of the find, count and distinct endpoints.
+
+    None when they read from the primary. Results read elsewhere may lag
+    behind the generation read from the primary, so they are neither
+    cached nor given an ETag.
+    """
+    read_preference = database.read_preference(current_app.config)
+    if read_preference == ReadPreference.PRIMARY:
+        return None
+    return read_preference
+
+
+def cached_query(operation, asset_type, query, run_query, generation=None,
+                 encode=None):
+    """Runs a read query through the QUERY_CACHE.
+
+    Args:
+        operation (str): find, count or distinct
+        asset_type (str): Asset type the query runs against
+        query (tuple): Normalized query arguments, part of the key
+        run_query (callable): Runs the query on a miss
+        generation (tuple): type_generation result if the caller has it
+        encode (callable): Turns a successful response into the entry kept,
+                           see cache_response
+    Returns:
+        AbellDb response dict, the kept entry when it was cached
+    """
+    if generation is None:
+        generation = type_generation(asset_type)
+    if generation is None:
+        # Unknown type or db error, nothing safe to key on
+        return run_query()
+    key = query_cache_key(operation, asset_type, generation, query)
+    cached = QUERY_CACHE.get(key)
+    if cached is not None:
+        return dict(cached)
+    return cache_response(key, run_query(), encode)
+
+
+def query_cache_key(operation, asset_type, generation, query):
+    return (operation, asset_type, generation,
+            json.dumps(query, sort_keys=True, default=str))
+
+
+def cache_response(key, db_response, encode=None):
+    """Keeps a successful response in the QUERY_CACHE.
+
+    encode lets the API keep its encoded payload instead of the documents,
+    so hits skip encoding them again. Failed queries and long results are
+    not kept.
+    Returns:
+        dict: The response as kept, db_response when it is not
+    """
+    result = db_response.get('result')
+    if not db_response.get('success') or (
+            isinstance(result, list) and
+            len(result) > QUERY_CACHE.max_results):
+        return db_response
+    if encode is not None:
+        db_response = encode(db_response)
+    QUERY_CACHE.set(key, dict(db_response))
+    return db_response
+
+
+def authorized_keys(ato, user_update_dict, auth_level='user'):
+    """Returns the part of an update the auth level may change."""
+    # TEMP Auth check, this will Change)
+    if auth_level == 'admin':
+        valid_keys = ato.managed_keys.union(ato.unmanaged_keys)
+    else:
+        valid_keys = ato.unmanaged_keys
+    return dict((k, v) for k, v in user_update_dict.items()
+                if k.split('.')[0] in valid_keys)
+
+
+def bulk_update_asset_values(operations, auth_level='user', multi=False):
+    """Applies a list of {filter, update} pairs in one bulk_write.
+
+    All filters must target the same asset type, which is looked up once.
+    Each update is restricted to the keys the auth level may change, the
+    same way update_asset_values does.
+    Args:
+        operations (list): [{'filter': dict, 'update': dict}, ...]
+        auth_level (str): user or admin
+        multi (bool): Update every asset a filter matches instead of one,
+                      otherwise a filter matching several assets is
+                      rejected and one matching none is not_found
+    Returns:
+        Response dict: {'success': bool, 'matched': int, 'modified': int,
+                        'results': [{'index': int, 'status': str,
+                                     'message': str, 'updated_keys': dict,
+                                     'matched': int, 'modified': int}]}
+        The counts of an operation are None when the database cannot
+        report them, see AbellDb.bulk_update_assets.
+    """
+    response_dict = {'success': False,
+                     'error': None,
+                     'message': None,
+                     'matched': 0,
+                     'modified': 0,
+                     'results': []}
+    valid = []
+    for index, op in enumerate(operations):
+        result = {'index': index, 'status': 'rejected', 'message': None,
+                  'updated_keys': {}, 'matched': 0, 'modified': 0}
+        response_dict['results'].append(result)
+        if (type(op) is not dict or type(op.get('filter')) is not dict or
+                type(op.get('update')) is not dict):
+            result['message'] = 'Operation needs a filter and an update dict'
+            continue
+        valid.append((index, op))
+    if not valid:
+        response_dict.update({'error': 400,
+                              'message': 'Operations need a filter and an '
+                                         'update dict'})
+        return response_dict
+    asset_type = valid[0][1]['filter'].get('type')
+    ato = AT.get_asset_type(asset_type)
+    if not ato:
+        response_dict.update({'error': 404,
+                              'message': 'Type %s not found.' % asset_type})
+        return response_dict
+
+    updates = []
+    for index, op in valid:
+        result = response_dict['results'][index]
+        if op['filter'].get('type') != ato.asset_type:
+            result['message'] = 'Filter type must be %s' % ato.asset_type
+            continue
+        updated_keys = authorized_keys(ato, op['update'], auth_level)
+        if not updated_keys:
+            result['message'] = 'No updatable keys in update'
+            continue
+        result['updated_keys'] = model_tools.item_stringify(updated_keys)
+        updates.append((index, op['filter'], result['updated_keys']))
+
+    if updates and not multi:
+        # UpdateOne would pick any one of several matches and does not
+        # tell which operations matched nothing
+        r = single_asset_filters(ato.asset_type,
+                                 [op_filter for _, op_filter, _ in updates])
+        if not r.get('success'):
+            response_dict.update({'error': 500,
+                                  'message': r.get('message')})
+            return response_dict
+        pinned = []
+        for (index, _, keys), (update_filter, error) in zip(
+                updates, r.get('result')):
+            result = response_dict['results'][index]
+            if error == 404:
+                result.update({'status': 'not_found',
+                               'message': 'No asset matches the filter'})
+            elif error == 400:
+                result['message'] = ('The filter matches several assets, '
+                                     'pass update_multiple_assets=true to '
+                                     'update them all')
+            else:
+                pinned.append((index, update_filter, keys))
+        updates = pinned
+    elif updates:
+        updates = [(index, multi_write_filter(ato.asset_type, op_filter),
+                    keys) for index, op_filter, keys in updates]
+
+    if updates:
+        db_response = ABELLDB.bulk_update_assets(
+            ato.asset_type,
+            [(op_filter, keys) for _, op_filter, keys in updates],
+            multi=multi)
+        if not db_response.get('success'):
+            response_dict.update({'error': 500,
+                                  'message': db_response.get('message')})
+            return response_dict
+        errors = db_response.get('errors', {})
+        counts = db_response.get('counts') or [None] * len(updates)
+        for position, (index, _, _) in enumerate(updates):
+            result = response_dict['results'][index]
+            if position in errors:
+                result.update({'status': 'error',
+                               'message': errors[position]})
+                continue
+            result.update({'status': 'ok', 'matched': None,
+                           'modified': None})
+            if counts[position] is not None:
+                result['matched'], result['modified'] = counts[position]
+                if not result['matched']:
+                    # removed or changed since its filter was resolved
+                    result['status'] = 'not_found'
+        response_dict.update({'matched': db_response.get('matched'),
+                              'modified': db_response.get('modified')})
+    response_dict['success'] = True
+    return response_dict
+
+
+def single_asset_filter(asset_type, asset_filter):
+    """Narrows a filter down to the one asset it is expected to match.
+
+    A filter on a plain abell_id can match one asset at most thanks to the
+    unique index and is used as is. Otherwise up to two matching ids are
+    read to tell a single match from an ambiguous filter, and the filter is
+    pinned to the id found so a concurrent writer cannot change which asset
+    is hit.
+    Returns:
+        Response dict: {'success': bool, 'result': (filter, abell_id)}
+        result is (None, None) when nothing matches.
+    """
+    if sparse_type(asset_type):
+        asset_filter = sparse_filter(asset_filter)
+    abell_id = asset_filter.get('abell_id')
+    if isinstance(abell_id, str):
+        return {'success': True, 'result': (asset_filter, abell_id)}
+    db_response = ABELLDB.asset_ids(asset_type, asset_filter, limit=2)
+    if not db_response.get('success'):
+        return db_response
+    abell_ids = db_response.get('result')
+    if len(abell_ids) > 1:
+        return {'success': False,
+                'error': 400,
+                'message': 'The filter did not return a single asset'}
+    if not abell_ids:
+        return {'success': True, 'result': (None, None)}
+    return {'success': True,
+            'result': ({'$and': [asset_filter,
+                                 {'abell_id': abell_ids[0]}]},
+                       abell_ids[0])}
+
+
+def single_asset_filters(asset_type, asset_filters):
+    """single_asset_filter for every filter of a bulk update.
+
+    Up to two matching ids of every filter are read in one aggregate.
+    Returns:
+        Response dict: {'success': bool, 'result': [(filter, error)]}
+        error is None, 400 when a filter matches several assets, or 404
+        when it matches none, filter is None on an error.
+    """
+    if sparse_type(asset_type):
+        asset_filters = [sparse_filter(f) for f in asset_filters]
+    db_response = ABELLDB.asset_ids_per_filter(asset_type, asset_filters,
+                                               limit=2)
+    if not db_response.get('success'):
+        return db_response
+    pinned = []
+    for asset_filter, abell_ids in zip(asset_filters,
+                                       db_response.get('result')):
+        if len(abell_ids) > 1:
+            pinned.append((None, 400))
+        elif not abell_ids:
+            pinned.append((None, 404))
+        elif isinstance(asset_filter.get('abell_id'), str):
+            pinned.append((asset_filter, None))
+        else:
+            pinned.append(({'$and': [asset_filter,
+                                     {'abell_id': abell_ids[0]}]}, None))
+    return {'success': True, 'result': pinned}
+
+
+def multi_write_filter(asset_type, asset_filter):
+    if sparse_type(asset_type):
+        return sparse_filter(asset_filter)
+    return asset_filter
+
+
 def update_asset_values(asset_type, asset_filter, user_update_dict,
                         auth_level='user', multi=False, upsert=False):
     response_dict = {'success': False,
@@ -20,57 +316,76 @@ def update_asset_values(asset_type, asset_filter, user_update_dict,
                               'message': 'Type %s not found.' % asset_type})
         return response_dict
 
-    # TEMP Auth check, this will Change)
-    if auth_level == 'admin':
-        valid_keys = ato.managed_keys.union(ato.unmanaged_keys)
-        for k, v in user_update_dict.items():
-            if k.split('.')[0] in valid_keys:
-                response_dict['updated_keys'][k] = v
-    else:
-        valid_keys = ato.unmanaged_keys
-        for k, v in user_update_dict.items():
-            if k.split('.')[0] in valid_keys:
-                response_dict['updated_keys'][k] = v
-    payload = model_tools.item_stringify(response_dict['updated_keys'])
-
-    # Get abell ids of matching assets
-    assets_to_update = asset_find(
-                        asset_type,
-                        asset_filter,
-                        specified_keys={'_id': 0, 'abell_id': 1})
-    assets_to_update = assets_to_update.get('result')
-    if not multi:
-        # check for UPSERT if len is 0
-        if upsert and len(assets_to_update) is 0:
-            print('creating new asset')
-            new_asset = AbellAsset(ato.asset_type,
-                                   user_update_dict.get('abell_id'),
-                                   user_update_dict,
-                                   ato)
-            r = new_asset.insert_asset()
-            if r.get('success'):
-                response_dict.update({'success': True,
-                                      'new_assets': r.get('message')})
-                return response_dict
-            else:
-                response_dict.update({'error': 500,
-                                      'message': 'Error creating asset.'})
-                return response_dict
-
-        if len(assets_to_update) is not 1:
-            response_dict.update({'error': 400,
-                                  'message': 'The filter did not return '
-                                             'a single asset'})
-            return response_dict
+    payload = model_tools.item_stringify(
+        authorized_keys(ato, user_update_dict, auth_level))
+    response_dict['updated_keys'] = payload
+    if not payload and not upsert:
+        response_dict.update({'error': 400,
+                              'message': 'No updatable keys in update'})
+        return response_dict
 
-    db_response = ABELLDB.update_asset(asset_type, asset_filter, payload)
-    if db_response.get('success'):
-        for a in assets_to_update:
-            asset_id = a.get('abell_id')
-            response_dict['updated_asset_ids'].append(asset_id)
+    if multi:
+        db_response = ABELLDB.update_asset(
+            asset_type, multi_write_filter(asset_type, asset_filter),
+            payload, current_app.config.get('MULTI_WRITE_BATCH_SIZE', 1000))
+        if not db_response.get('success'):
+            response_dict.update({'error': 500,
+                                  'message': db_response.get('error')})
+            return response_dict
         response_dict.update({'success': True,
-                              'message': db_response.get('result')})
-    # TODO Probably convert to a bulk find and update call
+                              'updated_asset_ids': db_response.get('result'),
+                              'message': db_response.get('message')})
+        return response_dict
+
+    r = single_asset_filter(asset_type, asset_filter)
+    if not r.get('success'):
+        response_dict.update({'error': r.get('error', 500),
+                              'message': r.get('message')})
+        return response_dict
+    update_filter, abell_id = r.get('result')
+
+    if upsert:
+        new_asset = AbellAsset(ato.asset_type,
+                               user_update_dict.get('abell_id'),
+                               user_update_dict,
+                               ato)
+        # $set and $setOnInsert may not touch the same top level key
+        set_keys = set(k.split('.')[0] for k in payload)
+        insert_fields = dict((k, v) for k, v in new_asset.fields.items()
+                             if k not in set_keys)
+        db_response = ABELLDB.upsert_asset(asset_type,
+                                           update_filter or asset_filter,
+                                           payload, insert_fields)
+        if not db_response.get('success'):
+            response_dict.update({'error': 500,
+                                  'message': 'Error creating asset.'})
+        elif db_response.get('upserted'):
+            message = 'asset with abell_id: %s created' % new_asset.abell_id
+            response_dict.update({'success': True,
+                                  'new_assets': message})
+        else:
+            response_dict.update({'success': True,
+                                  'updated_asset_ids': [abell_id] if abell_id
+                                  else [],
+                                  'message': '1 matched'})
+        return response_dict
+
+    if update_filter is not None:
+        db_response = ABELLDB.update_one_asset(asset_type, update_filter,
+                                               payload)
+        if not db_response.get('success'):
+            response_dict.update({'error': 500,
+                                  'message': db_response.get('message')})
+            return response_dict
+        abell_id = db_response.get('result')
+    if update_filter is None or abell_id is None:
+        response_dict.update({'error': 400,
+                              'message': 'The filter did not return '
+                                         'a single asset'})
+        return response_dict
+    response_dict.update({'success': True,
+                          'updated_asset_ids': [abell_id],
+                          'message': '1 matched'})
     # TODO Log updated documents
     return response_dict
 
@@ -78,38 +393,250 @@ def update_asset_values(asset_type, asset_filter, user_update_dict,
 def delete_assets(asset_type, asset_filter, auth_level='user', multi=False):
     response_dict = {'success': False,
                      'deleted_asset_ids': []}
-    # Get abell_ids for matching assets_to_update
-    assets_to_delete = asset_find(asset_type,
-                                  asset_filter,
-                                  specified_keys={'_id': 0, 'abell_id': 1})
-    assets_to_delete = assets_to_delete.get('result')
-    if not multi:
-        if len(assets_to_delete) is not 1:
-            response_dict.update({'error': 400,
-                                  'message': 'The filter did not return '
-                                             'a single asset'})
+    if multi:
+        db_response = ABELLDB.delete_assets(
+            asset_type, multi_write_filter(asset_type, asset_filter),
+            current_app.config.get('MULTI_WRITE_BATCH_SIZE', 1000))
+        if not db_response.get('success'):
+            response_dict.update({'error': 500,
+                                  'message': db_response.get('error')})
             return response_dict
-    db_response = ABELLDB.delete_assets(asset_type, asset_filter)
-    if db_response.get('success'):
-        for a in assets_to_delete:
-            asset_id = a.get('abell_id')
-            response_dict['deleted_asset_ids'].append(asset_id)
-        response_dict.update({'success': True})
-    # TODO Probably convert to a bulk find and update call
-    # TODO Log updated documents
+        response_dict.update({'success': True,
+                              'deleted_asset_ids': db_response.get('result')})
+        return response_dict
+
+    r = single_asset_filter(asset_type, asset_filter)
+    if not r.get('success'):
+        response_dict.update({'error': r.get('error', 500),
+                              'message': r.get('message')})
+        return response_dict
+    delete_filter, abell_id = r.get('result')
+    if delete_filter is not None:
+        db_response = ABELLDB.delete_one_asset(asset_type, delete_filter)
+        if not db_response.get('success'):
+            response_dict.update({'error': 500,
+                                  'message': db_response.get('message')})
+            return response_dict
+        abell_id = db_response.get('result')
+    if delete_filter is None or abell_id is None:
+        response_dict.update({'error': 400,
+                              'message': 'The filter did not return '
+                                         'a single asset'})
+        return response_dict
+    response_dict.update({'success': True,
+                          'deleted_asset_ids': [abell_id]})
+    # TODO Log deleted documents
     return response_dict
 
 
-def asset_find(asset_type, params, specified_keys=None):
-    return ABELLDB.asset_find(asset_type, params, specified_keys)
+def invalid_asset(ato, data):
+    """Returns why data is not a valid new asset of the type, or None."""
+    if type(data) is not dict:
+        return 'Asset must be a dict'
+    missing = [k for k in AT.AbellAssetType.SYSTEM_KEYS if k not in data]
+    if missing:
+        return 'Missing required fields %s' % missing
+    if data.get('type') != ato.asset_type:
+        return 'Type must be %s' % ato.asset_type
+    return None
+
+
+def insert_assets(ato, assets, chunk_size=1000):
+    """Validates and inserts many assets of one type.
+
+    Every asset is checked against the given AbellAssetType, the valid ones
+    are written with unordered insert_many calls of chunk_size assets.
+    Args:
+        ato (AbellAssetType): Type all the assets must belong to
+        assets (list): Asset dicts as sent to POST /v1/asset
+        chunk_size (int): Assets per insert_many call
+    Returns:
+        Response dict: {'success': bool, 'created': [abell_id],
+                        'duplicates': [abell_id], 'rejected': [dict]}
+    """
+    response_dict = {'success': False,
+                     'created': [],
+                     'duplicates': [],
+                     'rejected': []}
+    valid_assets = []
+    for index, data in enumerate(assets):
+        message = invalid_asset(ato, data)
+        if message:
+            response_dict['rejected'].append(
+                {'index': index,
+                 'abell_id': (data.get('abell_id') if type(data) is dict
+                              else None),
+                 'message': message})
+            continue
+        new_asset = AbellAsset(ato.asset_type, data.get('abell_id'), data,
+                               ato)
+        valid_assets.append((index, new_asset.fields))
+
+    for start in range(0, len(valid_assets), chunk_size):
+        chunk = valid_assets[start:start + chunk_size]
+        db_response = ABELLDB.add_new_assets(ato.asset_type,
+                                             [fields for _, fields in chunk])
+        duplicates = set(db_response.get('duplicates', []))
+        errors = db_response.get('errors', {})
+        for position, (index, fields) in enumerate(chunk):
+            abell_id = fields.get('abell_id')
+            if not db_response.get('success'):
+                response_dict['rejected'].append(
+                    {'index': index, 'abell_id': abell_id,
+                     'message': db_response.get('message')})
+            elif position in duplicates:
+                response_dict['duplicates'].append(abell_id)
+            elif position in errors:
+                response_dict['rejected'].append(
+                    {'index': index, 'abell_id': abell_id,
+                     'message': errors[position]})
+            else:
+                response_dict['created'].append(abell_id)
+    response_dict['success'] = True
+    return response_dict
+
+
+NONE_VALUES = [None, 'None']
+
+
+def sparse_filter(params):
+    """Rewrites a filter so 'None' also matches keys an asset does not store.
+
+    Sparse assets leave unset keys out instead of storing 'None', so
+    equality and $ne on 'None' become $in and $nin on both values.
+    """
+    rewritten = {}
+    for key, value in params.items():
+        if key in ('$and', '$or', '$nor') and type(value) is list:
+            value = [sparse_filter(v) if type(v) is dict else v
+                     for v in value]
+        elif value == 'None':
+            value = {'$in': NONE_VALUES}
+        elif type(value) is dict:
+            value = dict(value)
+            if value.get('$eq') == 'None':
+                del value['$eq']
+                value['$in'] = list(value.get('$in', [])) + NONE_VALUES
+            if value.get('$ne') == 'None':
+                del value['$ne']
+                value['$nin'] = list(value.get('$nin', [])) + NONE_VALUES
+            for op in ('$in', '$nin'):
+                values = value.get(op)
+                if (type(values) is list and 'None' in values and
+                        None not in values):
+                    value[op] = values + [None]
+        rewritten[key] = value
+    return rewritten
+
+
+def sparse_type(asset_type):
+    """Returns the AbellAssetType if the type uses sparse storage."""
+    ato = AT.get_asset_type(asset_type)
+    if ato and ato.sparse:
+        return ato
+    return None
+
+
+def asset_find(asset_type, params, specified_keys=None, sort=None, limit=0,
+               cache=False, generation=None, read_preference=None,
+               encode=None):
+    ato = sparse_type(asset_type)
+
+    def run_query():
+        if not ato:
+            return ABELLDB.asset_find(asset_type, params, specified_keys,
+                                      sort, limit, read_preference)
+        db_response = ABELLDB.asset_find(asset_type, sparse_filter(params),
+                                         specified_keys, sort, limit,
+                                         read_preference)
+        if db_response.get('success'):
+            db_response['result'] = [
+                ato.fill_defaults(document, specified_keys)
+                for document in db_response.get('result')]
+        return db_response
+    if cache:
+        return cached_query('find', asset_type,
+                            (params, specified_keys, sort, limit), run_query,
+                            generation, encode)
+    return run_query()
+
+
+def asset_stream(asset_type, params, specified_keys=None, sort=None,
+                 limit=0, raw=False, read_preference=None):
+    # result is a lazy cursor, documents are fetched while iterating. raw
+    # asks for RawBSONDocuments, sparse types still need decoding to be
+    # filled and always return dicts
+    ato = sparse_type(asset_type)
+    if not ato:
+        return ABELLDB.asset_cursor(asset_type, params, specified_keys, sort,
+                                    limit, raw, read_preference)
+    db_response = ABELLDB.asset_cursor(asset_type, sparse_filter(params),
+                                       specified_keys, sort, limit,
+                                       read_preference=read_preference)
+    if db_response.get('success'):
+        cursor = db_response.get('result')
+        db_response['result'] = (ato.fill_defaults(document, specified_keys)
+                                 for document in cursor)
+    return db_response
+
+
+def distinct_asset_fields(asset_type, params, distinct_key, cache=False,
+                          generation=None, read_preference=None,
+                          encode=None):
+    distinct_key = str(distinct_key)
+    ato = sparse_type(asset_type)
+
+    def run_query():
+        if not ato:
+            return ABELLDB.asset_distinct(asset_type, params, distinct_key,
+                                          read_preference)
+        query_filter = sparse_filter(params)
+        db_response = ABELLDB.asset_distinct(asset_type, query_filter,
+                                             distinct_key, read_preference)
+        values = db_response.get('result')
+        if (not db_response.get('success') or 'None' in values or
+                distinct_key.split('.')[0] not in ato.all_keys()):
+            return db_response
+        # assets without the key read back as 'None'
+        missing = ABELLDB.asset_find(
+            asset_type,
+            {'$and': [query_filter, {distinct_key: {'$exists': False}}]},
+            {'_id': 1}, limit=1, read_preference=read_preference)
+        if not missing.get('success'):
+            return missing
+        if missing.get('result'):
+            db_response['result'] = values + ['None']
+        return db_response
+    if cache:
+        return cached_query('distinct', asset_type,
+                            (params, distinct_key), run_query, generation,
+                            encode)
+    return run_query()
+
 
+def asset_count(asset_type, params, cache=False, generation=None,
+                read_preference=None, encode=None):
+    ato = sparse_type(asset_type)
 
-def distinct_asset_fields(asset_type, params, distinct_key):
-    return ABELLDB.asset_distinct(asset_type, params, str(distinct_key))
+    def run_query():
+        if ato:
+            return ABELLDB.asset_count(asset_type, sparse_filter(params),
+                                       read_preference)
+        return ABELLDB.asset_count(asset_type, params, read_preference)
+    if cache:
+        return cached_query('count', asset_type, (params,), run_query,
+                            generation, encode)
+    return run_query()
 
 
-def asset_count(asset_type, params):
-    return ABELLDB.asset_count(asset_type, params)
+def export_assets(ato, batch_size=1000):
+    """Snapshot iterator over every asset of a type, in abell_id order."""
+    db_response = ABELLDB.asset_snapshot(ato.asset_type, batch_size)
+    if db_response.get('success') and ato.sparse:
+        documents = db_response['result']['documents']
+        db_response['result']['documents'] = (
+            ato.fill_defaults(document) for document in documents)
+    return db_response
 
 
 class AbellAsset(object):
@@ -136,17 +663,22 @@ class AbellAsset(object):
         return getattr(self, name)
 
     def __create_fields(self):
+        self.valid_keys = self.asset_type_object.all_keys()
         self.fields.update(dict.fromkeys(
                     self.asset_type_object.system_keys, 'None'))
+        if self.asset_type_object.sparse:
+            # unset keys are filled in on read
+            return
         self.fields.update(dict.fromkeys(
                     self.asset_type_object.managed_keys, 'None'))
         self.fields.update(dict.fromkeys(
                     self.asset_type_object.unmanaged_keys, 'None'))
 
     def update_keys(self, property_dict):
-        stringified_dict = model_tools.item_stringify(property_dict)
+        # property_dict belongs to the caller, often the request body
+        stringified_dict = model_tools.stringify(property_dict)
         for key, value in stringified_dict.items():
-            if key in self.fields:
+            if key in self.valid_keys:
                 self.fields[key] = value
 
     def stringified_attributes(self):
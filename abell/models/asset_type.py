@@ -1,16 +1,144 @@
+import threading
+import time
+from flask import current_app
+from abell.cache import LRUCache
 from abell.database import AbellDb
+from abell.models import migration
 
 
 ABELLDB = AbellDb()
 
 
+class AssetTypeCache(LRUCache):
+    """Process local cache of AbellAssetType objects.
+
+    Every schema change bumps the version counter of the type in assetinfo.
+    At most once every check_interval seconds the cached versions are
+    compared against the db in a single query, so changes made by other
+    worker processes are picked up without a lookup per request.
+    """
+
+    def __init__(self, maxsize=256, ttl=300, check_interval=1):
+        super(AssetTypeCache, self).__init__(maxsize, ttl,
+                                             config_prefix='ASSET_TYPE_CACHE')
+        self.check_interval = check_interval
+        self.checked_at = 0
+        self.version_checks = 0
+
+    def init_app(self, app):
+        super(AssetTypeCache, self).init_app(app)
+        self.check_interval = app.config.get(
+            'ASSET_TYPE_CACHE_CHECK_INTERVAL', self.check_interval)
+        self.checked_at = 0
+        self.version_checks = 0
+
+    def sync_versions(self):
+        now = time.time()
+        if now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        cached_types = self.keys()
+        if not cached_types:
+            return
+        self.version_checks += 1
+        db_response = ABELLDB.get_asset_type_versions(cached_types)
+        versions = db_response.get('result')
+        if not db_response.get('success'):
+            # Unable to verify anything, drop it all
+            versions = {}
+        for asset_type in cached_types:
+            cached = self.peek(asset_type)
+            if cached and cached.version != versions.get(asset_type):
+                self.invalidate(asset_type)
+
+    def stats(self):
+        stats = super(AssetTypeCache, self).stats()
+        stats.update({'check_interval': self.check_interval,
+                      'version_checks': self.version_checks})
+        return stats
+
+
+ASSET_TYPE_CACHE = AssetTypeCache()
+
+
 def get_asset_type(asset_type):
-    # need to cache this!
+    ASSET_TYPE_CACHE.sync_versions()
+    cached = ASSET_TYPE_CACHE.get(asset_type)
+    if cached:
+        return cached.copy()
     db_response = ABELLDB.get_asset_type_info(asset_type).get('result')
     if not db_response:
         return None
-    asset_type = AbellAssetType(asset_type, asset_info=db_response)
-    return asset_type
+    abell_asset_type = AbellAssetType(asset_type, asset_info=db_response)
+    ASSET_TYPE_CACHE.set(asset_type, abell_asset_type)
+    # callers mutate the keys, never hand out the cached object
+    return abell_asset_type.copy()
+
+
+def warm_cache():
+    """Loads asset types into the cache, up to its size.
+
+    Returns:
+        int: Number of cached types
+    """
+    db_response = ABELLDB.get_asset_types(limit=ASSET_TYPE_CACHE.maxsize)
+    for asset_info in db_response.get('result') or []:
+        asset_type = asset_info.get('type')
+        ASSET_TYPE_CACHE.set(asset_type,
+                             AbellAssetType(asset_type, asset_info=asset_info))
+    return len(db_response.get('result') or [])
+
+
+def index_name(keys):
+    # same name pymongo gives an ascending index on these keys
+    return '_'.join('%s_1' % k for k in keys)
+
+
+def change_indexes(asset_type, create=None, drop=None):
+    """Creates and drops secondary indexes of an asset type.
+
+    Builds run in a background thread unless INDEX_BUILD_BACKGROUND is
+    off. Progress is kept in the assetinfo document so any process can
+    report it.
+    Args:
+        asset_type (str): Asset type owning the collection
+        create (list): Lists of keys to build compound indexes on
+        drop (list): Lists of keys of indexes to drop
+    """
+    create = create or []
+    drop = drop or []
+    for keys in create:
+        ABELLDB.set_index_status(asset_type, index_name(keys), 'building')
+    for keys in drop:
+        ABELLDB.set_index_status(asset_type, index_name(keys), 'dropping')
+    app = current_app._get_current_object()
+    if not app.config.get('INDEX_BUILD_BACKGROUND', True):
+        _run_index_changes(app, asset_type, create, drop)
+        return
+    thread = threading.Thread(target=_run_index_changes,
+                              args=(app, asset_type, create, drop))
+    thread.daemon = True
+    thread.start()
+
+
+def _run_index_changes(app, asset_type, create, drop):
+    with app.app_context():
+        for keys in drop:
+            name = index_name(keys)
+            r = ABELLDB.drop_asset_index(asset_type, name)
+            if r.get('success'):
+                ABELLDB.set_index_status(asset_type, name, None)
+            else:
+                ABELLDB.set_index_status(asset_type, name, 'failed',
+                                         r.get('message'))
+        for keys in create:
+            name = index_name(keys)
+            r = ABELLDB.create_asset_index(asset_type, keys, name)
+            if r.get('success'):
+                ABELLDB.set_index_status(asset_type, name, 'ready')
+            else:
+                ABELLDB.set_index_status(asset_type, name, 'failed',
+                                         r.get('message'))
 
 
 class AbellAssetType(object):
@@ -23,34 +151,116 @@ class AbellAssetType(object):
         self.managed_keys = set(asset_info.get('managed_keys', []))
         self.unmanaged_keys = set(asset_info.get('unmanaged_keys', []))
         self.system_keys = set(asset_info.get('system_keys', self.SYSTEM_KEYS))
+        self.version = asset_info.get('version', 0)
+        self.indexed_keys = [list(k) for k in
+                             asset_info.get('indexed_keys', [])]
+        # None until create_new_type applies SPARSE_STORAGE_DEFAULT
+        self.sparse = asset_info.get('sparse')
 
     def key_dict(self):
         return {'type': self.asset_type,
                 'managed_keys': list(self.managed_keys),
                 'unmanaged_keys': list(self.unmanaged_keys),
-                'system_keys': list(self.system_keys)}
+                'system_keys': list(self.system_keys),
+                'indexed_keys': [list(k) for k in self.indexed_keys],
+                'sparse': bool(self.sparse)}
+
+    def all_keys(self):
+        return self.managed_keys.union(self.unmanaged_keys, self.system_keys)
+
+    def fill_defaults(self, document, specified_keys=None):
+        """Returns an asset of a sparse type in its full shape.
+
+        Sparse assets only store the keys that were set, every other key of
+        the type is added with the 'None' default. Keys removed from the
+        type but not yet unset by the migration are left out.
+        Args:
+            document (dict): Asset as stored in the db
+            specified_keys (dict): Projection the asset was read with
+        Returns:
+            dict: The filled asset
+        """
+        keys = self.all_keys()
+        if specified_keys:
+            included = set(k.split('.')[0] for k, v in specified_keys.items()
+                           if v and k != '_id')
+            if included:
+                keys = keys.intersection(included)
+            else:
+                keys = keys.difference(specified_keys)
+        filled = dict.fromkeys(keys, 'None')
+        filled.update((k, v) for k, v in document.items()
+                      if k in keys or k == '_id')
+        return filled
+
+    def normalize_indexed_keys(self, indexed_keys):
+        """Validates a user provided indexed_keys list.
+
+        Each entry is a key name or a list of key names for a compound
+        index. Every key must belong to the type.
+        Returns:
+            Response dict: {'success': bool, 'indexed_keys': list,
+                            'message': str}
+        """
+        all_keys = self.all_keys()
+        normalized = []
+        for entry in indexed_keys:
+            keys = [entry] if isinstance(entry, str) else entry
+            if (not isinstance(keys, list) or not keys or
+                    not all(isinstance(k, str) for k in keys)):
+                return {'success': False, 'error': 400,
+                        'message': 'indexed_keys entries must be a key or '
+                                   'a list of keys'}
+            unknown = set(keys).difference(all_keys)
+            if unknown:
+                return {'success': False, 'error': 400,
+                        'message': 'Cannot index unknown keys %s'
+                                   % sorted(unknown)}
+            # abell_id already has its unique index
+            if keys == ['abell_id'] or keys in normalized:
+                continue
+            normalized.append(keys)
+        return {'success': True, 'indexed_keys': normalized}
+
+    def index_status(self):
+        """Returns the build state of each declared index by name."""
+        if not self.indexed_keys:
+            return {}
+        states = ABELLDB.get_index_status(self.asset_type).get('result') or {}
+        return dict((index_name(k), states.get(index_name(k), 'unknown'))
+                    for k in self.indexed_keys)
+
+    def copy(self):
+        asset_info = self.key_dict()
+        asset_info['version'] = self.version
+        return AbellAssetType(self.asset_type, asset_info=asset_info)
 
     def __update_database(self, case, **kwargs):
+        # Any change to the type makes the cached copy stale. The copy is
+        # dropped once the type is written, dropping it before would let a
+        # concurrent request cache the old type again
         if case is 'new_keys':
             new_keys = kwargs.get('new_keys')
             update_dict = {'managed_keys': list(self.managed_keys)}
             db_resp = ABELLDB.update_managed_vars(self.asset_type, update_dict)
-            if not db_resp.get('success'):
+            ASSET_TYPE_CACHE.invalidate(self.asset_type)
+            if not db_resp.get('success') or self.sparse:
+                # sparse assets get the default on read, nothing to write
                 return db_resp
-            db_resp = ABELLDB.add_new_key_all_assets(self.asset_type,
-                                                     list(new_keys))
+            db_resp = migration.start_migration(self.asset_type,
+                                                new_keys=new_keys)
             return db_resp
 
         elif case is 'new_type':
-            update_dict = {'type': self.asset_type,
-                           'managed_keys': list(self.managed_keys),
-                           'unmanaged_keys': list(self.unmanaged_keys),
-                           'system_keys': list(self.system_keys)}
-            db_resp = ABELLDB.add_new_asset_type(update_dict)
+            db_resp = ABELLDB.add_new_asset_type(self.key_dict())
+            ASSET_TYPE_CACHE.invalidate(self.asset_type)
+            if db_resp.get('success') and self.indexed_keys:
+                change_indexes(self.asset_type, create=self.indexed_keys)
             return db_resp
 
         elif case is 'delete_type':
             db_resp = ABELLDB.delete_asset_type(self.asset_type)
+            ASSET_TYPE_CACHE.invalidate(self.asset_type)
             return db_resp
 
         elif case is 'update_type':
@@ -58,18 +268,22 @@ class AbellAssetType(object):
             removed_keys = kwargs.get('removed_keys')
             # update type
             db_resp = ABELLDB.update_asset_type(self.key_dict())
+            ASSET_TYPE_CACHE.invalidate(self.asset_type)
             if not db_resp.get('success'):
                 return db_resp
-            # add new keys
-            if new_keys:
-                db_resp = ABELLDB.add_new_key_all_assets(self.asset_type,
-                                                         list(new_keys))
-                if not db_resp.get('success'):
-                    return db_resp
-            # remove keys
-            if removed_keys:
-                db_resp = ABELLDB.delete_key_all_assets(self.asset_type,
-                                                        list(removed_keys))
+            # secondary indexes
+            new_indexes = kwargs.get('new_indexes')
+            dropped_indexes = kwargs.get('dropped_indexes')
+            if new_indexes or dropped_indexes:
+                change_indexes(self.asset_type, create=new_indexes,
+                               drop=dropped_indexes)
+            # add and remove keys on every asset in the background
+            if self.sparse:
+                new_keys = None
+            if new_keys or removed_keys:
+                db_resp = migration.start_migration(self.asset_type,
+                                                    new_keys=new_keys,
+                                                    removed_keys=removed_keys)
             return db_resp
 
         return {'success': False}
@@ -86,7 +300,8 @@ class AbellAssetType(object):
         self.managed_keys.update(new_keys)
         r = self.__update_database('new_keys', new_keys=list(new_keys))
         if r.get('success'):
-            return {'success': True, 'new_keys': new_keys}
+            return {'success': True, 'new_keys': new_keys,
+                    'migration_id': r.get('result')}
         return r
 
     def create_new_type(self, managed_keys=None, unmanaged_keys=None):
@@ -102,6 +317,13 @@ class AbellAssetType(object):
 
         self.managed_keys.update(managed_keys)
         self.unmanaged_keys.update(unmanaged_keys)
+        if self.sparse is None:
+            self.sparse = current_app.config.get('SPARSE_STORAGE_DEFAULT',
+                                                 False)
+        r = self.normalize_indexed_keys(self.indexed_keys)
+        if not r.get('success'):
+            return r
+        self.indexed_keys = r.get('indexed_keys')
         r = self.__update_database('new_type')
         return r
         # log & posible hooks
@@ -121,7 +343,7 @@ class AbellAssetType(object):
                 'resubmit this call' % self.asset_type}
 
     def update_keys(self, remove_keys=None, managed_keys=None,
-                    unmanaged_keys=None):
+                    unmanaged_keys=None, indexed_keys=None):
         if remove_keys is None:
             remove_keys = []
         if managed_keys is None:
@@ -167,11 +389,29 @@ class AbellAssetType(object):
             self.unmanaged_keys.update(unmanaged_update)
             # print(managed_update)
             # update new keys
+        # indexes on removed keys go away, None keeps the current list
+        if indexed_keys is None:
+            indexed_keys = [k for k in self.indexed_keys
+                            if not all_removed_keys.intersection(k)]
+        r = self.normalize_indexed_keys(indexed_keys)
+        if not r.get('success'):
+            return r
+        new_indexes = [k for k in r.get('indexed_keys')
+                       if k not in self.indexed_keys]
+        dropped_indexes = [k for k in self.indexed_keys
+                           if k not in r.get('indexed_keys')]
+        self.indexed_keys = r.get('indexed_keys')
+
         r = self.__update_database('update_type', new_keys=all_new_keys,
-                                   removed_keys=all_removed_keys)
+                                   removed_keys=all_removed_keys,
+                                   new_indexes=new_indexes,
+                                   dropped_indexes=dropped_indexes)
         if r.get('success'):
             return {'success': True,
                     'removed_keys': list(all_removed_keys),
-                    'new_keys': list(all_new_keys)}
+                    'new_keys': list(all_new_keys),
+                    'new_indexes': new_indexes,
+                    'dropped_indexes': dropped_indexes,
+                    'migration_id': r.get('result')}
         return {'success': False,
                 'message': r.get('message', 'Unknown update error')}
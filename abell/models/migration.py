@@ -0,0 +1,145 @@
+import threading
+import time
+import uuid
+from flask import current_app
+from abell.database import AbellDb
+
+
+ABELLDB = AbellDb()
+
+
+def start_migration(asset_type, new_keys=None, removed_keys=None):
+    """Queues a schema migration for all assets of a type.
+
+    New keys are set to 'None' on assets that do not have them yet and
+    removed keys are unset. The job is run in a background thread unless
+    MIGRATION_BACKGROUND is off, jobs of the same type run in the order
+    they were queued.
+    Args:
+        asset_type (str): Asset type to migrate
+        new_keys (list): Keys to add to every asset
+        removed_keys (list): Keys to remove from every asset
+    Returns:
+        Response dict: {'success': bool, 'result': job id}
+    """
+    now = time.time()
+    job = {'type': asset_type,
+           'new_keys': list(new_keys or []),
+           'removed_keys': list(removed_keys or []),
+           'state': 'pending',
+           'last_id': None,
+           'processed': 0,
+           'error': None,
+           'owner': None,
+           'lease_until': 0,
+           'created_at': now,
+           'updated_at': now}
+    r = ABELLDB.add_migration(job)
+    if r.get('success'):
+        run_migrations(asset_type)
+    return r
+
+
+def run_migrations(asset_type, background=None):
+    """Runs the unfinished migrations of a type.
+
+    Jobs left behind by a crashed process are picked up again once their
+    lease has expired and continue after the last migrated asset.
+    """
+    app = current_app._get_current_object()
+    if background is None:
+        background = app.config.get('MIGRATION_BACKGROUND', True)
+    if not background:
+        _run_migrations(app, asset_type)
+        return
+    thread = threading.Thread(target=_run_migrations,
+                              args=(app, asset_type))
+    thread.daemon = True
+    thread.start()
+
+
+def resume_stalled_migrations(asset_type=None):
+    """Restarts unfinished jobs whose runner has gone away."""
+    r = ABELLDB.get_migrations(asset_type=asset_type, unfinished=True)
+    now = time.time()
+    stalled_types = set(job.get('type') for job in r.get('result') or []
+                        if job.get('lease_until', 0) < now)
+    for stalled_type in stalled_types:
+        run_migrations(stalled_type)
+    return list(stalled_types)
+
+
+def _run_migrations(app, asset_type):
+    with app.app_context():
+        owner = uuid.uuid4().hex
+        lease = app.config.get('MIGRATION_LEASE', 60)
+        while True:
+            job = ABELLDB.claim_migration(asset_type, owner, lease)
+            job = job.get('result')
+            if not job:
+                return
+            if not migrate_job(job, owner,
+                               app.config.get('MIGRATION_CHUNK_SIZE', 500),
+                               app.config.get('MIGRATION_RATE_LIMIT', 0),
+                               lease):
+                return
+
+
+def migrate_job(job, owner, chunk_size=500, rate_limit=0, lease=60):
+    """Migrates the assets of a claimed job in _id ordered chunks.
+
+    Progress is recorded after every chunk, which also renews the lease.
+    Args:
+        job (dict): Migration job document
+        owner (str): Runner id the job was claimed with
+        chunk_size (int): Assets per update
+        rate_limit (int): Max assets per second, 0 for no limit
+        lease (int): Seconds the claim is renewed for after every chunk
+    Returns:
+        bool: True if the job finished
+    """
+    asset_type = job.get('type')
+    last_id = job.get('last_id')
+    processed = job.get('processed', 0)
+    while True:
+        started = time.time()
+        r = ABELLDB.asset_id_chunk(asset_type, last_id, chunk_size)
+        ids = r.get('result')
+        if r.get('success') and ids:
+            r = ABELLDB.migrate_assets(asset_type, ids,
+                                       job.get('new_keys'),
+                                       job.get('removed_keys'))
+        if not r.get('success'):
+            ABELLDB.update_migration(job.get('_id'), owner,
+                                     {'state': 'failed',
+                                      'error': r.get('message'),
+                                      'lease_until': 0})
+            return False
+        if not ids:
+            ABELLDB.update_migration(job.get('_id'), owner,
+                                     {'state': 'done', 'lease_until': 0})
+            return True
+
+        last_id = ids[-1]
+        processed += len(ids)
+        r = ABELLDB.update_migration(job.get('_id'), owner,
+                                     {'last_id': last_id,
+                                      'processed': processed,
+                                      'lease_until': time.time() + lease})
+        if not r.get('result'):
+            # lease lost to another runner
+            return False
+        if rate_limit:
+            pause = float(len(ids)) / rate_limit - (time.time() - started)
+            if pause > 0:
+                time.sleep(pause)
+
+
+def job_status(job):
+    """JSON friendly view of a migration job document."""
+    status = dict(job)
+    status['id'] = str(status.pop('_id', ''))
+    if status.get('last_id') is not None:
+        status['last_id'] = str(status['last_id'])
+    status.pop('owner', None)
+    return status
@@ -1,3 +1,67 @@
+# type -> shallow copy function for the containers stringify walks into.
+# Exact types only, like the type() checks of the legacy helpers, any
+# other value is passed to str().
+CONTAINER_COPIES = {dict: dict, list: list}
+
+
+def stringify(item):
+    """Returns a copy of item with every value converted to a string.
+
+    The input is left untouched, item_stringify converts in place and is
+    faster where that does not matter. Each dict and list is shallow
+    copied and its values are converted on the copy, the copy function
+    comes from CONTAINER_COPIES. A flat dict costs a single pass, nested
+    containers are queued on an explicit stack instead of recursing so
+    deep nesting cannot hit the recursion limit. Keys are kept as they
+    are.
+    """
+    copies = CONTAINER_COPIES
+    copy_container = copies.get(type(item))
+    if copy_container is None:
+        return str(item)
+    root = copy_container(item)
+    # flat fast path, no stack unless a value is a container
+    stack = None
+    for key, value in (root.items() if type(root) is dict
+                       else enumerate(root)):
+        value_type = type(value)
+        if value_type is str:
+            continue
+        copy_container = copies.get(value_type)
+        if copy_container is None:
+            root[key] = str(value)
+            continue
+        root[key] = value = copy_container(value)
+        if stack is None:
+            stack = [value]
+        else:
+            stack.append(value)
+    if stack:
+        _stringify_copies(stack)
+    return root
+
+
+def _stringify_copies(stack):
+    # stack holds shallow copies, their values are converted in place and
+    # nested containers are copied in turn and queued
+    copies = CONTAINER_COPIES
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        target = pop()
+        for key, value in (target.items() if type(target) is dict
+                           else enumerate(target)):
+            value_type = type(value)
+            if value_type is str:
+                continue
+            copy_container = copies.get(value_type)
+            if copy_container is None:
+                target[key] = str(value)
+            else:
+                target[key] = value = copy_container(value)
+                push(value)
+
+
 def list_stringify(item):
     list_range = len(item)
     for i in range(0, list_range, 1):
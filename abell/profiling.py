@@ -0,0 +1,167 @@
+import cProfile
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+import tracemalloc
+from flask import g, request
+from abell import metrics
+from abell.api.v1_controller import get_query_params
+from abell.slow_queries import query_shape
+
+
+log = logging.getLogger('abell.profiling')
+
+HEADER = 'X-Abell-Profile'
+
+
+class RequestProfiler(object):
+    """Runs chosen requests under cProfile and writes the stats to disk.
+
+    A request is profiled when PROFILING_ENABLED is set and either its
+    X-Abell-Profile header matches PROFILING_TOKEN or it is one of every
+    PROFILING_SAMPLE_RATE requests. With PROFILING_TRACEMALLOC the biggest
+    allocation differences of the request are saved next to the stats.
+    Only one request per process is profiled at a time, others that would
+    have been are served as usual. Streamed bodies are sent after the
+    profile is written, their encoding is not in it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = itertools.count(1)
+        self._written = itertools.count(1)
+        self.enabled = False
+        self.token = None
+        self.sample_rate = 0
+        self.directory = None
+        self.trace_memory = False
+        self.top_allocations = 25
+
+    def init_app(self, app):
+        self.enabled = app.config.get('PROFILING_ENABLED', False)
+        self.token = app.config.get('PROFILING_TOKEN')
+        self.sample_rate = app.config.get('PROFILING_SAMPLE_RATE', 0)
+        self.directory = app.config.get('PROFILING_DIR', 'profiles')
+        self.trace_memory = app.config.get('PROFILING_TRACEMALLOC', False)
+        self.top_allocations = app.config.get('PROFILING_TOP_ALLOCATIONS',
+                                              self.top_allocations)
+        if not self.enabled:
+            return
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        # requests failing with an exception still release the profiler
+        app.teardown_request(self.release)
+
+    def requested(self):
+        header = request.headers.get(HEADER)
+        return bool(header and self.token and hmac.compare_digest(
+            header.encode('utf-8'), self.token.encode('utf-8')))
+
+    def sampled(self):
+        return bool(self.sample_rate and
+                    next(self._requests) % self.sample_rate == 0)
+
+    def start(self):
+        # cProfile and tracemalloc cannot be shared by two requests
+        if request.endpoint == 'metrics':
+            return
+        requested = self.requested()
+        if not (requested or self.sampled()) or not self._lock.acquire(False):
+            return
+        g.profile = cProfile.Profile()
+        g.profile_requested = requested
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            g.profile_memory = tracemalloc.take_snapshot()
+        g.profile_started = time.perf_counter()
+        g.profile.enable()
+
+    def finish(self, response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+        profile.disable()
+        elapsed = time.perf_counter() - g.profile_started
+        allocations = None
+        before = g.pop('profile_memory', None)
+        if before is not None:
+            after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            allocations = [str(stat) for stat in after.compare_to(
+                before, 'lineno')[:self.top_allocations]]
+        try:
+            name = self.write(profile, elapsed, response.status_code,
+                              allocations)
+            # only admins sending the token learn where it went
+            if g.profile_requested:
+                response.headers[HEADER] = name
+        except (IOError, OSError) as e:
+            log.error('Writing the profile failed: %s', e)
+        finally:
+            self._lock.release()
+        return response
+
+    def release(self, exception=None):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        if g.pop('profile_memory', None) is not None:
+            tracemalloc.stop()
+        self._lock.release()
+
+    def write(self, profile, elapsed, status, allocations=None):
+        """Saves the stats as <name>.prof and what was run as <name>.json.
+
+        The name starts with the route and a hash of the query shape, so
+        profiles of the same kind of request sort together, then the time,
+        the process id and a count.
+        Returns:
+            str: The name
+        """
+        route = metrics.route_name()
+        shape = request_shape()
+        shape_json = json.dumps(shape, sort_keys=True)
+        name = '%s-%s-%s-%d-%d' % (
+            re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_'),
+            hashlib.sha1(shape_json.encode('utf-8')).hexdigest()[:8],
+            time.strftime('%Y%m%dT%H%M%S'), os.getpid(),
+            next(self._written))
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, name)
+        profile.dump_stats(path + '.prof')
+        with open(path + '.json', 'w') as f:
+            json.dump({'route': route,
+                       'path': request.path,
+                       'shape': shape,
+                       'status': status,
+                       'elapsed_ms': round(elapsed * 1000, 3),
+                       'allocations': allocations}, f, indent=2)
+        log.info('Profiled %s in %.1fms to %s', route, elapsed * 1000, path)
+        return name
+
+
+def request_shape():
+    """Query shape of the request arguments, as the slow query log keys it.
+
+    Filter values are replaced with '?', the limit, paging and key options
+    keep only their names.
+    """
+    r = get_query_params(request.args)
+    if not r.get('success'):
+        return {'invalid': sorted(request.args.keys())}
+    shape = {'filter': query_shape(r.get('params'))}
+    shape.update((option, '?') for option in
+                 ('distinct_key', 'limit', 'after', 'specified_keys')
+                 if option in request.args)
+    return shape
+
+
+PROFILER = RequestProfiler()
@@ -0,0 +1,90 @@
+import argparse
+import multiprocessing
+from abell import config as abell_config, create_app
+from abell.models import asset_type
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+
+# Connections kept on top of one per request thread, for the migration
+# and index build threads
+POOL_HEADROOM = 4
+
+
+def pool_size(threads):
+    return threads + POOL_HEADROOM
+
+
+def default_workers():
+    return multiprocessing.cpu_count() * 2 + 1
+
+
+def serve_config(config, threads):
+    """Config for the workers, the pool is sized for the thread count."""
+    if getattr(config, 'MONGO_MAX_POOL_SIZE', None):
+        return config
+    return type(config.__name__, (config,),
+                {'MONGO_MAX_POOL_SIZE': pool_size(threads)})
+
+
+def warm_worker(worker):
+    """gunicorn post_worker_init hook, fills the asset type cache."""
+    with worker.wsgi.app_context():
+        count = asset_type.warm_cache()
+    worker.log.info('Cached %d asset types', count)
+
+
+def serve(config, bind=None, workers=None, threads=None, timeout=None):
+    """Runs abell under gunicorn with pre-forked threaded workers.
+
+    The app is loaded in each worker after the fork, never in the master,
+    so every worker creates its own MongoClient as PyMongo is not fork
+    safe.
+    """
+    if BaseApplication is None:
+        raise RuntimeError('manage.py serve needs gunicorn, '
+                           'pip install gunicorn')
+    threads = threads or getattr(config, 'SERVE_THREADS', 8)
+    options = {
+        'bind': bind or getattr(config, 'SERVE_BIND', '0.0.0.0:6000'),
+        'workers': (workers or getattr(config, 'SERVE_WORKERS', None) or
+                    default_workers()),
+        'threads': threads,
+        'worker_class': 'gthread',
+        'timeout': timeout or getattr(config, 'SERVE_TIMEOUT', 60),
+        'preload_app': False,
+        'post_worker_init': warm_worker}
+    worker_config = serve_config(config, threads)
+
+    class AbellApplication(BaseApplication):
+
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return create_app(worker_config)
+
+    AbellApplication().run()
+
+
+def main(argv=None):
+    """manage.py serve, parsed without flask_script.
+
+    flask_script creates the app before it runs any command, the gunicorn
+    master would then hold a MongoClient when it forks the workers.
+    """
+    parser = argparse.ArgumentParser(
+        prog='manage.py serve',
+        description='Runs the production server, needs gunicorn')
+    parser.add_argument('-b', '--bind', default=None,
+                        help='host:port to listen on')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Worker processes')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Request threads per worker')
+    args = parser.parse_args(argv)
+    serve(abell_config.base_config, bind=args.bind, workers=args.workers,
+          threads=args.threads)
@@ -0,0 +1,163 @@
+import json
+import logging
+import threading
+import time
+from abell.cache import LRUCache
+
+
+log = logging.getLogger('abell.slow_queries')
+
+
+def query_shape(value):
+    """Replaces every value of a filter with '?', keeping keys and operators.
+
+    Lists of clauses, as in $and or $or, keep their shape, any other list
+    is a single value.
+    """
+    if isinstance(value, dict):
+        return dict((k, query_shape(v)) for k, v in value.items())
+    if (isinstance(value, list) and value and
+            all(isinstance(v, dict) for v in value)):
+        return [query_shape(v) for v in value]
+    return '?'
+
+
+def plan_summary(explain):
+    """Stages, indexes and counters of an executionStats explain."""
+    winning = explain.get('queryPlanner', {}).get('winningPlan', {})
+    # the slot based engine nests the classic plan
+    stack = [winning.get('queryPlan', winning)]
+    stages = []
+    indexes = []
+    while stack:
+        stage = stack.pop()
+        if stage.get('stage'):
+            stages.append(stage['stage'])
+        if stage.get('indexName'):
+            indexes.append(stage['indexName'])
+        if 'inputStage' in stage:
+            stack.append(stage['inputStage'])
+        stack.extend(stage.get('inputStages', []))
+    stats = explain.get('executionStats', {})
+    return {'stages': stages,
+            'indexes': indexes,
+            'collscan': 'COLLSCAN' in stages,
+            'docs_examined': stats.get('totalDocsExamined'),
+            'keys_examined': stats.get('totalKeysExamined'),
+            'returned': stats.get('nReturned')}
+
+
+class SlowQueryLog(LRUCache):
+    """Find, count and distinct calls slower than threshold_ms, by shape.
+
+    Entries are keyed on asset type, operation and query shape and keep
+    timing totals. The first slow call of a shape, and the next one once
+    explain_interval seconds have passed, is explained so the entry shows
+    its plan and whether it scanned the whole collection. The explain runs
+    the query again, it is done in a background thread unless background
+    is off so the slow request does not wait for it.
+    """
+
+    def __init__(self, maxsize=500, threshold_ms=100, explain_interval=60,
+                 background=True):
+        super(SlowQueryLog, self).__init__(maxsize,
+                                           config_prefix='SLOW_QUERY_LOG')
+        self.threshold_ms = threshold_ms
+        self.explain_interval = explain_interval
+        self.background = background
+        self._update_lock = threading.Lock()
+
+    def init_app(self, app):
+        super(SlowQueryLog, self).init_app(app)
+        self.threshold_ms = app.config.get('SLOW_QUERY_MS',
+                                           self.threshold_ms)
+        self.explain_interval = app.config.get('SLOW_QUERY_EXPLAIN_INTERVAL',
+                                               self.explain_interval)
+        self.background = app.config.get('SLOW_QUERY_EXPLAIN_BACKGROUND',
+                                         self.background)
+
+    def check(self, operation, asset_type, query, started, returned,
+              explain):
+        """Records the query if it took longer than the threshold.
+
+        Args:
+            operation (str): find, count or distinct
+            asset_type (str): Collection the query ran on
+            query (dict): filter, plus the sort keys or the distinct key.
+                Only the filter values are replaced in the shape
+            started (float): time.perf_counter() before the query ran
+            returned (int): Documents or values returned
+            explain (callable): Returns the AbellDb.explain_query response
+        """
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if not self.threshold_ms or elapsed_ms < self.threshold_ms:
+            return
+        shape = dict(query)
+        shape['filter'] = query_shape(query.get('filter') or {})
+        key = (asset_type, operation, json.dumps(shape, sort_keys=True))
+        now = time.time()
+        with self._update_lock:
+            entry = self.peek(key)
+            if entry is None:
+                entry = {'asset_type': asset_type,
+                         'operation': operation,
+                         'shape': shape,
+                         'count': 0,
+                         'total_ms': 0.0,
+                         'max_ms': 0.0,
+                         'plan': None,
+                         'explained_at': None}
+            entry['count'] += 1
+            entry['total_ms'] += elapsed_ms
+            entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+            entry.update({'last_ms': elapsed_ms,
+                          'last_returned': returned,
+                          'last_seen': now})
+            needs_plan = (entry['explained_at'] is None or
+                          now - entry['explained_at'] >=
+                          self.explain_interval)
+            if needs_plan:
+                entry['explained_at'] = now
+            self.set(key, entry)
+        plan = entry['plan'] or {}
+        log.warning('Slow %s on %s took %.1fms, returned %s, examined %s, '
+                    'collscan %s: %s', operation, asset_type, elapsed_ms,
+                    returned, plan.get('docs_examined'),
+                    plan.get('collscan'), key[2])
+        if not needs_plan:
+            return
+        if not self.background:
+            self.explain(entry, explain)
+            return
+        thread = threading.Thread(target=self.explain, args=(entry, explain))
+        thread.daemon = True
+        thread.start()
+
+    def explain(self, entry, explain):
+        db_response = explain()
+        if db_response.get('success'):
+            plan = plan_summary(db_response.get('result'))
+        else:
+            plan = {'error': db_response.get('message')}
+        with self._update_lock:
+            entry['plan'] = plan
+        log.warning('Plan of slow %s on %s: stages %s, examined %s, '
+                    'collscan %s', entry['operation'], entry['asset_type'],
+                    plan.get('stages'), plan.get('docs_examined'),
+                    plan.get('collscan'))
+
+    def worst(self, asset_type=None, limit=10):
+        """Entries by total time, worst first, grouped by asset type."""
+        grouped = {}
+        for key in self.keys():
+            entry = self.peek(key)
+            if entry is None or (asset_type and key[0] != asset_type):
+                continue
+            grouped.setdefault(key[0], []).append(dict(entry))
+        for entries in grouped.values():
+            entries.sort(key=lambda e: e['total_ms'], reverse=True)
+            del entries[limit:]
+        return grouped
+
+
+SLOW_QUERIES = SlowQueryLog()
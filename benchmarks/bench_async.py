@@ -0,0 +1,129 @@
+"""Compares AbellDb on threads with AsyncAbellDb under high concurrency.
+
+Usage: python benchmarks/bench_async.py [-u URI] [-a ASSETS] [-q QUERIES]
+                                        [-c 50,500,2000] [-t THREADS]
+
+Needs a local mongod. ASSETS servers are seeded into a scratch database
+which is dropped afterwards. At every concurrency level QUERIES finds on
+a random cloud are run, by a pool of THREADS threads through AbellDb
+(capped at the level, like a threaded worker) and as concurrent tasks
+through AsyncAbellDb with at most that many in flight.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from pymongo import MongoClient  # noqa: E402
+from abell import config, create_app  # noqa: E402
+from abell.database.async_db import AsyncAbellDb  # noqa: E402
+from abell.models import asset  # noqa: E402
+
+ASSET_TYPE = 'bench_server'
+CLOUDS = ['cloud%02d' % i for i in range(50)]
+
+
+def seed(uri, assets):
+    client = MongoClient(uri)
+    db = client.get_default_database()
+    db[ASSET_TYPE].drop()
+    db[ASSET_TYPE].insert_many(
+        [{'abell_id': 'srv-%06d' % i, 'type': ASSET_TYPE,
+          'cloud': CLOUDS[i % len(CLOUDS)], 'owner': 'ops',
+          'status': 'active'} for i in range(assets)])
+    db[ASSET_TYPE].create_index('cloud')
+    return client
+
+
+def percentile(timings, fraction):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def report(name, concurrency, elapsed, timings, errors):
+    print('%-6s %6d %10.0f %9.2f %9.2f %7d' % (
+        name, concurrency, len(timings) / elapsed,
+        percentile(timings, 0.5) * 1000, percentile(timings, 0.99) * 1000,
+        errors))
+
+
+def run_sync(app, queries, concurrency, threads):
+    def query(cloud):
+        started = time.perf_counter()
+        with app.app_context():
+            result = asset.ABELLDB.asset_find(ASSET_TYPE, {'cloud': cloud},
+                                              {'_id': 0})
+        return time.perf_counter() - started, result.get('success')
+
+    clouds = [random.choice(CLOUDS) for _ in range(queries)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(concurrency, threads)) as pool:
+        results = list(pool.map(query, clouds))
+    elapsed = time.perf_counter() - started
+    report('sync', concurrency, elapsed, [t for t, _ in results],
+           sum(1 for _, ok in results if not ok))
+
+
+async def run_async(db, queries, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def query(cloud):
+        async with semaphore:
+            started = time.perf_counter()
+            result = await db.asset_find(ASSET_TYPE, {'cloud': cloud},
+                                         {'_id': 0})
+            return time.perf_counter() - started, result.get('success')
+
+    clouds = [random.choice(CLOUDS) for _ in range(queries)]
+    started = time.perf_counter()
+    results = await asyncio.gather(*[query(cloud) for cloud in clouds])
+    elapsed = time.perf_counter() - started
+    report('async', concurrency, elapsed, [t for t, _ in results],
+           sum(1 for _, ok in results if not ok))
+
+
+async def async_levels(uri, queries, levels):
+    db = AsyncAbellDb()
+    db.init_app({'MONGO_URI': uri})
+    try:
+        # first query opens the pool
+        await db.asset_count(ASSET_TYPE, {})
+        for concurrency in levels:
+            await run_async(db, queries, concurrency)
+    finally:
+        await db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', '--uri',
+                        default='mongodb://localhost:27017/abell_bench_async')
+    parser.add_argument('-a', '--assets', type=int, default=20000)
+    parser.add_argument('-q', '--queries', type=int, default=5000)
+    parser.add_argument('-c', '--concurrency', default='50,500,2000')
+    parser.add_argument('-t', '--threads', type=int, default=64)
+    args = parser.parse_args()
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    client = seed(args.uri, args.assets)
+    try:
+        app = create_app(type('BenchConfig', (config.base_config,),
+                              {'MONGO_URI': args.uri}))
+        print('%-6s %6s %10s %9s %9s %7s' % (
+            'mode', 'conc', 'queries/s', 'p50 ms', 'p99 ms', 'errors'))
+        for concurrency in levels:
+            run_sync(app, args.queries, concurrency, args.threads)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(async_levels(args.uri, args.queries, levels))
+    finally:
+        client.drop_database(client.get_default_database().name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,440 @@
+"""Throughput and latency of every /api/v1 route against a running server.
+
+Usage: python benchmarks/bench_http.py [-u URL] [-f FLEET] [-s SEED]
+                                       [-c 1,16,64] [-d SECONDS]
+                                       [-r SCENARIO,...] [-o RESULTS.json]
+
+Seed the fleet with benchmarks/fleet.py first and start the server on the
+same database, e.g. python manage.py serve. Every scenario runs for
+SECONDS at each concurrency level. Each level uses one thread and one
+keep-alive connection per concurrent client, after a short warm up that
+is not measured. Requests and errors are counted, and throughput, p50,
+p90, p99 and max latency are written as JSON to compare with compare.py.
+Updates only move the status of seeded assets between the usual
+values, and the create and delete scenarios only touch what the run
+made, so every run queries the same fleet.
+"""
+import argparse
+import datetime
+import http.client
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fleet import CLOUDS, OS_NAMES, STATUSES, Fleet  # noqa: E402
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+
+class Scenario(object):
+    """One route and a way of building its requests.
+
+    build(state, rng) returns (path, body, headers), or None when the
+    scenario has nothing to do, like deleting before anything was created.
+    """
+
+    def __init__(self, name, method, route, build):
+        self.name = name
+        self.method = method
+        self.route = route
+        self.build = build
+
+
+class RunState(object):
+    """Fleet plus what the write scenarios created, shared by threads."""
+
+    def __init__(self, fleet):
+        self.fleet = fleet
+        self.run_id = '%x' % int(time.time())
+        self._lock = threading.Lock()
+        self._counter = 0
+        self.created_assets = []
+        self.created_types = []
+
+    def next_number(self):
+        with self._lock:
+            self._counter += 1
+            return self._counter
+
+    def push(self, items, value):
+        with self._lock:
+            items.append(value)
+
+    def pop(self, items):
+        with self._lock:
+            return items.pop() if items else None
+
+    def random_asset(self, rng, asset_type='bench_server'):
+        number = rng.randrange(self.fleet.counts[asset_type])
+        return self.fleet.asset_id(asset_type, number)
+
+    def new_asset(self, rng):
+        asset_id = 'bench_server-w%s-%d' % (self.run_id, self.next_number())
+        return {'type': 'bench_server', 'abell_id': asset_id,
+                'cloud': rng.choice(CLOUDS), 'owner': 'bench',
+                'os': rng.choice(OS_NAMES)}
+
+
+def query(path, params):
+    """GET builder, params(state, rng) returns the query arguments."""
+    def build(state, rng):
+        return path + '?' + urlencode(params(state, rng)), None, {}
+    return build
+
+
+def fixed(path):
+    return lambda state, rng: (path, None, {})
+
+
+def find_by_cloud(state, rng):
+    return {'type': 'bench_server', 'cloud': rng.choice(CLOUDS),
+            'limit': 100}
+
+
+def find_by_id(state, rng):
+    return {'type': 'bench_server', 'abell_id': state.random_asset(rng)}
+
+
+def count_by_os(state, rng):
+    return {'type': 'bench_server', 'os': rng.choice(OS_NAMES)}
+
+
+def find_by_rack(state, rng):
+    # prefix regex on a key without an index
+    return {'type': 'bench_server', 'rack': '/^r0%d' % rng.randrange(10),
+            'limit': 100}
+
+
+def distinct_os(state, rng):
+    return {'type': 'bench_server', 'cloud': rng.choice(CLOUDS),
+            'distinct_key': 'os'}
+
+
+def ndjson_page(state, rng):
+    path = '/api/v1/asset?' + urlencode({'type': 'bench_switch',
+                                         'cloud': rng.choice(CLOUDS),
+                                         'limit': 1000})
+    return path, None, {'Accept': 'application/x-ndjson'}
+
+
+def update_one(state, rng):
+    return ('/api/v1/asset',
+            {'filter': {'type': 'bench_server',
+                        'abell_id': state.random_asset(rng)},
+             'update': {'status': rng.choice(STATUSES)}},
+            JSON_HEADERS)
+
+
+def update_bulk(state, rng):
+    return ('/api/v1/assets/bulk',
+            [{'filter': {'type': 'bench_server',
+                         'abell_id': state.random_asset(rng)},
+              'update': {'status': rng.choice(STATUSES)}}
+             for _ in range(100)],
+            JSON_HEADERS)
+
+
+def create_one(state, rng):
+    new_asset = state.new_asset(rng)
+    state.push(state.created_assets, new_asset['abell_id'])
+    return '/api/v1/asset', new_asset, JSON_HEADERS
+
+
+def create_bulk(state, rng):
+    new_assets = [state.new_asset(rng) for _ in range(100)]
+    for new_asset in new_assets:
+        state.push(state.created_assets, new_asset['abell_id'])
+    return '/api/v1/assets/bulk', new_assets, JSON_HEADERS
+
+
+def delete_one(state, rng):
+    asset_id = state.pop(state.created_assets)
+    if asset_id is None:
+        return None
+    return ('/api/v1/asset',
+            {'filter': {'type': 'bench_server', 'abell_id': asset_id}},
+            JSON_HEADERS)
+
+
+def create_type(state, rng):
+    name = 'bench_scratch_%s_%d' % (state.run_id, state.next_number())
+    state.push(state.created_types, name)
+    return ('/api/v1/asset_type',
+            {'type': name, 'managed_keys': ['os', 'rack'],
+             'unmanaged_keys': ['notes']},
+            JSON_HEADERS)
+
+
+def update_type(state, rng):
+    with state._lock:
+        if not state.created_types:
+            return None
+        name = rng.choice(state.created_types)
+    return ('/api/v1/asset_type',
+            {'type': name, 'managed_keys': ['os', 'rack',
+                                            'k%d' % state.next_number()]},
+            JSON_HEADERS)
+
+
+def delete_type(state, rng):
+    name = state.pop(state.created_types)
+    if name is None:
+        return None
+    # the type to delete is a query argument, not a body
+    return '/api/v1/asset_type?' + urlencode({'type': name}), None, {}
+
+
+# Writes are ordered so the deletes find what the creates made
+SCENARIOS = [
+    Scenario('find_by_cloud', 'GET', '/api/v1/asset',
+             query('/api/v1/asset', find_by_cloud)),
+    Scenario('find_by_id', 'GET', '/api/v1/asset',
+             query('/api/v1/asset', find_by_id)),
+    Scenario('find_regex', 'GET', '/api/v1/asset',
+             query('/api/v1/asset', find_by_rack)),
+    Scenario('find_ndjson', 'GET', '/api/v1/asset', ndjson_page),
+    Scenario('count', 'GET', '/api/v1/asset/count',
+             query('/api/v1/asset/count', count_by_os)),
+    Scenario('distinct', 'GET', '/api/v1/asset/distinct',
+             query('/api/v1/asset/distinct', distinct_os)),
+    Scenario('asset_type', 'GET', '/api/v1/asset_type',
+             fixed('/api/v1/asset_type?type=bench_switch')),
+    Scenario('export', 'GET', '/api/v1/asset_type/<asset_type>/export',
+             fixed('/api/v1/asset_type/bench_pdu/export')),
+    Scenario('stats', 'GET', '/api/v1/stats', fixed('/api/v1/stats')),
+    Scenario('migrations', 'GET', '/api/v1/migrations',
+             fixed('/api/v1/migrations')),
+    Scenario('slow_queries', 'GET', '/api/v1/admin/slow_queries',
+             fixed('/api/v1/admin/slow_queries')),
+    Scenario('update_one', 'PUT', '/api/v1/asset', update_one),
+    Scenario('update_bulk', 'PUT', '/api/v1/assets/bulk', update_bulk),
+    Scenario('create_one', 'POST', '/api/v1/asset', create_one),
+    Scenario('create_bulk', 'POST', '/api/v1/assets/bulk', create_bulk),
+    Scenario('delete_one', 'DELETE', '/api/v1/asset', delete_one),
+    Scenario('create_type', 'POST', '/api/v1/asset_type', create_type),
+    Scenario('update_type', 'PUT', '/api/v1/asset_type', update_type),
+    Scenario('delete_type', 'DELETE', '/api/v1/asset_type', delete_type),
+]
+
+SCENARIOS_BY_NAME = dict((s.name, s) for s in SCENARIOS)
+
+
+class Connection(http.client.HTTPConnection):
+    """Keep-alive connection with Nagle turned off, like wrk and ab."""
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def connect(url):
+    parts = urlsplit(url)
+    return Connection(parts.hostname, parts.port, timeout=60)
+
+
+def percentile(timings, fraction):
+    # nearest rank on sorted timings
+    if not timings:
+        return None
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def send(connection, scenario, request):
+    path, body, headers = request
+    if body is not None:
+        body = json.dumps(body)
+    connection.request(scenario.method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    response.read()
+    return response.status
+
+
+def client_loop(url, scenario, state, seed, warmup_until, stop_at):
+    """One client on one keep-alive connection, returns its measurements."""
+    connection = connect(url)
+    rng = random.Random(seed)
+    timings = []
+    errors = 0
+    try:
+        while True:
+            now = time.perf_counter()
+            if now >= stop_at:
+                break
+            request = scenario.build(state, rng)
+            if request is None:
+                time.sleep(0.01)
+                continue
+            started = time.perf_counter()
+            try:
+                status = send(connection, scenario, request)
+            except (OSError, http.client.HTTPException):
+                status = None
+                connection.close()
+            elapsed = time.perf_counter() - started
+            if started < warmup_until:
+                continue
+            if status is None or status >= 400:
+                errors += 1
+            else:
+                timings.append(elapsed)
+    finally:
+        connection.close()
+    return timings, errors
+
+
+def run_scenario(url, scenario, state, concurrency, duration, warmup):
+    warmup_until = time.perf_counter() + warmup
+    stop_at = warmup_until + duration
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(client_loop, url, scenario, state,
+                               '%s-%d-%d' % (scenario.name, concurrency, i),
+                               warmup_until, stop_at)
+                   for i in range(concurrency)]
+        results = [future.result() for future in futures]
+    timings = sorted(t for client_timings, _ in results
+                     for t in client_timings)
+    errors = sum(client_errors for _, client_errors in results)
+
+    def ms(seconds):
+        return None if seconds is None else round(seconds * 1000, 3)
+
+    return {'scenario': scenario.name,
+            'route': '%s %s' % (scenario.method, scenario.route),
+            'concurrency': concurrency,
+            'requests': len(timings),
+            'errors': errors,
+            'rps': round(len(timings) / duration, 1),
+            'p50_ms': ms(percentile(timings, 0.5)),
+            'p90_ms': ms(percentile(timings, 0.9)),
+            'p99_ms': ms(percentile(timings, 0.99)),
+            'max_ms': ms(timings[-1] if timings else None)}
+
+
+def check_fleet(url, fleet):
+    """Warns when the server's database does not hold the expected fleet."""
+    connection = connect(url)
+    try:
+        for asset_type, expected in sorted(fleet.counts.items()):
+            connection.request('GET', '/api/v1/asset/count?type=%s'
+                               % asset_type)
+            response = connection.getresponse()
+            body = json.loads(response.read().decode('utf-8'))
+            count = (body.get('payload') or {}).get('count')
+            # the write scenarios of an earlier run may have left a few
+            if count is None or count < expected:
+                print('Warning: %s has %s assets, the %s fleet has %d. Run '
+                      'benchmarks/fleet.py first' % (asset_type, count,
+                                                     fleet.size, expected))
+    finally:
+        connection.close()
+
+
+def cleanup(url, state):
+    """Deletes the assets and types a run created and did not delete.
+
+    Returns:
+        int: Deletes that failed, what they were for is left behind
+    """
+    connection = connect(url)
+    rng = random.Random(0)
+    failed = 0
+    try:
+        for scenario in (SCENARIOS_BY_NAME['delete_one'],
+                         SCENARIOS_BY_NAME['delete_type']):
+            request = scenario.build(state, rng)
+            while request is not None:
+                status = send(connection, scenario, request)
+                if status != 200:
+                    failed += 1
+                    print('Warning: cleanup %s %s returned %d'
+                          % (scenario.method, request[0], status))
+                request = scenario.build(state, rng)
+    finally:
+        connection.close()
+    return failed
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', '--url', default='http://127.0.0.1:6000')
+    parser.add_argument('-f', '--fleet', default='small')
+    parser.add_argument('-s', '--seed', type=int, default=42)
+    parser.add_argument('-c', '--concurrency', default='1,16,64')
+    parser.add_argument('-d', '--duration', type=float, default=10)
+    parser.add_argument('-w', '--warmup', type=float, default=1)
+    parser.add_argument('-r', '--scenarios', default=None,
+                        help='Comma separated scenario names, all by '
+                             'default')
+    parser.add_argument('-o', '--output', default=None)
+    args = parser.parse_args()
+
+    fleet = Fleet(args.fleet, args.seed)
+    levels = [int(level) for level in args.concurrency.split(',')]
+    scenarios = SCENARIOS
+    if args.scenarios:
+        scenarios = [SCENARIOS_BY_NAME[name]
+                     for name in args.scenarios.split(',')]
+    check_fleet(args.url, fleet)
+    state = RunState(fleet)
+    started = datetime.datetime.utcnow()
+    results = []
+    cleanup_failures = None
+    print('%-14s %5s %9s %8s %9s %9s %9s' % (
+        'scenario', 'conc', 'req/s', 'errors', 'p50 ms', 'p99 ms', 'max ms'))
+    try:
+        for scenario in scenarios:
+            for concurrency in levels:
+                result = run_scenario(args.url, scenario, state, concurrency,
+                                      args.duration, args.warmup)
+                results.append(result)
+                print('%-14s %5d %9.1f %8d %9s %9s %9s' % (
+                    scenario.name, concurrency, result['rps'],
+                    result['errors'], result['p50_ms'], result['p99_ms'],
+                    result['max_ms']))
+    finally:
+        cleanup_failures = cleanup(args.url, state)
+
+    output = {'meta': {'started': started.isoformat() + 'Z',
+                       'git_commit': git_commit(),
+                       'url': args.url,
+                       'python': platform.python_version(),
+                       'host': platform.node(),
+                       'cpus': os.cpu_count(),
+                       'duration': args.duration,
+                       'warmup': args.warmup,
+                       'concurrency': levels,
+                       'fleet': fleet.fingerprint(),
+                       'cleanup_failures': cleanup_failures},
+              'results': results}
+    path = args.output or 'bench-%s.json' % started.strftime('%Y%m%d-%H%M%S')
+    with open(path, 'w') as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+    print('Results written to %s' % path)
+    if cleanup_failures:
+        print('Cleanup failed %d times, later runs will not see the same '
+              'database' % cleanup_failures)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+"""Micro benchmarks of the request parsing and model code, no DB needed.
+
+Usage: python benchmarks/bench_micro.py [-s SIZES] [-t SECONDS] [-r CASES]
+                                        [-o OUT.json] [-b BASELINE.json]
+                                        [--threshold PERCENT]
+
+Runs each case on synthetic payloads of every size in SIZES (keys per
+payload) and prints calls per second, the best of five timed rounds, and
+the bytes a call allocates, the tracemalloc peak of a single call. -o
+saves the results as JSON. -b compares them with an earlier run and exits
+with 1 when a case got slower or allocates more by over --threshold
+percent.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from werkzeug.datastructures import MultiDict  # noqa: E402
+from abell.api import responses  # noqa: E402
+from abell.api.v1_controller import get_query_params, validate_data  # noqa
+from abell.models import model_tools  # noqa: E402
+from abell.models.asset import AbellAsset  # noqa: E402
+from abell.models.asset_type import AbellAssetType  # noqa: E402
+from compare import change, format_change  # noqa: E402
+
+DEFAULT_SIZES = '10,100,1000'
+
+
+class BenchAssetType(AbellAssetType):
+    # update_keys ends with a db write, only its set arithmetic is timed
+    def _AbellAssetType__update_database(self, case, **kwargs):
+        return {'success': True, 'result': None}
+
+
+def asset_info(size):
+    managed = size // 2
+    return {'managed_keys': ['key%04d' % i for i in range(managed)],
+            'unmanaged_keys': ['key%04d' % i for i in range(managed, size)]}
+
+
+def properties(size):
+    # a mix of value types, a few nested, and keys the type does not have
+    record = {'type': 'bench', 'abell_id': 'bench-1', 'cloud': 'dfw',
+              'owner': 'ops'}
+    for i in range(size):
+        if i % 10 == 9:
+            value = {'rack': i, 'tags': ['a', 'b', i]}
+        elif i % 3:
+            value = 'value %d' % i
+        else:
+            value = i
+        record['key%04d' % i] = value
+    record.update(('extra%04d' % i, i) for i in range(size // 10))
+    return record
+
+
+def query_args(size):
+    args = MultiDict([('type', 'bench'), ('limit', '100'),
+                      ('specified_keys', '[%s]' % ','.join(
+                          'key%04d' % i for i in range(size // 4 or 1)))])
+    for i in range(size):
+        value = ('!off', '/^r1', 'dfw')[i % 3]
+        args.add('key%04d' % i, value)
+    return args
+
+
+def find_payload(size):
+    return [dict([('abell_id', 'bench-%d' % i)] +
+                 [('key%04d' % k, 'value %d-%d' % (i, k))
+                  for k in range(20)])
+            for i in range(size)]
+
+
+def case_get_query_params(size):
+    args = query_args(size)
+    return lambda: get_query_params(args)
+
+
+def case_validate_data(size):
+    data = properties(size)
+    fields = ['key%04d' % i for i in range(size)]
+    return lambda: validate_data('update', data, fields)
+
+
+def case_stringify(size):
+    data = properties(size)
+    # stringify, item_stringify would convert data on the first call only
+    return lambda: model_tools.stringify(data)
+
+
+def case_asset_init(size):
+    ato = BenchAssetType('bench', asset_info(size))
+    ato.sparse = False
+    return lambda: AbellAsset('bench', 'bench-1', asset_type_object=ato)
+
+
+def case_asset_update(size):
+    ato = BenchAssetType('bench', asset_info(size))
+    ato.sparse = False
+    data = properties(size)
+    return lambda: AbellAsset('bench', 'bench-1', data,
+                              asset_type_object=ato)
+
+
+def case_type_update_keys(size):
+    info = asset_info(size)
+    remove = info['managed_keys'][::4]
+    managed = info['unmanaged_keys'][::3] + ['new%04d' % i
+                                             for i in range(size // 10)]
+    unmanaged = info['managed_keys'][1::3] + ['cloud']
+    # a fresh type per call, update_keys changes it
+    return lambda: BenchAssetType('bench', info).update_keys(
+        remove_keys=remove, managed_keys=managed, unmanaged_keys=unmanaged)
+
+
+def case_abell_success(size):
+    payload = find_payload(size)
+    details = {'query_params': {'type': 'bench'}, 'total': size}
+    return lambda: responses.abell_success(payload=payload, **details)
+
+
+CASES = [('get_query_params', case_get_query_params),
+         ('validate_data', case_validate_data),
+         ('stringify', case_stringify),
+         ('asset_init', case_asset_init),
+         ('asset_update', case_asset_update),
+         ('type_update_keys', case_type_update_keys),
+         ('abell_success', case_abell_success)]
+
+
+def calls_per_second(function, seconds, repeat=5):
+    """Best of repeat rounds, each about seconds long."""
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - started
+        if elapsed >= seconds / 10:
+            break
+        number *= 10
+    best = elapsed
+    number = max(1, int(number * seconds / elapsed))
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - started) / number)
+    return 1 / best
+
+
+def allocated_bytes(function, repeat=5):
+    # clear_traces also resets the peak, so it covers exactly one call
+    function()
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(repeat):
+            tracemalloc.clear_traces()
+            function()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()
+    return sorted(peaks)[len(peaks) // 2]
+
+
+def run(cases, sizes, seconds):
+    results = []
+    for name, build in cases:
+        for size in sizes:
+            function = build(size)
+            results.append({'case': name,
+                            'size': size,
+                            'ops': calls_per_second(function, seconds),
+                            'alloc_bytes': allocated_bytes(function)})
+    return results
+
+
+def regressions(baseline, results, threshold):
+    """Results slower or allocating more than baseline by over threshold."""
+    before = dict(((r['case'], r['size']), r) for r in baseline)
+    found = []
+    for result in results:
+        previous = before.get((result['case'], result['size']))
+        if previous is None:
+            continue
+        ops_change = change(previous['ops'], result['ops'])
+        alloc_change = change(previous['alloc_bytes'],
+                              result['alloc_bytes'])
+        reasons = []
+        if ops_change is not None and ops_change < -threshold:
+            reasons.append('ops %s' % format_change(ops_change))
+        if alloc_change is not None and alloc_change > threshold:
+            reasons.append('alloc %s' % format_change(alloc_change))
+        if reasons:
+            found.append((result, reasons))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-s', '--sizes', default=DEFAULT_SIZES)
+    parser.add_argument('-t', '--time', type=float, default=0.2,
+                        help='Seconds per timed round')
+    parser.add_argument('-r', '--cases', default=None,
+                        help='Comma separated case names, all by default')
+    parser.add_argument('-o', '--output', default=None)
+    parser.add_argument('-b', '--baseline', default=None)
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Allowed change in percent')
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(',')]
+    cases = CASES
+    if args.cases:
+        wanted = args.cases.split(',')
+        unknown = set(wanted).difference(name for name, _ in CASES)
+        if unknown:
+            parser.error('Unknown cases %s' % ', '.join(sorted(unknown)))
+        cases = [(name, build) for name, build in CASES if name in wanted]
+
+    results = run(cases, sizes, args.time)
+    print('%-18s %6s %12s %12s' % ('case', 'size', 'ops/s', 'alloc B'))
+    for result in results:
+        print('%(case)-18s %(size)6d %(ops)12.0f %(alloc_bytes)12d'
+              % result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': {'python': sys.version.split()[0],
+                                'time': args.time},
+                       'results': results}, f, indent=2)
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        found = regressions(json.load(f)['results'], results,
+                            args.threshold)
+    for result, reasons in found:
+        print('REGRESSION %s@%d: %s' % (result['case'], result['size'],
+                                        ', '.join(reasons)))
+    print('%d regressions over %.0f%%' % (len(found), args.threshold))
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""Times encoding large find responses with each available encoder.
+
+Usage: python benchmarks/bench_responses.py [-a ASSETS] [-n ROUNDS]
+
+"before" is the old abell_success body, json.dumps of the whole envelope.
+The other rows build the same envelope through abell_success with each
+installed encoder, plus a payload passed as PreEncoded bytes.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from abell.api import responses  # noqa: E402
+
+
+def find_payload(assets):
+    return [dict([('abell_id', 'asset-%06d' % i), ('type', 'server'),
+                  ('cloud', 'dfw'), ('owner', 'ops')] +
+                 [('key%02d' % k, 'value %d-%d' % (i, k))
+                  for k in range(20)] +
+                 [('tags', ['a', 'b', 'c']),
+                  ('meta', {'rack': str(i % 40), 'u': str(i % 42)})])
+            for i in range(assets)]
+
+
+def old_abell_success(payload, **details):
+    return json.dumps({'code': 200, 'payload': payload, 'details': details})
+
+
+def best_time(function, rounds, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            function()
+        timings.append(time.perf_counter() - started)
+    return min(timings) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-a', '--assets', type=int, default=5000)
+    parser.add_argument('-n', '--rounds', type=int, default=10)
+    args = parser.parse_args()
+    payload = find_payload(args.assets)
+    details = {'query_params': {'type': 'server'}}
+    encoders = ['json'] + [name for name, module, _ in
+                           responses.ResponseEncoder.ENCODERS if module]
+    pre_encoded = responses.PreEncoded(responses.ENCODER.encode(payload))
+    cases = [('before', lambda: old_abell_success(payload, **details))]
+    cases += [(name, lambda: responses.abell_success(payload=payload,
+                                                     **details))
+              for name in encoders]
+    cases.append(('pre_encoded', lambda: responses.abell_success(
+        payload=pre_encoded, **details)))
+
+    body = responses.abell_success(payload=payload, **details).get_data()
+    print('%d assets, %d byte body, default encoder %s' % (
+        args.assets, len(body), responses.ENCODER.name))
+    baseline = None
+    for name, function in cases:
+        if name in encoders:
+            responses.ENCODER.set_encoder(name)
+        elapsed = best_time(function, args.rounds)
+        baseline = baseline or elapsed
+        print('%-12s %9.2f ms %7.2fx' % (name, elapsed * 1000,
+                                         baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
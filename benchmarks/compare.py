@@ -0,0 +1,94 @@
+"""Compares two bench_http.py result files.
+
+Usage: python benchmarks/compare.py BASELINE.json CURRENT.json [-t PERCENT]
+
+Prints requests per second and p99 latency of every scenario and
+concurrency level in both runs. A row is a regression when throughput
+fell or p99 rose by more than PERCENT (10 by default), or when it has
+errors the baseline did not. Exits with 1 when there is any regression,
+so it can gate a release.
+"""
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as f:
+        results = json.load(f)
+    rows = dict(((r['scenario'], r['concurrency']), r)
+                for r in results['results'])
+    return results['meta'], rows
+
+
+def change(before, after):
+    if not before or after is None:
+        return None
+    return (after - before) * 100.0 / before
+
+
+def format_change(value):
+    return '%+.1f%%' % value if value is not None else 'n/a'
+
+
+def compare(baseline, current, threshold=10.0):
+    """Returns (rows, regressions), a row per scenario and level in both."""
+    rows = []
+    regressions = []
+    for key in sorted(set(baseline) & set(current)):
+        before, after = baseline[key], current[key]
+        rps_change = change(before['rps'], after['rps'])
+        p99_change = change(before['p99_ms'], after['p99_ms'])
+        reasons = []
+        if rps_change is not None and rps_change < -threshold:
+            reasons.append('throughput')
+        if p99_change is not None and p99_change > threshold:
+            reasons.append('p99')
+        if after['errors'] and not before['errors']:
+            reasons.append('errors')
+        row = (key[0], key[1], before['rps'], after['rps'], rps_change,
+               before['p99_ms'], after['p99_ms'], p99_change, reasons)
+        rows.append(row)
+        if reasons:
+            regressions.append(row)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('-t', '--threshold', type=float, default=10.0,
+                        help='Allowed change in percent')
+    args = parser.parse_args()
+
+    baseline_meta, baseline = load(args.baseline)
+    current_meta, current = load(args.current)
+    if baseline_meta.get('fleet') != current_meta.get('fleet'):
+        print('Warning: the runs used different fleets, %s and %s'
+              % (baseline_meta.get('fleet'), current_meta.get('fleet')))
+    missing = sorted(set(baseline) ^ set(current))
+    if missing:
+        print('Only in one run: %s' % ', '.join('%s@%d' % key
+                                                for key in missing))
+
+    rows, regressions = compare(baseline, current, args.threshold)
+    print('%-14s %5s %10s %10s %8s %10s %10s %8s' % (
+        'scenario', 'conc', 'req/s', 'req/s', 'change', 'p99 ms', 'p99 ms',
+        'change'))
+    for (scenario, concurrency, rps_before, rps_after, rps_change,
+         p99_before, p99_after, p99_change, reasons) in rows:
+        print('%-14s %5d %10.1f %10.1f %8s %10s %10s %8s %s' % (
+            scenario, concurrency, rps_before, rps_after,
+            format_change(rps_change), p99_before, p99_after,
+            format_change(p99_change),
+            'REGRESSION (%s)' % ', '.join(reasons) if reasons else ''))
+    print('%d regressions over %.0f%% between %s and %s' % (
+        len(regressions), args.threshold,
+        baseline_meta.get('git_commit') or args.baseline,
+        current_meta.get('git_commit') or args.current))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""Seeded asset fleets for the HTTP benchmarks.
+
+Usage: python benchmarks/fleet.py [-u URI] [-f small|medium|large]
+                                  [-s SEED] [-w WORKERS] [--force]
+
+Drops every collection of the database in URI, then creates the benchmark
+asset types and their assets through the same code paths as the API, so
+the documents and indexes match a real deployment. The same fleet and
+seed always produce the same assets, bench_http.py rebuilds its queries
+from them without reading the database. A database without 'bench' in
+its name is only wiped with --force.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from pymongo import MongoClient  # noqa: E402
+from abell import config, create_app, loader  # noqa: E402
+from abell.models import asset_type as AT  # noqa: E402
+
+FLEETS = {'small': 1000, 'medium': 100000, 'large': 1000000}
+
+# name, share of the fleet, managed keys, unmanaged keys, indexed keys
+TYPES = [('bench_server', 0.6, 24, 8, ['cloud', 'os']),
+         ('bench_switch', 0.25, 12, 4, ['cloud']),
+         ('bench_pdu', 0.15, 6, 2, [])]
+
+CLOUDS = ['dfw', 'ord', 'iad', 'lon', 'hkg', 'syd', 'sjc', 'fra']
+OWNERS = ['ops', 'network', 'database', 'web', 'storage', 'security']
+OS_NAMES = ['ubuntu-22.04', 'ubuntu-24.04', 'rhel-8', 'rhel-9',
+            'debian-12', 'windows-2022']
+STATUSES = ['active', 'active', 'active', 'maintenance', 'decommissioned']
+
+DEFAULT_URI = 'mongodb://localhost:27017/abell_bench'
+
+
+class Fleet(object):
+    """Deterministic description of a seeded fleet."""
+
+    def __init__(self, size='small', seed=42):
+        if size not in FLEETS:
+            raise ValueError('Unknown fleet %s, use %s'
+                             % (size, ', '.join(sorted(FLEETS))))
+        self.size = size
+        self.seed = seed
+        self.total = FLEETS[size]
+        self.counts = dict((name, max(1, int(self.total * share)))
+                           for name, share, _, _, _ in TYPES)
+
+    def type_definition(self, name):
+        for type_name, _, managed, unmanaged, indexed in TYPES:
+            if type_name == name:
+                return {'type': name,
+                        'managed_keys': (['os', 'rack', 'status'] +
+                                         ['attr%02d' % i
+                                          for i in range(managed - 3)]),
+                        'unmanaged_keys': ['note%02d' % i
+                                           for i in range(unmanaged)],
+                        'indexed_keys': indexed}
+        raise ValueError('Unknown asset type %s' % name)
+
+    def asset_id(self, asset_type, number):
+        return '%s-%07d' % (asset_type, number)
+
+    def asset(self, asset_type, number):
+        # every asset has its own generator, so any asset can be rebuilt
+        rng = random.Random('%s-%s-%d' % (self.seed, asset_type, number))
+        definition = self.type_definition(asset_type)
+        record = {'type': asset_type,
+                  'abell_id': self.asset_id(asset_type, number),
+                  'cloud': rng.choice(CLOUDS),
+                  'owner': rng.choice(OWNERS),
+                  'os': rng.choice(OS_NAMES),
+                  'rack': 'r%03d' % rng.randrange(400),
+                  'status': rng.choice(STATUSES)}
+        for key in definition['managed_keys'][3:]:
+            record[key] = 'v%d' % rng.randrange(50)
+        # notes are only set on some assets
+        for key in definition['unmanaged_keys']:
+            if rng.random() < 0.3:
+                record[key] = 'note %d' % rng.randrange(10 ** 6)
+        return record
+
+    def fingerprint(self):
+        return {'fleet': self.size, 'seed': self.seed,
+                'assets': dict(self.counts)}
+
+
+def bench_config(uri):
+    return type('BenchConfig', (config.base_config,),
+                {'MONGO_URI': uri,
+                 'INDEX_BUILD_BACKGROUND': False,
+                 'MIGRATION_BACKGROUND': False})
+
+
+def seed(uri, fleet, workers=4, chunk_size=1000, force=False,
+         report=print):
+    """Wipes the database and loads the fleet into it.
+
+    Returns:
+        dict: The fleet fingerprint and the seconds it took
+    """
+    if 'bench' not in uri.rsplit('/', 1)[-1] and not force:
+        raise ValueError('Refusing to wipe %s, the database name does not '
+                         'contain bench. Pass --force to do it anyway'
+                         % uri)
+    started = time.time()
+    mongo_client = MongoClient(uri)
+    mongo_client.drop_database(mongo_client.get_default_database().name)
+    mongo_client.close()
+    app = create_app(bench_config(uri))
+    client = app.test_client()
+    for name, _, _, _, _ in TYPES:
+        r = client.post('/api/v1/asset_type',
+                        json=fleet.type_definition(name))
+        if r.status_code != 200:
+            raise RuntimeError('Creating %s failed: %s'
+                               % (name, r.data.decode('utf-8')))
+        with app.app_context():
+            ato = AT.get_asset_type(name)
+
+        def chunk(first):
+            last = min(first + chunk_size, fleet.counts[name])
+            items = []
+            for number in range(first, last):
+                item, message = loader.prepare_record(
+                    ato, fleet.asset(name, number), 'insert')
+                items.append((number + 1, item))
+            return loader.load_chunk(app, name, 'insert', items)
+
+        inserted = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for result in pool.map(chunk, range(0, fleet.counts[name],
+                                                chunk_size)):
+                inserted += result.get('inserted', 0)
+        report('%s: %d assets' % (name, inserted))
+    summary = fleet.fingerprint()
+    summary['seconds'] = round(time.time() - started, 1)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', '--uri', default=DEFAULT_URI)
+    parser.add_argument('-f', '--fleet', default='small',
+                        choices=sorted(FLEETS))
+    parser.add_argument('-s', '--seed', type=int, default=42)
+    parser.add_argument('-w', '--workers', type=int, default=4)
+    parser.add_argument('--force', action='store_true')
+    args = parser.parse_args()
+    summary = seed(args.uri, Fleet(args.fleet, args.seed), args.workers,
+                   force=args.force)
+    print('Seeded %(fleet)s fleet in %(seconds)ss' % summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Compares model_tools.stringify against the legacy item_stringify.
+
+Usage: python benchmarks/stringify_bench.py [-n ROUNDS]
+
+in_place is item_stringify, which changes the payload it is given.
+copied is item_stringify on a deepcopy, what a caller whose payload must
+stay intact paid before stringify. So that no function sees already
+converted values, every call gets its own deep copy of the payload, made
+before the timer starts. The speedups are those of stringify.
+"""
+import argparse
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from abell.models import model_tools  # noqa: E402
+
+
+def copied_stringify(item_dict):
+    return model_tools.item_stringify(copy.deepcopy(item_dict))
+
+
+def flat_payload(size=50):
+    return dict(('key%d' % i, i if i % 2 else 'value%d' % i)
+                for i in range(size))
+
+
+def nested_payload(width=10, depth=4):
+    payload = flat_payload(width)
+    node = payload
+    for level in range(depth):
+        node['child'] = flat_payload(width)
+        node['items'] = [flat_payload(width // 2), list(range(width)),
+                         None, 1.5]
+        node = node['child']
+    return payload
+
+
+def large_update(assets=200):
+    return {'patches': [{'id': i, 'applied': True, 'kb': [i, i + 1],
+                         'meta': {'size': i * 10, 'tags': ['a', 'b']}}
+                        for i in range(assets)]}
+
+
+# name, payload and its share of the rounds
+PAYLOADS = [('small_update', {'status': 'active', 'patches': 3}, 10),
+            ('flat', flat_payload(), 1),
+            ('nested', nested_payload(), 1),
+            ('large_update', large_update(), 0.05)]
+
+
+def best_times(functions, payload, rounds, repeat=15):
+    """Best time of each function, the functions take turns every repeat."""
+    best = [float('inf')] * len(functions)
+    for _ in range(repeat):
+        for index, function in enumerate(functions):
+            copies = [copy.deepcopy(payload) for _ in range(rounds)]
+            started = time.perf_counter()
+            for item in copies:
+                function(item)
+            best[index] = min(best[index], time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--rounds', type=int, default=1000)
+    args = parser.parse_args()
+    functions = [('in_place', model_tools.item_stringify),
+                 ('copied', copied_stringify),
+                 ('stringify', model_tools.stringify)]
+    print('%-14s' % 'ops/s' + ''.join('%12s' % f for f, _ in functions) +
+          '%12s%12s' % ('vs copied', 'vs in_place'))
+    for name, payload, share in PAYLOADS:
+        assert model_tools.stringify(payload) == model_tools.item_stringify(
+            copy.deepcopy(payload))
+        rounds = max(1, int(args.rounds * share))
+        row = [rounds / elapsed for elapsed in
+               best_times([f for _, f in functions], payload, rounds)]
+        print('%-14s' % name + ''.join('%12.0f' % ops for ops in row) +
+              '%11.2fx%11.2fx' % (row[2] / row[1], row[2] / row[0]))
+
+
+if __name__ == '__main__':
+    main()
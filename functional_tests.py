@@ -1,7 +1,10 @@
 from abell import create_app
 from abell.config import test_config
-from abell.database import AbellDb
+from abell.database import AbellDb, mongo
+from pymongo import ReadPreference, monitoring
 import json
+import os
+import time
 # from faker import Factory
 
 import unittest
@@ -205,5 +208,112 @@ class UpdateAssetTypeTestCase(unittest.TestCase):
         # test that its been updated from assets
 
 
+class replica_set_config(test_config):
+    READ_PREFERENCE = 'secondaryPreferred'
+    READ_MAX_STALENESS = 90
+    QUERY_CACHE_SIZE = 0
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """Keeps the server address each asset command was sent to."""
+
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        # count_documents runs as an aggregate
+        if event.command_name in ('find', 'aggregate', 'distinct',
+                                  'findAndModify'):
+            self.commands.append((event.command_name,
+                                  event.command.get(event.command_name),
+                                  event.connection_id))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def sent(self, name, collection='server'):
+        return [address for command, target, address in self.commands
+                if command == name and target == collection]
+
+
+# registered before any client is built, every MongoClient reports to it
+COMMANDS = CommandRecorder()
+monitoring.register(COMMANDS)
+
+
+@unittest.skipUnless(os.environ.get('MONGO_REPLICA_SET'),
+                     'MONGO_REPLICA_SET is not set')
+class ReadRoutingTestCase(unittest.TestCase):
+    def setUp(self):
+        app = create_app(replica_set_config)
+        self.app = app.test_client()
+        self.app_context = app.app_context()
+        self.app_context.push()
+        AbellDb().nuke_all_collections()
+        r = self.app.post('/api/v1/asset_type',
+                          data=json.dumps({'type': 'server',
+                                           'managed_keys': ['os']}),
+                          headers={'content-type': 'application/json'})
+        self.assertEqual(r.status_code, 200)
+        a = {'type': 'server', 'abell_id': 'a1', 'owner': 'me',
+             'cloud': 'dfw', 'os': 'linux'}
+        r = self.app.post('/api/v1/asset', data=json.dumps(a),
+                          headers={'content-type': 'application/json'})
+        self.assertEqual(r.status_code, 200)
+        del COMMANDS.commands[:]
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_reads_go_to_secondaries(self):
+        topology = mongo.cx.topology_description
+        self.assertEqual(topology.topology_type_name, 'ReplicaSetWithPrimary')
+        # the secondaries catch up with the write
+        for _ in range(50):
+            r = self.app.get('/api/v1/asset/count?type=server')
+            if json.loads(r.data.decode())['payload']['count'] == 1:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail('Asset never reached the secondaries')
+        self.assertNotIn('ETag', r.headers)
+        r = self.app.get('/api/v1/asset?type=server&os=linux')
+        self.assertEqual(len(json.loads(r.data.decode())['payload']), 1)
+        r = self.app.get('/api/v1/asset/distinct?type=server'
+                         '&distinct_key=os')
+        self.assertEqual(r.status_code, 200)
+        secondaries = mongo.cx.secondaries
+        self.assertTrue(secondaries)
+        for command in ('aggregate', 'find', 'distinct'):
+            addresses = COMMANDS.sent(command)
+            self.assertTrue(addresses, '%s was never sent' % command)
+            self.assertTrue(set(addresses) <= secondaries,
+                            '%s went to %s' % (command, addresses))
+
+    def test_writes_read_the_primary(self):
+        # the update looks the asset up right after the insert
+        r = self.app.put('/api/v1/asset',
+                         data=json.dumps({'filter': {'type': 'server',
+                                                     'os': 'linux'},
+                                          'update': {'os': 'bsd'}}),
+                         headers={'content-type': 'application/json'})
+        self.assertEqual(r.status_code, 200)
+        payload = json.loads(r.data.decode())
+        self.assertEqual(payload['details']['updated_asset_ids'], ['a1'])
+        primary = mongo.cx.primary
+        for command in ('find', 'findAndModify'):
+            addresses = COMMANDS.sent(command)
+            self.assertTrue(addresses, '%s was never sent' % command)
+            self.assertEqual(set(addresses), set([primary]))
+        # read back from the primary, a secondary may not have it yet
+        document = mongo.db['server'].with_options(
+            read_preference=ReadPreference.PRIMARY).find_one(
+                {'abell_id': 'a1'})
+        self.assertEqual(document['os'], 'bsd')
+
+
 if __name__ == '__main__':
     unittest.main()
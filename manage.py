@@ -1,17 +1,90 @@
+import sys
 from abell import create_app, config
+from abell import async_api, loader, server
+from abell.models import migration
+from flask import current_app
 from flask_script import Server, Shell, Manager
 
 
-def _make_context():
-    return dict(app=create_app(config.dev_config))
+def _make_app():
+    return create_app(config=config.dev_config)
+
 
+def _make_context():
+    return dict(app=current_app._get_current_object())
 
-app = create_app(config=config.dev_config)
 
-manager = Manager(app)
+# built when a command runs, not on import
+manager = Manager(_make_app)
 manager.add_command('runserver', Server(host="0.0.0.0", port=6000))
 manager.add_command('shell', Shell(make_context=_make_context))
 
 
+@manager.option('-t', '--type', dest='asset_type', default=None,
+                help='Only run migrations of this asset type')
+def migrate(asset_type=None):
+    """Runs unfinished schema migrations in the foreground"""
+    r = migration.ABELLDB.get_migrations(asset_type=asset_type,
+                                         unfinished=True)
+    for job_type in sorted(set(job.get('type') for job in r.get('result')
+                               or [])):
+        print('Migrating %s' % job_type)
+        migration.run_migrations(job_type, background=False)
+
+
+@manager.option('path', help='CSV or NDJSON file, may be gzipped')
+@manager.option('-t', '--type', dest='asset_type', required=True,
+                help='Asset type every record belongs to')
+@manager.option('-m', '--mode', dest='mode', default='insert',
+                choices=['insert', 'upsert'],
+                help='insert skips existing abell_ids, upsert updates them')
+@manager.option('-f', '--format', dest='fmt', default=None,
+                choices=['csv', 'ndjson'],
+                help='File format, guessed from the extension by default')
+@manager.option('-w', '--workers', dest='workers', type=int, default=4,
+                help='Writer threads')
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int,
+                default=None, help='Records per write')
+@manager.option('--checkpoint', dest='checkpoint', default=None,
+                help='File the resume point is saved in, PATH.checkpoint'
+                ' by default')
+@manager.option('--resume', dest='resume', action='store_true',
+                default=False, help='Continue from the checkpoint')
+def load(path, asset_type, mode='insert', fmt=None, workers=4,
+         chunk_size=None, checkpoint=None, resume=False):
+    """Loads a CSV or NDJSON file of assets"""
+    app = current_app._get_current_object()
+    checkpoint = checkpoint or path + '.checkpoint'
+    summary = loader.load_file(
+        app, path, asset_type, mode=mode, fmt=fmt, workers=workers,
+        chunk_size=chunk_size or app.config.get('BULK_INSERT_CHUNK_SIZE'),
+        checkpoint_path=checkpoint, resume=resume)
+    print(loader.progress_line(summary))
+    for line, abell_id, message in summary['errors']:
+        print('line %s (%s): %s' % (line, abell_id, message))
+    if summary['checkpoint']:
+        print('Loaded up to line %d' % summary['checkpoint'])
+    if summary['failed_chunks']:
+        print('%d chunks failed to write, rerun with --resume to load them'
+              % summary['failed_chunks'])
+
+
+@manager.option('-H', '--host', dest='host', default='0.0.0.0',
+                help='Address to listen on')
+@manager.option('-p', '--port', dest='port', type=int, default=6001,
+                help='Port to listen on')
+@manager.option('--pool', dest='pool', type=int, default=None,
+                help='Most MongoDB connections, queries queue past it')
+def serve_async(host='0.0.0.0', port=6001, pool=None):
+    """Runs the asyncio read only API, needs aiohttp"""
+    async_api.serve_async(config.base_config, host=host, port=port,
+                          max_pool_size=pool)
+
+
 if __name__ == '__main__':
-    manager.run()
+    # serve is kept away from flask_script, which would build an app and
+    # its MongoClient in the gunicorn master before the workers fork
+    if sys.argv[1:2] == ['serve']:
+        server.main(sys.argv[2:])
+    else:
+        manager.run()
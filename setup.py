@@ -6,4 +6,8 @@ setup(
     author="Abell Contributors",
     packages=['abell'],
     zip_safe=False,
+    extras_require={
+        # Accept: application/msgpack, answered with a 406 without it
+        'msgpack': ['msgpack'],
+    },
 )
@@ -1,9 +1,34 @@
 from abell import create_app
-from abell.config import test_config
+from abell import (async_api, loader, metrics, profiling, server,
+                   slow_queries)
+from abell.api import responses
+from abell.config import base_config, test_config
+from abell.database import AbellDb, mongo_uri, read_preference
+from abell.database.async_db import AsyncAbellDb
+from abell.models import asset
+from abell.models import asset_type as AT
+from abell.models import migration
+from abell.models import model_tools
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+import bson
+from pymongo import ReadPreference
+from pymongo.errors import InvalidOperation, OperationFailure
+import asyncio
+import copy
+import datetime
+import gzip
 import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 
 import unittest
 from unittest import mock
+import zlib
 
 
 class BasicRunningTestCase(unittest.TestCase):
@@ -97,6 +122,7 @@ class GetAssetTypeTestCase(unittest.TestCase):
              'managed_keys': ['test'],
              'unmanaged_keys': ['test2'],
         }
+        new_type.indexed_keys = []
         mock_get.return_value = new_type
         r = self.app.get('/api/v1/asset_type?type=server')
         payload = dict(json.loads(r.data.decode()).get('payload'))
@@ -201,5 +227,1782 @@ class UpdateAssetTypeTestCase(unittest.TestCase):
         mock_type.update_keys.assert_called_with([], ['test3'], [])
 
 
+class AssetTypeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            app = create_app(test_config)
+            self.app = app.test_client()
+            self.app_context = app.app_context()
+            self.app_context.push()
+        self.server_info = {'type': 'server',
+                            'managed_keys': ['test'],
+                            'unmanaged_keys': ['test2'],
+                            'version': 3}
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_lru_eviction_and_ttl(self):
+        from abell.cache import LRUCache
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        with mock.patch('abell.cache.time.time', return_value=1e12):
+            self.assertIsNone(cache.get('c'))
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+
+    @mock.patch('abell.models.asset_type.ABELLDB')
+    def test_get_asset_type_cached(self, mock_db):
+        mock_db.get_asset_type_info.return_value = {
+            'success': True, 'result': self.server_info}
+        mock_db.get_asset_type_versions.return_value = {
+            'success': True, 'result': {'server': 3}}
+        first = AT.get_asset_type('server')
+        second = AT.get_asset_type('server')
+        self.assertEqual(mock_db.get_asset_type_info.call_count, 1)
+        self.assertEqual(second.managed_keys, set(['test']))
+        # handed out objects are copies
+        first.managed_keys.add('changed')
+        self.assertEqual(AT.get_asset_type('server').managed_keys,
+                         set(['test']))
+        self.assertEqual(AT.ASSET_TYPE_CACHE.stats()['hits'], 2)
+
+    @mock.patch('abell.models.asset_type.ABELLDB')
+    def test_get_asset_type_version_change(self, mock_db):
+        mock_db.get_asset_type_info.return_value = {
+            'success': True, 'result': self.server_info}
+        mock_db.get_asset_type_versions.return_value = {
+            'success': True, 'result': {'server': 4}}
+        AT.get_asset_type('server')
+        AT.get_asset_type('server')
+        self.assertEqual(mock_db.get_asset_type_info.call_count, 2)
+
+    @mock.patch('abell.models.asset_type.ABELLDB')
+    def test_update_keys_invalidates(self, mock_db):
+        mock_db.get_asset_type_info.return_value = {
+            'success': True, 'result': self.server_info}
+        mock_db.get_asset_type_versions.return_value = {
+            'success': True, 'result': {'server': 3}}
+        mock_db.update_asset_type.return_value = {'success': True}
+        abell_asset_type = AT.get_asset_type('server')
+        abell_asset_type.update_keys(remove_keys=['test'])
+        self.assertIsNone(AT.ASSET_TYPE_CACHE.peek('server'))
+
+    @mock.patch('abell.models.asset_type.ABELLDB')
+    def test_invalidated_after_write(self, mock_db):
+        mock_db.get_asset_type_info.return_value = {
+            'success': True, 'result': self.server_info}
+        mock_db.get_asset_type_versions.return_value = {
+            'success': True, 'result': {'server': 3}}
+
+        def concurrent_read(type_info):
+            # another request reads the type while it is being written
+            AT.get_asset_type('server')
+            return {'success': True}
+        mock_db.update_asset_type.side_effect = concurrent_read
+        abell_asset_type = AT.get_asset_type('server')
+        AT.ASSET_TYPE_CACHE.invalidate('server')
+        abell_asset_type.update_keys(remove_keys=['test'])
+        self.assertIsNone(AT.ASSET_TYPE_CACHE.peek('server'))
+
+    def test_cache_stats(self):
+        r = self.app.get('/api/v1/stats')
+        payload = json.loads(r.data.decode()).get('payload')
+        self.assertIn('hits', payload.get('asset_type_cache'))
+
+
+class StreamFindAssetsTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            app = create_app(test_config)
+            self.app = app.test_client()
+            self.app_context = app.app_context()
+            self.app_context.push()
+        self.assets = [{'abell_id': str(i), 'type': 'server'}
+                       for i in range(3)]
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    @mock.patch('abell.models.asset.asset_stream')
+    def test_ndjson_stream(self, mock_stream):
+        mock_stream.return_value = {'success': True,
+                                    'result': iter(self.assets)}
+        r = self.app.get('/api/v1/asset?type=server',
+                         headers={'accept': 'application/x-ndjson'})
+        self.assertEqual(r.mimetype, 'application/x-ndjson')
+        lines = r.data.decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], self.assets)
+
+    @mock.patch('abell.models.asset.asset_stream')
+    def test_json_stream(self, mock_stream):
+        mock_stream.return_value = {'success': True,
+                                    'result': iter(self.assets)}
+        r = self.app.get('/api/v1/asset?type=server&stream=true')
+        body = json.loads(r.data.decode())
+        self.assertEqual(body.get('payload'), self.assets)
+        self.assertEqual(body['details']['query_params'], {'type': 'server'})
+
+    @mock.patch('abell.models.asset.asset_stream')
+    def test_json_stream_interrupted(self, mock_stream):
+        def broken_cursor():
+            yield self.assets[0]
+            raise Exception('cursor killed')
+        mock_stream.return_value = {'success': True,
+                                    'result': broken_cursor()}
+        r = self.app.get('/api/v1/asset?type=server&stream=true')
+        body = json.loads(r.data.decode())
+        self.assertEqual(body.get('payload'), self.assets[:1])
+        self.assertIn('error', body.get('details'))
+        self.assertEqual(metrics.METRICS.db_errors.get('abell_stream'), 1)
+
+
+class PaginateFindAssetsTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            app = create_app(test_config)
+            self.app = app.test_client()
+            self.app_context = app.app_context()
+            self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    @mock.patch('abell.models.asset.asset_find')
+    def test_first_page(self, mock_find):
+        mock_find.return_value = {'success': True,
+                                  'result': [{'abell_id': 'a'},
+                                             {'abell_id': 'b'},
+                                             {'abell_id': 'c'}]}
+        r = self.app.get('/api/v1/asset?type=server&limit=2')
+        body = json.loads(r.data.decode())
+        self.assertEqual(len(body.get('payload')), 2)
+        self.assertEqual(body['details']['next_cursor'], 'b')
+        mock_find.assert_called_with('server', {'type': 'server'},
+                                     specified_keys={'_id': 0},
+                                     sort=[('abell_id', 1)],
+                                     limit=3,
+                                     cache=True,
+                                     generation=None,
+                                     read_preference=None,
+                                     encode=mock.ANY)
+
+    @mock.patch('abell.models.asset.asset_find')
+    def test_last_page(self, mock_find):
+        mock_find.return_value = {'success': True,
+                                  'result': [{'abell_id': 'c'}]}
+        r = self.app.get('/api/v1/asset?type=server&limit=2&after=b'
+                         '&specified_keys=[owner]')
+        body = json.loads(r.data.decode())
+        self.assertIsNone(body['details']['next_cursor'])
+        mock_find.assert_called_with(
+            'server', {'type': 'server', 'abell_id': {'$gt': 'b'}},
+            specified_keys={'_id': 0, 'owner': 1, 'abell_id': 1},
+            sort=[('abell_id', 1)],
+            limit=3,
+            cache=True,
+            generation=None,
+            read_preference=None,
+            encode=mock.ANY)
+
+    @mock.patch('abell.models.asset.asset_find')
+    def test_after_without_limit(self, mock_find):
+        mock_find.return_value = {'success': True,
+                                  'result': [{'abell_id': 'c'}]}
+        r = self.app.get('/api/v1/asset?type=server&after=b')
+        body = json.loads(r.data.decode())
+        self.assertEqual(len(body.get('payload')), 1)
+        self.assertNotIn('next_cursor', body['details'])
+        mock_find.assert_called_with(
+            'server', {'type': 'server', 'abell_id': {'$gt': 'b'}},
+            specified_keys={'_id': 0},
+            sort=[('abell_id', 1)],
+            limit=0,
+            cache=True,
+            generation=None,
+            read_preference=None,
+            encode=mock.ANY)
+
+    def test_bad_limit(self):
+        r = self.app.get('/api/v1/asset?type=server&limit=zero')
+        self.assertEqual(r.status_code, 400)
+        r = self.app.get('/api/v1/asset?type=server&limit=0')
+        self.assertEqual(r.status_code, 400)
+
+
+class QueryCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            app = create_app(test_config)
+            self.app = app.test_client()
+            self.app_context = app.app_context()
+            self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_cached_until_generation_changes(self, mock_db):
+        mock_db.get_generation.return_value = {'success': True,
+                                               'result': ('id', 1)}
+        mock_db.asset_count.return_value = {'success': True, 'result': 5}
+        for i in range(3):
+            r = self.app.get('/api/v1/asset/count?type=server&cloud=dfw')
+        payload = json.loads(r.data.decode()).get('payload')
+        self.assertEqual(payload, {'count': 5})
+        self.assertEqual(mock_db.asset_count.call_count, 1)
+        mock_db.get_generation.return_value = {'success': True,
+                                               'result': ('id', 2)}
+        self.app.get('/api/v1/asset/count?type=server&cloud=dfw')
+        self.assertEqual(mock_db.asset_count.call_count, 2)
+        stats = asset.QUERY_CACHE.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_hits_are_not_encoded_again(self, mock_db):
+        mock_db.get_generation.return_value = {'success': True,
+                                               'result': ('id', 1)}
+        mock_db.asset_find.return_value = {
+            'success': True,
+            'result': [{'abell_id': 'a'}, {'abell_id': 'b'},
+                       {'abell_id': 'c'}]}
+        self.app.get('/api/v1/asset?type=server&limit=2')
+        with mock.patch.object(responses.ENCODER, 'encode',
+                               wraps=responses.ENCODER.encode) as encode:
+            r = self.app.get('/api/v1/asset?type=server&limit=2')
+        body = json.loads(r.data.decode())
+        self.assertEqual(body.get('payload'),
+                         [{'abell_id': 'a'}, {'abell_id': 'b'}])
+        self.assertEqual(body['details']['next_cursor'], 'b')
+        self.assertEqual(mock_db.asset_find.call_count, 1)
+        # only the details are encoded on a hit
+        self.assertEqual(encode.call_count, 1)
+        cached = asset.QUERY_CACHE.peek(asset.QUERY_CACHE.keys()[0])
+        self.assertIsInstance(cached['result'], responses.PreEncoded)
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_large_results_not_cached(self, mock_db):
+        mock_db.get_generation.return_value = {'success': True,
+                                               'result': ('id', 1)}
+        mock_db.asset_find.return_value = {
+            'success': True,
+            'result': [{'abell_id': str(i)} for i in range(
+                asset.QUERY_CACHE.max_results + 1)]}
+        self.app.get('/api/v1/asset?type=server')
+        self.app.get('/api/v1/asset?type=server')
+        self.assertEqual(mock_db.asset_find.call_count, 2)
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_unknown_type_not_cached(self, mock_db):
+        mock_db.get_generation.return_value = {'success': True,
+                                               'result': None}
+        mock_db.asset_distinct.return_value = {'success': True,
+                                               'result': ['dfw']}
+        self.app.get('/api/v1/asset/distinct?type=server&distinct_key=cloud')
+        self.app.get('/api/v1/asset/distinct?type=server&distinct_key=cloud')
+        self.assertEqual(mock_db.asset_distinct.call_count, 2)
+        self.assertEqual(asset.QUERY_CACHE.stats()['size'], 0)
+
+
+class AssetTypeIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            app = create_app(test_config)
+            self.app = app.test_client()
+            self.app_context = app.app_context()
+            self.app_context.push()
+        self.asset_type = AT.AbellAssetType(
+            'server', asset_info={'managed_keys': ['os', 'cabinet'],
+                                  'unmanaged_keys': ['notes'],
+                                  'indexed_keys': [['os'],
+                                                   ['cloud', 'cabinet']]})
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_normalize_indexed_keys(self):
+        r = self.asset_type.normalize_indexed_keys(
+            ['os', ['cloud', 'owner'], 'abell_id', ['os']])
+        self.assertEqual(r.get('indexed_keys'),
+                         [['os'], ['cloud', 'owner']])
+        r = self.asset_type.normalize_indexed_keys(['missing'])
+        self.assertFalse(r.get('success'))
+        r = self.asset_type.normalize_indexed_keys([[]])
+        self.assertFalse(r.get('success'))
+
+    @mock.patch('abell.models.migration.start_migration')
+    @mock.patch('abell.models.asset_type.ABELLDB')
+    def test_removed_key_drops_index(self, mock_db, mock_migration):
+        mock_db.update_asset_type.return_value = {'success': True}
+        mock_migration.return_value = {'success': True, 'result': 'job'}
+        mock_db.drop_asset_index.return_value = {'success': True}
+        r = self.asset_type.update_keys(remove_keys=['cabinet'])
+        self.assertEqual(r.get('dropped_indexes'), [['cloud', 'cabinet']])
+        mock_db.drop_asset_index.assert_called_with('server',
+                                                    'cloud_1_cabinet_1')
+        mock_db.set_index_status.assert_called_with(
+            'server', 'cloud_1_cabinet_1', None)
+        self.assertEqual(self.asset_type.indexed_keys, [['os']])
+
+    @mock.patch('abell.models.asset_type.ABELLDB')
+    def test_new_index_built(self, mock_db):
+        mock_db.update_asset_type.return_value = {'success': True}
+        mock_db.create_asset_index.return_value = {'success': True}
+        r = self.asset_type.update_keys(
+            indexed_keys=['os', ['cloud', 'cabinet'], 'notes'])
+        self.assertEqual(r.get('new_indexes'), [['notes']])
+        mock_db.create_asset_index.assert_called_with('server', ['notes'],
+                                                      'notes_1')
+        mock_db.set_index_status.assert_called_with('server', 'notes_1',
+                                                    'ready')
+
+    @mock.patch('abell.models.asset_type.get_asset_type')
+    def test_index_status_reported(self, mock_get):
+        mock_get.return_value = self.asset_type
+        with mock.patch('abell.models.asset_type.ABELLDB') as mock_db:
+            mock_db.get_index_status.return_value = {
+                'success': True, 'result': {'os_1': 'ready'}}
+            r = self.app.get('/api/v1/asset_type?type=server')
+        details = json.loads(r.data.decode()).get('details')
+        self.assertEqual(details.get('index_status'),
+                         {'os_1': 'ready', 'cloud_1_cabinet_1': 'unknown'})
+
+
+class BulkCreateAssetsTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            app = create_app(test_config)
+            app.config['BULK_INSERT_CHUNK_SIZE'] = 2
+            self.app = app.test_client()
+            self.app_context = app.app_context()
+            self.app_context.push()
+        self.asset_type = AT.AbellAssetType(
+            'server', asset_info={'managed_keys': ['os'],
+                                  'unmanaged_keys': ['notes']})
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def new_asset(self, abell_id, **kwargs):
+        data = {'type': 'server', 'abell_id': abell_id,
+                'owner': 'me', 'cloud': 'dfw'}
+        data.update(kwargs)
+        return data
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    @mock.patch('abell.models.asset_type.get_asset_type')
+    def test_bulk_create(self, mock_get, mock_db):
+        mock_get.return_value = self.asset_type
+        mock_db.add_new_assets.side_effect = [
+            {'success': True, 'duplicates': [1], 'errors': {}},
+            {'success': True, 'duplicates': [], 'errors': {}}]
+        assets = [self.new_asset('a1', os=7),
+                  self.new_asset('a2'),
+                  {'type': 'server', 'abell_id': 'a3'},
+                  self.new_asset('a4', type='switch'),
+                  self.new_asset('a5')]
+        r = self.app.post('/api/v1/assets/bulk',
+                          data=json.dumps(assets),
+                          headers={'content-type': 'application/json'})
+        self.assertEqual(r.status_code, 200)
+        details = json.loads(r.data.decode()).get('details')
+        self.assertEqual(details.get('created'), ['a1', 'a5'])
+        self.assertEqual(details.get('duplicates'), ['a2'])
+        self.assertEqual([a.get('index') for a in details.get('rejected')],
+                         [2, 3])
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(mock_db.add_new_assets.call_count, 2)
+        first_chunk = mock_db.add_new_assets.call_args_list[0][0][1]
+        self.assertEqual(first_chunk[0].get('os'), '7')
+        self.assertEqual(first_chunk[0].get('notes'), 'None')
+
+    def test_bulk_create_not_a_list(self):
+        r = self.app.post('/api/v1/assets/bulk',
+                          data=json.dumps(self.new_asset('a1')),
+                          headers={'content-type': 'application/json'})
+        self.assertEqual(r.status_code, 400)
+
+
+class BulkUpdateAssetsTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            app = create_app(test_config)
+            self.app = app.test_client()
+            self.app_context = app.app_context()
+            self.app_context.push()
+        self.asset_type = AT.AbellAssetType(
+            'server', asset_info={'managed_keys': ['patches'],
+                                  'unmanaged_keys': ['notes']})
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    @mock.patch('abell.models.asset_type.get_asset_type')
+    def test_bulk_update(self, mock_get, mock_db):
+        mock_get.return_value = self.asset_type
+        mock_db.bulk_update_assets.return_value = {
+            'success': True, 'matched': 1, 'modified': 1,
+            'errors': {1: 'bad update'}, 'counts': [(1, 1), None]}
+        mock_db.asset_ids_per_filter.return_value = {
+            'success': True, 'result': [['a1'], ['a2']]}
+        operations = [
+            {'filter': {'type': 'server', 'abell_id': 'a1'},
+             'update': {'patches': 10, 'owner': 'me'}},
+            {'filter': {'type': 'server', 'abell_id': 'a2'},
+             'update': {'notes': 'hi'}},
+            {'filter': {'type': 'server', 'abell_id': 'a3'},
+             'update': {'owner': 'me'}},
+            {'filter': {'type': 'switch', 'abell_id': 'a4'},
+             'update': {'notes': 'hi'}}]
+        r = self.app.put('/api/v1/assets/bulk',
+                         data=json.dumps(operations),
+                         headers={'content-type': 'application/json'})
+        self.assertEqual(r.status_code, 200)
+        details = json.loads(r.data.decode()).get('details')
+        self.assertEqual(details.get('matched'), 1)
+        self.assertEqual([o.get('status') for o in details.get('results')],
+                         ['ok', 'error', 'rejected', 'rejected'])
+        self.assertEqual(details['results'][0]['updated_keys'],
+                         {'patches': '10'})
+        self.assertEqual([(o.get('matched'), o.get('modified'))
+                          for o in details.get('results')],
+                         [(1, 1), (0, 0), (0, 0), (0, 0)])
+        mock_db.bulk_update_assets.assert_called_with(
+            'server',
+            [({'type': 'server', 'abell_id': 'a1'}, {'patches': '10'}),
+             ({'type': 'server', 'abell_id': 'a2'}, {'notes': 'hi'})],
+            multi=False)
+        mock_db.asset_ids_per_filter.assert_called_once_with(
+            'server', [{'type': 'server', 'abell_id': 'a1'},
+                       {'type': 'server', 'abell_id': 'a2'}],
+            limit=2)
+        self.assertFalse(mock_db.asset_ids.called)
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    @mock.patch('abell.models.asset_type.get_asset_type')
+    def test_bulk_update_needs_single_matches(self, mock_get, mock_db):
+        mock_get.return_value = self.asset_type
+        mock_db.bulk_update_assets.return_value = {
+            'success': True, 'matched': 1, 'modified': 1, 'errors': {}}
+        mock_db.asset_ids_per_filter.return_value = {
+            'success': True, 'result': [['a1', 'a2'], [], ['a3'], []]}
+        operations = [
+            {'filter': {'type': 'server', 'os': 'linux'},
+             'update': {'notes': 'hi'}},
+            {'filter': {'type': 'server', 'abell_id': 'a9'},
+             'update': {'notes': 'hi'}},
+            {'filter': {'type': 'server', 'os': 'bsd'},
+             'update': {'notes': 'hi'}},
+            {'filter': {'type': 'server', 'os': 'ios'},
+             'update': {'notes': 'hi'}}]
+        r = self.app.put('/api/v1/assets/bulk',
+                         data=json.dumps(operations),
+                         headers={'content-type': 'application/json'})
+        self.assertEqual(r.status_code, 200)
+        details = json.loads(r.data.decode()).get('details')
+        self.assertEqual([o.get('status') for o in details.get('results')],
+                         ['rejected', 'not_found', 'ok', 'not_found'])
+        self.assertIn('update_multiple_assets',
+                      details['results'][0]['message'])
+        mock_db.bulk_update_assets.assert_called_with(
+            'server',
+            [({'$and': [{'type': 'server', 'os': 'bsd'},
+                        {'abell_id': 'a3'}]}, {'notes': 'hi'})],
+            multi=False)
+        # no counts from the database, the operation sent reports None
+        self.assertEqual([o.get('matched') for o in details['results']],
+                         [0, 0, None, 0])
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    @mock.patch('abell.models.asset_type.get_asset_type')
+    def test_bulk_update_missed_at_write(self, mock_get, mock_db):
+        mock_get.return_value = self.asset_type
+        mock_db.asset_ids_per_filter.return_value = {
+            'success': True, 'result': [['a1'], ['a2']]}
+        mock_db.bulk_update_assets.return_value = {
+            'success': True, 'matched': 1, 'modified': 0,
+            'counts': [(1, 0), (0, 0)]}
+        operations = [
+            {'filter': {'type': 'server', 'abell_id': 'a1'},
+             'update': {'notes': 'hi'}},
+            {'filter': {'type': 'server', 'abell_id': 'a2'},
+             'update': {'notes': 'hi'}}]
+        r = asset.bulk_update_asset_values(operations)
+        self.assertEqual([(o['status'], o['matched'], o['modified'])
+                          for o in r['results']],
+                         [('ok', 1, 0), ('not_found', 0, 0)])
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    @mock.patch('abell.models.asset_type.get_asset_type')
+    def test_bulk_update_malformed_operations(self, mock_get, mock_db):
+        mock_get.return_value = self.asset_type
+        operations = [{'filter': ['type', 'server'], 'update': {}},
+                      'server',
+                      {'filter': 'server', 'update': {'notes': 'hi'}}]
+        r = self.app.put('/api/v1/assets/bulk',
+                         data=json.dumps(operations),
+                         headers={'content-type': 'application/json'})
+        self.assertEqual(r.status_code, 400)
+        self.assertFalse(mock_db.bulk_update_assets.called)
+        mock_db.asset_ids_per_filter.return_value = {
+            'success': True, 'result': [['a1']]}
+        mock_db.bulk_update_assets.return_value = {
+            'success': True, 'matched': 1, 'modified': 1}
+        operations.append({'filter': {'type': 'server', 'abell_id': 'a1'},
+                           'update': {'notes': 'hi'}})
+        r = asset.bulk_update_asset_values(operations)
+        self.assertEqual([o['status'] for o in r['results']],
+                         ['rejected', 'rejected', 'rejected', 'ok'])
+
+    @mock.patch.object(AbellDb, 'client_bulk_write', True)
+    @mock.patch('abell.database.mongo')
+    def test_bulk_update_client_counts(self, mock_mongo):
+        mock_mongo.db.name = 'abell'
+        mock_mongo.cx.bulk_write.return_value = mock.Mock(
+            matched_count=1, modified_count=1,
+            update_results={0: mock.Mock(matched_count=1, modified_count=1),
+                            1: mock.Mock(matched_count=0, modified_count=0)})
+        db = AbellDb()
+        r = db.bulk_update_assets('server', [({'abell_id': 'a1'}, {'a': 1}),
+                                             ({'abell_id': 'a2'}, {'a': 1})])
+        self.assertEqual(r['counts'], [(1, 1), (0, 0)])
+        self.assertEqual(
+            mock_mongo.cx.bulk_write.call_args[0][0][0]._namespace,
+            'abell.server')
+        self.assertFalse(mock_mongo.db['server'].bulk_write.called)
+
+    @mock.patch.object(AbellDb, 'client_bulk_write', True)
+    @mock.patch('abell.database.mongo')
+    def test_bulk_update_old_server_counts(self, mock_mongo):
+        mock_mongo.cx.bulk_write.side_effect = InvalidOperation(
+            'MongoClient.bulk_write requires MongoDB server version 8.0+.')
+        collection = mock_mongo.db['server']
+        collection.bulk_write.return_value = mock.Mock(matched_count=2,
+                                                       modified_count=1)
+        db = AbellDb()
+        r = db.bulk_update_assets('server', [({'abell_id': 'a1'}, {'a': 1}),
+                                             ({'abell_id': 'a2'}, {'a': 1})])
+        # both matched, which one was modified is not known
+        self.assertEqual(r['counts'], [(1, None), (1, None)])
+        self.assertFalse(db.client_bulk_write)
+        collection.bulk_write.return_value = mock.Mock(matched_count=1,
+                                                       modified_count=1)
+        r = db.bulk_update_assets('server', [({'abell_id': 'a1'}, {'a': 1}),
+                                             ({'abell_id': 'a2'}, {'a': 1})])
+        self.assertEqual(r['counts'], [None, None])
+        self.assertEqual(mock_mongo.cx.bulk_write.call_count, 1)
+
+    @mock.patch('abell.database.mongo')
+    def test_filters_read_in_one_aggregate(self, mock_mongo):
+        collection = mock_mongo.db['server']
+        collection.aggregate.return_value = [
+            {'abell_id': 'a1', 'position': 0},
+            {'abell_id': 'a3', 'position': 2},
+            {'abell_id': 'a4', 'position': 2}]
+        r = AbellDb().asset_ids_per_filter(
+            'server', [{'os': 'linux'}, {'os': 'ios'}, {'os': 'bsd'}])
+        self.assertEqual(r['result'], [['a1'], [], ['a3', 'a4']])
+        self.assertEqual(collection.aggregate.call_count, 1)
+        pipeline = collection.aggregate.call_args[0][0]
+        self.assertEqual(pipeline[0], {'$match': {'os': 'linux'}})
+        self.assertEqual(pipeline[-1]['$unionWith']['pipeline'][0],
+                         {'$match': {'os': 'bsd'}})
+
+    @mock.patch('abell.models.asset_type.get_asset_type')
+    def test_bulk_update_unknown_type(self, mock_get):
+        mock_get.return_value = None
+        operations = [{'filter': {'type': 'server'}, 'update': {}}]
+        r = self.app.put('/api/v1/assets/bulk',
+                         data=json.dumps(operations),
+                         headers={'content-type': 'application/json'})
+        self.assertEqual(r.status_code, 404)
+
+
+class UpdateDeleteAssetsTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            app = create_app(test_config)
+            self.app = app.test_client()
+            self.app_context = app.app_context()
+            self.app_context.push()
+        self.asset_type = AT.AbellAssetType(
+            'server', asset_info={'managed_keys': ['patches'],
+                                  'unmanaged_keys': ['notes']})
+        patcher = mock.patch('abell.models.asset_type.get_asset_type',
+                             return_value=self.asset_type)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_update_by_abell_id_single_call(self, mock_db):
+        mock_db.update_one_asset.return_value = {'success': True,
+                                                 'result': 'a1'}
+        r = asset.update_asset_values('server',
+                                      {'type': 'server', 'abell_id': 'a1'},
+                                      {'notes': 5})
+        self.assertEqual(r.get('updated_asset_ids'), ['a1'])
+        self.assertFalse(mock_db.asset_ids.called)
+        mock_db.update_one_asset.assert_called_with(
+            'server', {'type': 'server', 'abell_id': 'a1'}, {'notes': '5'})
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_update_ambiguous_filter(self, mock_db):
+        mock_db.asset_ids.return_value = {'success': True,
+                                          'result': ['a1', 'a2']}
+        r = asset.update_asset_values('server', {'type': 'server'},
+                                      {'notes': 'x'})
+        self.assertEqual(r.get('error'), 400)
+        mock_db.asset_ids.assert_called_with('server', {'type': 'server'},
+                                             limit=2)
+        self.assertFalse(mock_db.update_one_asset.called)
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_upsert(self, mock_db):
+        mock_db.upsert_asset.return_value = {'success': True,
+                                             'upserted': True}
+        update = {'type': 'server', 'abell_id': 'a1', 'owner': 'me',
+                  'cloud': 'dfw', 'patches': 3}
+        r = asset.update_asset_values('server',
+                                      {'type': 'server', 'abell_id': 'a1'},
+                                      update, auth_level='admin',
+                                      upsert=True)
+        self.assertIn('created', r.get('new_assets'))
+        args = mock_db.upsert_asset.call_args[0]
+        self.assertEqual(args[2], {'patches': '3'})
+        self.assertNotIn('patches', args[3])
+        self.assertEqual(args[3].get('owner'), 'me')
+        self.assertEqual(args[3].get('notes'), 'None')
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_multi_delete(self, mock_db):
+        mock_db.delete_assets.return_value = {'success': True,
+                                              'result': ['a1', 'a2']}
+        r = asset.delete_assets('server', {'type': 'server'}, multi=True)
+        self.assertEqual(r.get('deleted_asset_ids'), ['a1', 'a2'])
+        mock_db.delete_assets.assert_called_with('server',
+                                                 {'type': 'server'}, 1000)
+        self.assertFalse(mock_db.asset_ids.called)
+
+    @mock.patch('abell.database.mongo')
+    def test_multi_update_batches(self, mock_mongo):
+        collection = mock_mongo.db['server']
+        first = [{'_id': 1, 'abell_id': 'a1'}, {'_id': 2, 'abell_id': 'a2'}]
+        cursor = collection.find.return_value.sort.return_value.limit
+        cursor.side_effect = [first, [{'_id': 3, 'abell_id': 'a3'}], []]
+        collection.update_many.side_effect = [
+            mock.Mock(matched_count=2, modified_count=2),
+            mock.Mock(matched_count=0, modified_count=0)]
+        r = AbellDb().update_asset('server', {'os': 'linux'},
+                                   {'notes': 'x'}, batch_size=2)
+        self.assertEqual(r['result'], ['a1', 'a2'])
+        self.assertEqual(r['message'], '2 matched, 2 modified')
+        # the second batch is read after the last _id of the first
+        self.assertEqual(collection.find.call_args_list[1][0][0],
+                         {'$and': [{'os': 'linux'}, {'_id': {'$gt': 2}}]})
+        self.assertEqual(collection.update_many.call_args_list[0][0][0],
+                         {'$and': [{'os': 'linux'},
+                                   {'_id': {'$in': [1, 2]}}]})
+
+    @mock.patch('abell.database.mongo')
+    def test_multi_delete_reports_deleted(self, mock_mongo):
+        collection = mock_mongo.db['server']
+        batch = [{'_id': 1, 'abell_id': 'a1'}, {'_id': 2, 'abell_id': 'a2'}]
+        batches = mock.Mock()
+        batches.sort.return_value.limit.side_effect = [batch, []]
+        # a2 stopped matching and was still there after the delete
+        collection.find.side_effect = lambda query, projection: (
+            [{'_id': 2}] if '$in' in query.get('_id', {}) else batches)
+        collection.delete_many.return_value = mock.Mock(deleted_count=1)
+        r = AbellDb().delete_assets('server', {'os': 'linux'}, batch_size=2)
+        self.assertEqual(r['result'], ['a1'])
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_single_delete_no_match(self, mock_db):
+        mock_db.delete_one_asset.return_value = {'success': True,
+                                                 'result': None}
+        r = self.app.delete('/api/v1/asset',
+                            data=json.dumps({'filter': {'type': 'server',
+                                                        'abell_id': 'a9'}}),
+                            headers={'content-type': 'application/json'})
+        self.assertEqual(r.status_code, 400)
+
+
+class MigrationTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            app = create_app(test_config)
+            self.app = app.test_client()
+            self.app_context = app.app_context()
+            self.app_context.push()
+        self.job = {'_id': 'job1', 'type': 'server', 'new_keys': ['os'],
+                    'removed_keys': [], 'last_id': None, 'processed': 0}
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    @mock.patch('abell.models.migration.ABELLDB')
+    def test_migrate_job_in_chunks(self, mock_db):
+        mock_db.asset_id_chunk.side_effect = [
+            {'success': True, 'result': [1, 2]},
+            {'success': True, 'result': [3]},
+            {'success': True, 'result': []}]
+        mock_db.migrate_assets.return_value = {'success': True}
+        mock_db.update_migration.return_value = {'success': True,
+                                                 'result': True}
+        self.assertTrue(migration.migrate_job(self.job, 'me', chunk_size=2))
+        self.assertEqual(mock_db.asset_id_chunk.call_args_list[1][0],
+                         ('server', 2, 2))
+        mock_db.update_migration.assert_any_call(
+            'job1', 'me', {'last_id': 3, 'processed': 3,
+                           'lease_until': mock.ANY})
+        mock_db.update_migration.assert_called_with(
+            'job1', 'me', {'state': 'done', 'lease_until': 0})
+
+    @mock.patch('abell.models.migration.ABELLDB')
+    def test_migrate_job_resumes(self, mock_db):
+        self.job.update({'last_id': 7, 'processed': 7})
+        mock_db.asset_id_chunk.return_value = {'success': True, 'result': []}
+        migration.migrate_job(self.job, 'me')
+        mock_db.asset_id_chunk.assert_called_with('server', 7, 500)
+
+    @mock.patch('abell.models.migration.ABELLDB')
+    def test_migrate_job_lease_lost(self, mock_db):
+        mock_db.asset_id_chunk.return_value = {'success': True,
+                                               'result': [1]}
+        mock_db.migrate_assets.return_value = {'success': True}
+        mock_db.update_migration.return_value = {'success': True,
+                                                 'result': False}
+        self.assertFalse(migration.migrate_job(self.job, 'me'))
+        self.assertEqual(mock_db.migrate_assets.call_count, 1)
+
+    @mock.patch('abell.models.migration.ABELLDB')
+    def test_migration_status(self, mock_db):
+        mock_db.get_migrations.return_value = {
+            'success': True, 'result': [dict(self.job, state='running',
+                                             lease_until=0)]}
+        mock_db.claim_migration.return_value = {'success': True,
+                                                'result': None}
+        r = self.app.get('/api/v1/migrations/job1')
+        body = json.loads(r.data.decode())
+        self.assertEqual(body['payload']['id'], 'job1')
+        # reading the status leaves stalled jobs alone
+        self.assertNotIn('resumed', body['details'])
+        self.assertFalse(mock_db.claim_migration.called)
+        mock_db.get_migrations.return_value = {'success': True,
+                                               'result': []}
+        r = self.app.get('/api/v1/migrations/job2')
+        self.assertEqual(r.status_code, 404)
+
+    @mock.patch('abell.models.migration.ABELLDB')
+    def test_resume_migrations(self, mock_db):
+        mock_db.get_migrations.return_value = {
+            'success': True, 'result': [dict(self.job, state='running',
+                                             lease_until=0)]}
+        mock_db.claim_migration.return_value = {'success': True,
+                                                'result': None}
+        r = self.app.post('/api/v1/migrations/resume?type=server')
+        body = json.loads(r.data.decode())
+        self.assertEqual(body['details']['resumed'], ['server'])
+        self.assertEqual(mock_db.claim_migration.call_args[0][0], 'server')
+        mock_db.get_migrations.assert_called_with(asset_type='server',
+                                                  unfinished=True)
+
+
+class SparseStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            app = create_app(test_config)
+            self.app = app.test_client()
+            self.app_context = app.app_context()
+            self.app_context.push()
+        self.ato = AT.AbellAssetType(
+            'server', asset_info={'managed_keys': ['os'],
+                                  'unmanaged_keys': ['notes'],
+                                  'sparse': True})
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_new_asset_stores_set_keys(self):
+        new_asset = asset.AbellAsset('server', 'a1',
+                                     {'os': 'linux', 'junk': 'x'}, self.ato)
+        self.assertEqual(set(new_asset.fields),
+                         set(AT.AbellAssetType.SYSTEM_KEYS + ['os']))
+
+    def test_fill_defaults(self):
+        document = {'abell_id': 'a1', 'os': 'linux', 'gone': 'x'}
+        filled = self.ato.fill_defaults(document)
+        self.assertEqual(filled['os'], 'linux')
+        self.assertEqual(filled['notes'], 'None')
+        self.assertNotIn('gone', filled)
+        filled = self.ato.fill_defaults(document, {'_id': 0, 'notes': 1})
+        self.assertEqual(filled, {'notes': 'None'})
+
+    def test_sparse_filter(self):
+        self.assertEqual(
+            asset.sparse_filter({'os': 'None', 'notes': {'$ne': 'None'},
+                                 '$and': [{'cloud': 'None'}]}),
+            {'os': {'$in': [None, 'None']},
+             'notes': {'$nin': [None, 'None']},
+             '$and': [{'cloud': {'$in': [None, 'None']}}]})
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    @mock.patch('abell.models.asset_type.get_asset_type')
+    def test_find_fills_defaults(self, mock_at, mock_db):
+        mock_at.return_value = self.ato
+        mock_db.asset_find.return_value = {
+            'success': True, 'result': [{'abell_id': 'a1', 'os': 'linux'}]}
+        r = asset.asset_find('server', {'type': 'server', 'os': 'None'})
+        mock_db.asset_find.assert_called_with(
+            'server', {'type': 'server', 'os': {'$in': [None, 'None']}},
+            None, None, 0, None)
+        self.assertEqual(r['result'][0]['notes'], 'None')
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    @mock.patch('abell.models.asset_type.get_asset_type')
+    def test_distinct_reports_unset(self, mock_at, mock_db):
+        mock_at.return_value = self.ato
+        mock_db.asset_distinct.return_value = {'success': True,
+                                               'result': ['linux']}
+        mock_db.asset_find.return_value = {'success': True,
+                                           'result': [{'_id': 1}]}
+        r = asset.distinct_asset_fields('server', {'type': 'server'}, 'os')
+        self.assertEqual(r['result'], ['linux', 'None'])
+
+    @mock.patch('abell.models.asset_type.migration.start_migration')
+    @mock.patch('abell.models.asset_type.ABELLDB')
+    def test_new_keys_skip_migration(self, mock_db, mock_migration):
+        mock_db.update_managed_vars.return_value = {'success': True}
+        r = self.ato.add_new_keys(['cabinet'])
+        self.assertTrue(r.get('success'))
+        self.assertIsNone(r.get('migration_id'))
+        self.assertFalse(mock_migration.called)
+
+
+class StringifyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.payload = {'a': 1, 'b': None, 'c': 'x',
+                        'd': {'e': [1, {'f': 2.5}, [True]], 'g': (1, 2)}}
+
+    def test_matches_legacy_output(self):
+        legacy = model_tools.dict_stringify(copy.deepcopy(self.payload))
+        self.assertEqual(model_tools.stringify(self.payload), legacy)
+        self.assertEqual(model_tools.item_stringify(self.payload), legacy)
+
+    def test_input_not_modified(self):
+        original = copy.deepcopy(self.payload)
+        result = model_tools.stringify(self.payload)
+        self.assertEqual(self.payload, original)
+        self.assertIsNot(result['d']['e'], self.payload['d']['e'])
+        items = [1, {'a': 2}]
+        result = model_tools.stringify(items)
+        self.assertEqual(result, ['1', {'a': '2'}])
+        self.assertEqual(items, [1, {'a': 2}])
+
+    def test_asset_leaves_properties_alone(self):
+        ato = AT.AbellAssetType('server', asset_info={'managed_keys': ['d']})
+        original = copy.deepcopy(self.payload)
+        new_asset = asset.AbellAsset('server', 'a1', self.payload, ato)
+        self.assertEqual(self.payload, original)
+        self.assertEqual(new_asset.fields['d']['e'], ['1', {'f': '2.5'},
+                                                      ['True']])
+
+    def test_flat_and_scalar(self):
+        self.assertEqual(model_tools.stringify({'a': 1, 'b': 'b'}),
+                         {'a': '1', 'b': 'b'})
+        self.assertEqual(model_tools.stringify(5), '5')
+        self.assertEqual(model_tools.stringify([]), [])
+
+    def test_deep_nesting(self):
+        payload = leaf = {}
+        for i in range(sys.getrecursionlimit() * 2):
+            leaf['n'] = {}
+            leaf = leaf['n']
+        leaf['n'] = 1
+        result = model_tools.stringify(payload)
+        while type(result) is dict:
+            result = result['n']
+        self.assertEqual(result, '1')
+
+
+class ResponseEncoderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.document = {'_id': ObjectId('5a0c3d9b2f8a4b1c9d0e1f20'),
+                         'seen': datetime.datetime(2017, 6, 1, 12, 30),
+                         'abell_id': 'a1'}
+
+    def tearDown(self):
+        responses.ENCODER.set_encoder('auto')
+
+    def test_bson_types(self):
+        for name in ('json', 'auto'):
+            responses.ENCODER.set_encoder(name)
+            r = responses.abell_success(payload=[self.document])
+            payload = json.loads(r.get_data().decode()).get('payload')
+            self.assertEqual(payload, [{'_id': '5a0c3d9b2f8a4b1c9d0e1f20',
+                                        'seen': '2017-06-01T12:30:00',
+                                        'abell_id': 'a1'}])
+
+    def test_pre_encoded_payload(self):
+        r = responses.abell_success(
+            payload=responses.PreEncoded(b'[{"abell_id": "a1"}]'), info='x')
+        self.assertEqual(json.loads(r.get_data().decode()),
+                         {'code': 200, 'payload': [{'abell_id': 'a1'}],
+                          'details': {'info': 'x'}})
+
+    def test_stdlib_fallback(self):
+        self.assertEqual(responses.ENCODER.encode({'big': 2 ** 70}),
+                         b'{"big": 1180591620717411303424}')
+        responses.ENCODER.set_encoder('not_installed')
+        self.assertEqual(responses.ENCODER.name, 'json')
+
+
+class CompressionTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            app = create_app(test_config)
+            self.app = app.test_client()
+            self.app_context = app.app_context()
+            self.app_context.push()
+        self.assets = [{'abell_id': str(i), 'type': 'server', 'os': 'None'}
+                       for i in range(200)]
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    @mock.patch('abell.models.asset.asset_find')
+    def test_gzip_buffered(self, mock_find):
+        mock_find.return_value = {'success': True, 'result': self.assets}
+        r = self.app.get('/api/v1/asset?type=server',
+                         headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(r.headers.get('Content-Encoding'), 'gzip')
+        self.assertIn('Accept-Encoding', r.headers.get('Vary'))
+        body = json.loads(gzip.decompress(r.data).decode())
+        self.assertEqual(body.get('payload'), self.assets)
+
+    @mock.patch('abell.models.asset.asset_find')
+    def test_small_or_not_accepted(self, mock_find):
+        mock_find.return_value = {'success': True, 'result': self.assets[:1]}
+        r = self.app.get('/api/v1/asset?type=server',
+                         headers={'Accept-Encoding': 'gzip'})
+        self.assertIsNone(r.headers.get('Content-Encoding'))
+        mock_find.return_value = {'success': True, 'result': self.assets}
+        r = self.app.get('/api/v1/asset?type=server')
+        self.assertIsNone(r.headers.get('Content-Encoding'))
+
+    @mock.patch('abell.models.asset.asset_stream')
+    def test_deflate_stream(self, mock_stream):
+        mock_stream.return_value = {'success': True,
+                                    'result': iter(self.assets[:2])}
+        r = self.app.get('/api/v1/asset?type=server',
+                         headers={'Accept-Encoding': 'deflate',
+                                  'Accept': 'application/x-ndjson'})
+        self.assertEqual(r.headers.get('Content-Encoding'), 'deflate')
+        lines = zlib.decompress(r.data).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+                         self.assets[:2])
+
+    @mock.patch('abell.models.asset.asset_stream')
+    def test_stream_sends_first_document_early(self, mock_stream):
+        produced = []
+
+        def documents():
+            for document in self.assets:
+                produced.append(document)
+                yield document
+
+        mock_stream.return_value = {'success': True, 'result': documents()}
+        r = self.app.get('/api/v1/asset?type=server',
+                         headers={'Accept-Encoding': 'gzip',
+                                  'Accept': 'application/x-ndjson'},
+                         buffered=False)
+        decompress = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        text = b''
+        chunks = iter(r.response)
+        while b'\n' not in text:
+            text += decompress.decompress(next(chunks))
+        first = text.split(b'\n')[0].decode()
+        self.assertEqual(json.loads(first), self.assets[0])
+        # the rest of the stream was not encoded to get there
+        self.assertLess(len(produced), 3)
+        r.close()
+
+
+class ConditionalGetTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            app = create_app(test_config)
+            self.app = app.test_client()
+            self.app_context = app.app_context()
+            self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_find_not_modified(self, mock_db):
+        mock_db.get_generation.return_value = {'success': True,
+                                               'result': ('id', 1, 0)}
+        mock_db.asset_find.return_value = {'success': True,
+                                           'result': [{'abell_id': 'a1'}]}
+        r = self.app.get('/api/v1/asset?type=server&cloud=dfw')
+        etag = r.headers.get('ETag')
+        self.assertTrue(etag.startswith('W/'))
+        mock_db.asset_find.reset_mock()
+        r = self.app.get('/api/v1/asset?cloud=dfw&type=server',
+                         headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.data, b'')
+        self.assertFalse(mock_db.asset_find.called)
+        # other format, other tag
+        r = self.app.get('/api/v1/asset?type=server&cloud=dfw&stream=true',
+                         headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_write_changes_etag(self, mock_db):
+        mock_db.get_generation.return_value = {'success': True,
+                                               'result': ('id', 1, 0)}
+        mock_db.asset_count.return_value = {'success': True, 'result': 5}
+        etag = self.app.get('/api/v1/asset/count?type=server').headers.get(
+            'ETag')
+        mock_db.get_generation.return_value = {'success': True,
+                                               'result': ('id', 2, 0)}
+        r = self.app.get('/api/v1/asset/count?type=server',
+                         headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertNotEqual(r.headers.get('ETag'), etag)
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_unknown_type_untagged(self, mock_db):
+        mock_db.get_generation.return_value = {'success': True,
+                                               'result': None}
+        mock_db.asset_distinct.return_value = {'success': True,
+                                               'result': []}
+        r = self.app.get('/api/v1/asset/distinct?type=x&distinct_key=os',
+                         headers={'If-None-Match': '*'})
+        self.assertEqual(r.status_code, 200)
+        self.assertIsNone(r.headers.get('ETag'))
+
+    @mock.patch('abell.models.asset_type.get_asset_type')
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_asset_type_ignores_asset_writes(self, mock_db, mock_at):
+        mock_at.return_value = AT.AbellAssetType('server')
+        mock_db.get_generation.return_value = {'success': True,
+                                               'result': ('id', 1, 3)}
+        etag = self.app.get('/api/v1/asset_type?type=server').headers.get(
+            'ETag')
+        mock_db.get_generation.return_value = {'success': True,
+                                               'result': ('id', 9, 3)}
+        r = self.app.get('/api/v1/asset_type?type=server',
+                         headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(mock_at.call_count, 1)
+
+
+class BinaryFormatsTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            app = create_app(test_config)
+            self.app = app.test_client()
+            self.app_context = app.app_context()
+            self.app_context.push()
+        self.assets = [{'abell_id': str(i), 'type': 'server'}
+                       for i in range(3)]
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    @mock.patch('abell.models.asset.asset_stream')
+    def test_raw_bson_passthrough(self, mock_stream):
+        raw = [RawBSONDocument(bson.encode(a)) for a in self.assets]
+        mock_stream.return_value = {'success': True, 'result': iter(raw)}
+        r = self.app.get('/api/v1/asset?type=server',
+                         headers={'Accept': 'application/bson'})
+        self.assertEqual(r.mimetype, 'application/bson')
+        self.assertEqual(r.data, b''.join(d.raw for d in raw))
+        self.assertEqual(bson.decode_all(r.data), self.assets)
+        self.assertTrue(mock_stream.call_args[1].get('raw'))
+
+    @mock.patch('abell.database.mongo')
+    def test_raw_cursor(self, mock_mongo):
+        collection = mock_mongo.db.__getitem__.return_value
+        asset.ABELLDB.asset_cursor('server', {}, raw=True)
+        options = collection.with_options.call_args[1]['codec_options']
+        self.assertIs(options.document_class, RawBSONDocument)
+
+    @mock.patch('abell.api.responses.msgpack', None)
+    def test_msgpack_unavailable(self):
+        r = self.app.get('/api/v1/asset?type=server',
+                         headers={'Accept': 'application/msgpack'})
+        self.assertEqual(r.status_code, 406)
+
+    @unittest.skipIf(responses.msgpack is None, 'msgpack is not installed')
+    @mock.patch('abell.models.asset.asset_stream')
+    def test_msgpack_stream(self, mock_stream):
+        mock_stream.return_value = {'success': True,
+                                    'result': iter(self.assets)}
+        r = self.app.get('/api/v1/asset?type=server',
+                         headers={'Accept': 'application/msgpack'})
+        self.assertEqual(r.mimetype, 'application/msgpack')
+        unpacker = responses.msgpack.Unpacker(raw=False)
+        unpacker.feed(r.data)
+        self.assertEqual(list(unpacker), self.assets)
+
+
+class ExportTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            app = create_app(test_config)
+            self.app = app.test_client()
+            self.app_context = app.app_context()
+            self.app_context.push()
+        self.assets = [{'abell_id': str(i), 'type': 'server'}
+                       for i in range(3)]
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    @mock.patch('abell.models.asset_type.get_asset_type')
+    def test_export(self, mock_at, mock_db):
+        mock_at.return_value = AT.AbellAssetType(
+            'server', asset_info={'managed_keys': ['os']})
+        mock_db.asset_snapshot.return_value = {
+            'success': True, 'result': {'documents': iter(self.assets),
+                                        'snapshot': True}}
+        r = self.app.get('/api/v1/asset_type/server/export',
+                         headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.mimetype, 'application/gzip')
+        self.assertIn('server.ndjson.gz',
+                      r.headers.get('Content-Disposition'))
+        # sent as is, not gzipped a second time
+        self.assertIsNone(r.headers.get('Content-Encoding'))
+        lines = gzip.decompress(r.data).decode().splitlines()
+        header = json.loads(lines[0])
+        self.assertEqual(header['schema']['managed_keys'], ['os'])
+        self.assertTrue(header['snapshot'])
+        self.assertEqual([json.loads(line) for line in lines[1:]],
+                         self.assets)
+
+    @mock.patch('abell.models.asset_type.get_asset_type')
+    def test_export_unknown_type(self, mock_at):
+        mock_at.return_value = None
+        r = self.app.get('/api/v1/asset_type/nope/export')
+        self.assertEqual(r.status_code, 404)
+
+    @mock.patch('abell.database.mongo')
+    def test_snapshot_fallback(self, mock_mongo):
+        def no_snapshots():
+            raise OperationFailure('no snapshots')
+            yield
+        unsupported = mock.MagicMock()
+        unsupported.__iter__.return_value = no_snapshots()
+        plain = mock.MagicMock()
+        plain.__iter__.return_value = iter(self.assets)
+        collection = mock_mongo.db.__getitem__.return_value
+        collection.find.side_effect = [unsupported, plain]
+        r = asset.ABELLDB.asset_snapshot('server')
+        self.assertFalse(r['result']['snapshot'])
+        self.assertEqual(list(r['result']['documents']), self.assets)
+        self.assertIsNone(collection.find.call_args[1]['session'])
+        mock_mongo.cx.start_session.return_value.end_session.assert_called()
+        plain.close.assert_called()
+
+
+class LoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            self.flask_app = create_app(test_config)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ato = AT.AbellAssetType(
+            'server', asset_info={'managed_keys': ['os', 'rack']})
+        patcher = mock.patch('abell.models.asset_type.get_asset_type')
+        patcher.start().return_value = self.ato
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_csv_insert(self, mock_db):
+        mock_db.add_new_assets.side_effect = lambda t, items: {
+            'success': True, 'errors': {},
+            'duplicates': [0] if items[0]['abell_id'] == 'a1' else []}
+        path = self.write('assets.csv',
+                          'abell_id,type,owner,cloud,os\n'
+                          'a1,server,me,dfw,linux\n'
+                          'a2,server,me,dfw,\n'
+                          'a3,switch,me,dfw,ios\n'
+                          'a4,server,me,dfw,bsd\n')
+        checkpoint = os.path.join(self.tmp_dir, 'load.checkpoint')
+        summary = loader.load_file(self.flask_app, path, 'server',
+                                   workers=2, chunk_size=2,
+                                   checkpoint_path=checkpoint)
+        self.assertEqual(summary['read'], 4)
+        self.assertEqual(summary['inserted'], 2)
+        self.assertEqual(summary['duplicates'], 1)
+        self.assertEqual(summary['rejected'], 1)
+        self.assertEqual(summary['errors'][0][:2], (3, 'a3'))
+        self.assertEqual(summary['checkpoint'], 4)
+        written = [item for call in mock_db.add_new_assets.call_args_list
+                   for item in call[0][1]]
+        self.assertEqual(written[1]['os'], 'None')
+        self.assertEqual(written[1]['rack'], 'None')
+
+        mock_db.add_new_assets.reset_mock()
+        summary = loader.load_file(self.flask_app, path, 'server',
+                                   checkpoint_path=checkpoint, resume=True)
+        self.assertEqual(summary['read'], 0)
+        self.assertFalse(mock_db.add_new_assets.called)
+
+        os.remove(checkpoint)
+        with self.assertRaises(ValueError):
+            loader.load_file(self.flask_app, path, 'server',
+                             checkpoint_path=checkpoint, resume=True)
+        with self.assertRaises(ValueError):
+            loader.load_file(self.flask_app, path, 'server', resume=True)
+        self.assertFalse(mock_db.add_new_assets.called)
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_failed_chunk_is_loaded_on_resume(self, mock_db):
+        def add_new_assets(asset_type, items):
+            if items[0]['abell_id'] == 'a3':
+                return {'success': False, 'message': 'DB insert error'}
+            return {'success': True, 'errors': {}, 'duplicates': []}
+        mock_db.add_new_assets.side_effect = add_new_assets
+        path = self.write('assets.csv',
+                          'abell_id,type,owner,cloud,os\n' +
+                          ''.join('a%d,server,me,dfw,linux\n' % i
+                                  for i in range(1, 7)))
+        checkpoint = os.path.join(self.tmp_dir, 'load.checkpoint')
+        summary = loader.load_file(self.flask_app, path, 'server',
+                                   workers=1, chunk_size=2,
+                                   checkpoint_path=checkpoint)
+        self.assertEqual(summary['failed_chunks'], 1)
+        self.assertEqual(summary['rejected'], 2)
+        self.assertEqual(summary['checkpoint'], 2)
+
+        mock_db.add_new_assets.reset_mock()
+        mock_db.add_new_assets.side_effect = lambda t, items: {
+            'success': True, 'errors': {}, 'duplicates': []}
+        summary = loader.load_file(self.flask_app, path, 'server',
+                                   workers=1, chunk_size=2,
+                                   checkpoint_path=checkpoint, resume=True)
+        written = [item['abell_id']
+                   for call in mock_db.add_new_assets.call_args_list
+                   for item in call[0][1]]
+        self.assertEqual(written, ['a3', 'a4', 'a5', 'a6'])
+        self.assertEqual(summary['failed_chunks'], 0)
+        self.assertEqual(summary['checkpoint'], 6)
+
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_ndjson_upsert(self, mock_db):
+        mock_db.upsert_assets.return_value = {'success': True, 'errors': {},
+                                              'upserted': 1, 'matched': 0}
+        path = self.write('assets.ndjson',
+                          '{"abell_id": "a1", "type": "server", '
+                          '"owner": "me", "cloud": "dfw", "os": 7}\n'
+                          'not json\n')
+        summary = loader.load_file(self.flask_app, path, 'server',
+                                   mode='upsert')
+        self.assertEqual(summary['inserted'], 1)
+        self.assertEqual(summary['rejected'], 1)
+        abell_id, set_dict, insert_dict = \
+            mock_db.upsert_assets.call_args[0][1][0]
+        self.assertEqual(abell_id, 'a1')
+        self.assertEqual(set_dict, {'os': '7'})
+        self.assertEqual(insert_dict['rack'], 'None')
+        self.assertEqual(insert_dict['owner'], 'me')
+        self.assertNotIn('os', insert_dict)
+
+    def test_checkpoint_waits_for_earlier_chunks(self):
+        checkpoint = loader.Checkpoint(None, 'assets.csv')
+        checkpoint.chunk_done(1, 20)
+        self.assertEqual(checkpoint.line, 0)
+        checkpoint.chunk_done(0, 10)
+        self.assertEqual(checkpoint.line, 20)
+
+
+class ServeTestCase(unittest.TestCase):
+    def test_mongo_uri(self):
+        settings = {'MONGO_USERNAME': 'abell', 'MONGO_PASSWORD': 'p@ss',
+                    'MONGO_HOST': 'db', 'MONGO_PORT': '27017',
+                    'MONGO_DBNAME': 'abell'}
+        self.assertEqual(mongo_uri(settings),
+                         'mongodb://abell:p%40ss@db:27017/abell')
+        self.assertEqual(mongo_uri(settings, max_pool_size=12),
+                         'mongodb://abell:p%40ss@db:27017/abell'
+                         '?maxPoolSize=12')
+
+    def test_pool_scales_with_threads(self):
+        worker_config = server.serve_config(test_config, 16)
+        self.assertEqual(worker_config.MONGO_MAX_POOL_SIZE,
+                         16 + server.POOL_HEADROOM)
+        self.assertTrue(issubclass(worker_config, test_config))
+        with mock.patch('abell.mongo'):
+            app = create_app(worker_config)
+        self.assertIn('maxPoolSize=20', app.config['MONGO_URI'])
+
+    @mock.patch('abell.server.serve')
+    @mock.patch('abell.server.create_app')
+    def test_main_builds_no_app(self, mock_create_app, mock_serve):
+        server.main(['-w', '2', '--bind', '0.0.0.0:6100'])
+        self.assertFalse(mock_create_app.called)
+        mock_serve.assert_called_once_with(
+            base_config, bind='0.0.0.0:6100', workers=2,
+            threads=None)
+
+    @mock.patch('abell.models.asset_type.ABELLDB')
+    def test_warm_cache(self, mock_db):
+        mock_db.get_asset_types.return_value = {
+            'success': True,
+            'result': [{'type': 'server', 'managed_keys': ['os'],
+                        'version': 2}]}
+        with mock.patch('abell.mongo'):
+            app = create_app(test_config)
+        worker = mock.Mock(wsgi=app)
+        server.warm_worker(worker)
+        cached = AT.ASSET_TYPE_CACHE.peek('server')
+        self.assertEqual(cached.managed_keys, set(['os']))
+        mock_db.get_asset_types.assert_called_with(
+            limit=AT.ASSET_TYPE_CACHE.maxsize)
+
+
+def run_async(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def async_result(value):
+    async def result(*args, **kwargs):
+        return value
+    return result
+
+
+class FakeAsyncCursor(object):
+    def __init__(self, documents):
+        self.documents = list(documents)
+
+    def batch_size(self, size):
+        return self
+
+    def sort(self, sort):
+        return self
+
+    def limit(self, limit):
+        return self
+
+    async def to_list(self, length):
+        return list(self.documents)
+
+    def __aiter__(self):
+        self.remaining = iter(self.documents)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.remaining)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class AsyncDbTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = AsyncAbellDb()
+        self.db.db = mock.MagicMock()
+
+    def test_get_generation(self):
+        self.db.db.assetinfo.find_one = async_result(
+            {'_id': 'abc', 'generation': 4, 'version': 2})
+        response = run_async(self.db.get_generation('server'))
+        self.assertEqual(response['result'], ('abc', 4, 2))
+
+    def test_asset_find(self):
+        self.db.db['server'].find.return_value = FakeAsyncCursor(
+            [{'abell_id': 'a1'}])
+        response = run_async(self.db.asset_find('server', {'cloud': 'dfw'},
+                                                {'_id': 0}))
+        self.assertTrue(response['success'])
+        self.assertEqual(response['result'], [{'abell_id': 'a1'}])
+
+    def test_db_error(self):
+        async def count_documents(asset_filter):
+            raise OperationFailure('down')
+        self.db.db['server'].count_documents = count_documents
+        response = run_async(self.db.asset_count('server', {}))
+        self.assertFalse(response['success'])
+        self.assertEqual(response['error'], 500)
+
+
+@unittest.skipIf(async_api.web is None, 'aiohttp is not installed')
+class AsyncApiTestCase(unittest.TestCase):
+    def setUp(self):
+        from aiohttp.test_utils import TestClient, TestServer
+        with mock.patch('abell.mongo'):
+            self.flask_app = create_app(test_config).test_client()
+
+        def client():
+            # an aiohttp app can only be started once
+            with mock.patch('abell.mongo'):
+                web_app = async_api.create_async_app(test_config)
+            web_app.on_startup.clear()
+            web_app.on_cleanup.clear()
+            return TestClient(TestServer(web_app))
+        self.client = client
+        type_info = {'type': 'server', 'managed_keys': ['os'], 'version': 1}
+        db = async_api.ASYNC_DB
+        patches = [
+            mock.patch.object(db, 'get_generation',
+                              async_result({'success': True,
+                                            'result': ('x', 3, 1)})),
+            mock.patch.object(db, 'get_asset_type_info',
+                              async_result({'success': True,
+                                            'result': type_info})),
+            mock.patch.object(db, 'asset_find',
+                              async_result({'success': True,
+                                            'result': [{'abell_id': 'a1'},
+                                                       {'abell_id': 'a2'}]})),
+            mock.patch.object(db, 'asset_count',
+                              async_result({'success': True, 'result': 2})),
+            mock.patch.object(db, 'asset_cursor', return_value={
+                'success': True, 'result': FakeAsyncCursor(
+                    [{'abell_id': 'a1'}])})]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def get(self, url, **headers):
+        async def request():
+            async with self.client() as client:
+                response = await client.get(url, headers=headers)
+                return response.status, response.headers, \
+                    await response.read()
+        return run_async(request())
+
+    def test_find_pages(self):
+        status, headers, body = self.get(
+            '/api/v1/asset?type=server&limit=1')
+        self.assertEqual(status, 200)
+        result = json.loads(body.decode('utf-8'))
+        self.assertEqual(result['payload'], [{'abell_id': 'a1'}])
+        self.assertEqual(result['details']['next_cursor'], 'a1')
+
+    def test_etag_matches_sync_api(self):
+        with mock.patch('abell.models.asset.type_generation',
+                        return_value=('x', 3, 1)), \
+                mock.patch('abell.models.asset.ABELLDB') as mock_db:
+            mock_db.asset_count.return_value = {'success': True,
+                                                'result': 2}
+            sync_etag = self.flask_app.get(
+                '/api/v1/asset/count?type=server').headers['ETag']
+        status, headers, body = self.get('/api/v1/asset/count?type=server')
+        self.assertEqual(headers['ETag'], sync_etag)
+        status, headers, body = self.get('/api/v1/asset/count?type=server',
+                                         **{'If-None-Match': sync_etag})
+        self.assertEqual(status, 304)
+
+    def test_ndjson(self):
+        status, headers, body = self.get(
+            '/api/v1/asset?type=server', Accept='application/x-ndjson')
+        self.assertEqual(headers['Content-Type'], 'application/x-ndjson')
+        self.assertTrue(body.endswith(b'\n'))
+        self.assertEqual(json.loads(body.decode('utf-8')), {'abell_id': 'a1'})
+
+    def test_bad_params(self):
+        status, headers, body = self.get('/api/v1/asset?type=server&limit=0')
+        self.assertEqual(status, 400)
+
+
+class ReadRoutingTestCase(unittest.TestCase):
+    def setUp(self):
+        class routed_config(test_config):
+            READ_PREFERENCE = 'secondaryPreferred'
+            READ_MAX_STALENESS = 120
+        with mock.patch('abell.mongo'):
+            app = create_app(routed_config)
+            self.app = app.test_client()
+
+    def test_pool_options_in_uri(self):
+        settings = {'MONGO_USERNAME': 'abell', 'MONGO_PASSWORD': 'pw',
+                    'MONGO_HOST': 'db1,db2:27018', 'MONGO_PORT': '27017',
+                    'MONGO_DBNAME': 'abell', 'MONGO_REPLICA_SET': 'rs0',
+                    'MONGO_MIN_POOL_SIZE': 2, 'MONGO_MAX_POOL_SIZE': 20,
+                    'MONGO_WAIT_QUEUE_TIMEOUT_MS': 500,
+                    'MONGO_SERVER_SELECTION_TIMEOUT_MS': 3000}
+        self.assertEqual(mongo_uri(settings),
+                         'mongodb://abell:pw@db1:27017,db2:27018/abell'
+                         '?maxPoolSize=20&minPoolSize=2&replicaSet=rs0'
+                         '&serverSelectionTimeoutMS=3000'
+                         '&waitQueueTimeoutMS=500')
+
+    def test_read_preference(self):
+        self.assertEqual(read_preference({}), ReadPreference.PRIMARY)
+        preference = read_preference({'READ_PREFERENCE': 'secondary',
+                                      'READ_MAX_STALENESS': 90})
+        self.assertEqual(preference.mongos_mode, 'secondary')
+        self.assertEqual(preference.max_staleness, 90)
+        with self.assertRaises(ValueError):
+            read_preference({'READ_PREFERENCE': 'anywhere'})
+
+    @mock.patch('abell.models.asset.type_generation')
+    @mock.patch('abell.models.asset.sparse_type', return_value=None)
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_count_reads_secondaries_uncached(self, mock_db, mock_sparse,
+                                              mock_generation):
+        mock_db.asset_count.return_value = {'success': True, 'result': 3}
+        for _ in range(2):
+            r = self.app.get('/api/v1/asset/count?type=server')
+            self.assertEqual(r.status_code, 200)
+            self.assertNotIn('ETag', r.headers)
+        self.assertEqual(mock_db.asset_count.call_count, 2)
+        preference = mock_db.asset_count.call_args[0][2]
+        self.assertEqual(preference.mongos_mode, 'secondaryPreferred')
+        self.assertEqual(preference.max_staleness, 120)
+        mock_generation.assert_not_called()
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            self.flask_app = create_app(test_config)
+            self.app = self.flask_app.test_client()
+
+    @mock.patch('abell.models.asset.type_generation', return_value=None)
+    @mock.patch('abell.models.asset.sparse_type', return_value=None)
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_server_timing_and_metrics(self, mock_db, mock_sparse,
+                                       mock_generation):
+        mock_db.asset_count.return_value = {'success': True, 'result': 3}
+        r = self.app.get('/api/v1/asset/count?type=server')
+        phases = [timing.split(';')[0]
+                  for timing in r.headers['Server-Timing'].split(', ')]
+        self.assertEqual(phases, ['db', 'serialize', 'total'])
+        r = self.app.get('/metrics')
+        self.assertEqual(r.mimetype, 'text/plain')
+        text = r.data.decode('utf-8')
+        self.assertIn('abell_request_seconds_count{route="GET '
+                      '/api/v1/asset/count",phase="total"} 1', text)
+        self.assertIn('route="GET /api/v1/asset/count",phase="db",'
+                      'le="+Inf"} 1', text)
+        self.assertNotIn('route="GET /metrics"', text)
+
+    @mock.patch('abell.database.mongo')
+    def test_db_time_and_errors(self, mock_mongo):
+        mock_mongo.db['server'].find.side_effect = OperationFailure('down')
+        with self.flask_app.test_request_context('/'):
+            metrics.start_request()
+            r = AbellDb().asset_find('server', {})
+            self.assertFalse(r['success'])
+            self.assertGreater(metrics.g.timings['db'], 0)
+            self.assertEqual(metrics.g.db_depth, 0)
+        # asset_find failed inside asset_cursor
+        self.assertEqual(metrics.METRICS.db_errors, {'asset_cursor': 1})
+        self.assertIn('abell_db_errors_total{method="asset_cursor"} 1',
+                      metrics.METRICS.render())
+
+    def test_histogram_buckets(self):
+        histogram = metrics.Histogram(buckets=(0.1, 1.0, float('inf')))
+        for seconds in (0.05, 0.5, 5):
+            histogram.observe(seconds)
+        self.assertEqual(histogram.counts, [1, 2, 3])
+        self.assertEqual(histogram.count, 3)
+        self.assertAlmostEqual(histogram.sum, 5.55)
+
+
+COLLSCAN_EXPLAIN = {
+    'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN',
+                                     'filter': {'os': {'$regex': '^l'}}}},
+    'executionStats': {'nReturned': 2, 'totalDocsExamined': 5000,
+                       'totalKeysExamined': 0}}
+
+
+class SlowQueryTestCase(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('abell.mongo'):
+            self.flask_app = create_app(test_config)
+            self.app = self.flask_app.test_client()
+
+    def test_query_shape(self):
+        query = {'type': 'server', 'os': {'$regex': '^l'},
+                 '$or': [{'cloud': 'dfw'},
+                         {'owner': {'$in': ['a', 'b']}}]}
+        self.assertEqual(slow_queries.query_shape(query),
+                         {'type': '?', 'os': {'$regex': '?'},
+                          '$or': [{'cloud': '?'}, {'owner': {'$in': '?'}}]})
+
+    def test_plan_summary(self):
+        summary = slow_queries.plan_summary(COLLSCAN_EXPLAIN)
+        self.assertTrue(summary['collscan'])
+        self.assertEqual(summary['docs_examined'], 5000)
+        self.assertEqual(summary['returned'], 2)
+        # slot based engine plans nest the stages under queryPlan
+        summary = slow_queries.plan_summary({'queryPlanner': {
+            'winningPlan': {'queryPlan': {
+                'stage': 'FETCH',
+                'inputStage': {'stage': 'IXSCAN',
+                               'indexName': 'cloud_1'}}}}})
+        self.assertEqual(summary['stages'], ['FETCH', 'IXSCAN'])
+        self.assertEqual(summary['indexes'], ['cloud_1'])
+        self.assertFalse(summary['collscan'])
+
+    def test_shapes_are_explained_once(self):
+        log = slow_queries.SlowQueryLog(threshold_ms=100, background=False)
+        explain = mock.Mock(return_value={'success': True,
+                                          'result': COLLSCAN_EXPLAIN})
+        started = time.perf_counter()
+        log.check('find', 'server', {'filter': {'os': 'linux'}}, started, 3,
+                  explain)
+        self.assertEqual(log.worst(), {})
+        for os_name in ('linux', 'bsd'):
+            log.check('find', 'server', {'filter': {'os': os_name}},
+                      started - 1, 3, explain)
+        entry = log.worst()['server'][0]
+        self.assertEqual(entry['count'], 2)
+        self.assertTrue(entry['plan']['collscan'])
+        self.assertEqual(explain.call_count, 1)
+
+    def test_keys_and_sort_are_part_of_the_shape(self):
+        log = slow_queries.SlowQueryLog(threshold_ms=100, background=False)
+        explain = mock.Mock(return_value={'success': False})
+        started = time.perf_counter() - 1
+        for key in ('os', 'owner', 'os'):
+            log.check('distinct', 'server',
+                      {'filter': {'cloud': 'dfw'}, 'key': key}, started, 3,
+                      explain)
+        for sort in ([], ['abell_id']):
+            log.check('find', 'server', {'filter': {}, 'sort': sort},
+                      started, 3, explain)
+        shapes = sorted((e['operation'], e['count'], json.dumps(e['shape']))
+                        for e in log.worst()['server'])
+        self.assertEqual(shapes, [
+            ('distinct', 1, '{"filter": {"cloud": "?"}, "key": "owner"}'),
+            ('distinct', 2, '{"filter": {"cloud": "?"}, "key": "os"}'),
+            ('find', 1, '{"filter": {}, "sort": ["abell_id"]}'),
+            ('find', 1, '{"filter": {}, "sort": []}')])
+        self.assertEqual(explain.call_count, 4)
+
+    def test_explain_runs_in_background(self):
+        log = slow_queries.SlowQueryLog(threshold_ms=100)
+        release = threading.Event()
+
+        def explain():
+            release.wait(5)
+            return {'success': True, 'result': COLLSCAN_EXPLAIN}
+
+        log.check('count', 'server', {'filter': {'os': 'linux'}},
+                  time.perf_counter() - 1, 1, explain)
+        # the check returned while the explain is still waiting
+        entry = log.worst()['server'][0]
+        self.assertIsNone(entry['plan'])
+        release.set()
+        for _ in range(100):
+            if log.worst()['server'][0]['plan']:
+                break
+            time.sleep(0.01)
+        self.assertTrue(log.worst()['server'][0]['plan']['collscan'])
+
+    @mock.patch('abell.database.mongo')
+    def test_slow_count_is_explained(self, mock_mongo):
+        mock_mongo.db['server'].count_documents.return_value = 7
+        mock_mongo.db.command.return_value = COLLSCAN_EXPLAIN
+        with self.flask_app.app_context(), \
+                mock.patch.object(slow_queries.SLOW_QUERIES, 'threshold_ms',
+                                  1e-9):
+            r = AbellDb().asset_count('server', {'os': {'$regex': '^l'}})
+        self.assertEqual(r['result'], 7)
+        command = mock_mongo.db.command.call_args
+        self.assertEqual(command[0][0], 'explain')
+        self.assertEqual(dict(command[0][1]),
+                         {'count': 'server',
+                          'query': {'os': {'$regex': '^l'}}})
+        r = self.app.get('/api/v1/admin/slow_queries?type=server')
+        payload = json.loads(r.data.decode('utf-8'))['payload']
+        entry = payload['server'][0]
+        self.assertEqual(entry['operation'], 'count')
+        self.assertEqual(entry['shape'], {'filter': {'os': {'$regex': '?'}}})
+        self.assertTrue(entry['plan']['collscan'])
+
+
+class ProfilingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def client(self, **options):
+        settings = {'PROFILING_ENABLED': True,
+                    'PROFILING_TOKEN': 'secret',
+                    'PROFILING_DIR': self.directory}
+        settings.update(options)
+        with mock.patch('abell.mongo'):
+            app = create_app(type('ProfilingConfig', (test_config,),
+                                  settings))
+        return app.test_client()
+
+    def profiles(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith('.json'))
+
+    @mock.patch('abell.models.asset.type_generation', return_value=None)
+    @mock.patch('abell.models.asset.sparse_type', return_value=None)
+    @mock.patch('abell.models.asset.ABELLDB')
+    def test_profile_on_header(self, mock_db, mock_sparse, mock_generation):
+        mock_db.asset_count.return_value = {'success': True, 'result': 3}
+        client = self.client(PROFILING_TRACEMALLOC=True)
+        url = '/api/v1/asset/count?type=server&os=/^l'
+        r = client.get(url, headers={'X-Abell-Profile': 'wrong'})
+        self.assertNotIn('X-Abell-Profile', r.headers)
+        r = client.get(url, headers={'X-Abell-Profile': 'secret'})
+        name = r.headers['X-Abell-Profile']
+        self.assertTrue(name.startswith('GET_api_v1_asset_count-'))
+        self.assertEqual(self.profiles(), [name + '.json'])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.directory, name + '.prof')))
+        with open(os.path.join(self.directory, name + '.json')) as f:
+            details = json.load(f)
+        self.assertEqual(details['route'], 'GET /api/v1/asset/count')
+        self.assertEqual(details['shape'],
+                         {'filter': {'type': '?', 'os': {'$regex': '?'}}})
+        self.assertEqual(details['status'], 200)
+        self.assertIsInstance(details['allocations'], list)
+        self.assertFalse(profiling.tracemalloc.is_tracing())
+
+    def test_sampling(self):
+        client = self.client(PROFILING_TOKEN=None, PROFILING_SAMPLE_RATE=2)
+        for _ in range(4):
+            r = client.get('/', headers={'X-Abell-Profile': 'secret'})
+            # the file name is only sent back to token holders
+            self.assertNotIn('X-Abell-Profile', r.headers)
+        self.assertEqual(len(self.profiles()), 2)
+
+    def test_disabled(self):
+        client = self.client(PROFILING_ENABLED=False,
+                             PROFILING_SAMPLE_RATE=1)
+        r = client.get('/', headers={'X-Abell-Profile': 'secret'})
+        self.assertNotIn('X-Abell-Profile', r.headers)
+        self.assertEqual(self.profiles(), [])
+
+
 if __name__ == '__main__':
     unittest.main()